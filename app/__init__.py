@@ -1,13 +1,96 @@
-import sqlite3
+import importlib
+import configparser
 
-from flask import Flask
+import rollups
+import database
+from app import storage, metrics
+from app.ingest import IngestBuffer, Pipeline
+from app.journal import Journal, JournaledBuffer
+from app.boundary import Boundary
+from app.positions import LatestPositions
  
 
-path = "./snowdonia.db"
-conn = sqlite3.connect(path, check_same_thread=False)
+config_path = 'config.ini'
+config = configparser.ConfigParser()
+config.read(config_path)
 
-app = Flask(__name__)
- 
-from app import views
-from app.maps import make_map_traffic
-from app.maps import make_map_world, make_map_berlin_bvg
+path = config.get('SERVICE', 'database')
+pragmas = storage.get_pragmas(config)
+
+# switches to WAL mode if configured
+with storage.connect(path, pragmas) as conn:
+    database.migrate(conn)
+conn.close()
+
+# queries use pooled read-only connections, the writer its own connection
+readers = storage.ReadPool(path,
+    size=config.getint('SQLITE', 'readers', fallback=4), pragmas=pragmas)
+
+buffer_settings = dict(
+    batch_size=config.getint('SERVICE', 'batch_size', fallback=500),
+    max_latency=config.getfloat('SERVICE', 'batch_latency', fallback=0.5),
+    connect=lambda path: storage.connect(path, pragmas),
+    vehicle_cache=config.getint('SERVICE', 'vehicle_cache', fallback=100000),
+    max_retries=config.getint('SERVICE', 'write_retries', fallback=10),
+    dead_letter=config.get('SERVICE', 'dead_letter', fallback='') or None)
+if config.getboolean('JOURNAL', 'enabled', fallback=False):
+    # accepted rows are appended to the journal, then applied in the background
+    journal = Journal(config.get('JOURNAL', 'directory', fallback='journal'),
+        segment_size=config.getint('JOURNAL', 'segment_size', fallback=100000),
+        fsync=config.get('JOURNAL', 'fsync', fallback='interval'),
+        fsync_interval=config.getfloat('JOURNAL', 'fsync_interval', fallback=1.0))
+    buffer = JournaledBuffer(path, journal,
+        load_size=config.getint('JOURNAL', 'load_size', fallback=50000), **buffer_settings)
+else:
+    buffer = IngestBuffer(path, **buffer_settings)
+# trip aggregates and rollups are updated with every batch written
+buffer.hooks.append(rollups.aggregate)
+buffer.timers.append(metrics.observe_write)
+
+center_lat, center_lon = [float(x) for x in
+    config.get('SERVICE', 'center', fallback='52.516667, 13.383333').split(',')]
+boundary = Boundary(center_lat, center_lon,
+    config.getfloat('SERVICE', 'radius', fallback=50000),
+    max_exited=config.getint('SERVICE', 'max_exited', fallback=100000))
+
+pipeline = Pipeline(buffer)
+pipeline.batch_filters.append(boundary.check_many)
+metrics.registry.gauge('ingest_queue_depth',
+    'Number of accepted rows waiting to be written.',
+    lambda: pipeline.sink.stats()['queue_depth'])
+
+# latest position of every vehicle, rebuilt from the database on startup
+positions = LatestPositions()
+with readers.connection() as conn:
+    positions.load(conn)
+pipeline.observers.append(positions.update)
+
+# optional subsystems, only imported if enabled
+blueprints = [name.strip() for name in
+    config.get('SERVICE', 'blueprints', fallback='export, maps').split(',')]
+
+
+def create_app():
+    '''
+    Create the Flask application with the views of all enabled blueprints.
+
+    This is done when app is first imported from this package, so the
+    aiohttp implementation, which only uses the other objects, never loads
+    Flask and the Flask views.
+    '''
+
+    global app
+    from flask import Flask
+
+    app = Flask(__name__)
+    from app import views
+    for name in filter(None, blueprints):
+        module = importlib.import_module('app.%s_views' % name)
+        app.register_blueprint(module.blueprint)
+    return app
+
+
+def __getattr__(name):
+    if name == 'app':
+        return create_app()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
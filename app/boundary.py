@@ -0,0 +1,153 @@
+"""
+City boundary filter for incoming emissions.
+
+Emissions from vehicles outside the boundary (a circle with a given radius
+around the town centre) are disregarded, as are all later emissions from
+vehicles that have exited it once (up to a maximum number of vehicles
+remembered, the least recently seen ones are forgotten first).
+"""
+
+import math
+
+import numpy as np
+
+from utils import bbox, distance, distances
+from app.cache import LRUCache
+
+
+class Boundary(object):
+    '''
+    Circular city boundary with precomputed bounding boxes for fast checks.
+
+    Points inside an inner box (inscribed into the circle) are accepted and
+    points outside an outer box (enclosing the circle) are rejected without
+    any geodesic computation. Only points between both boxes, i.e. near the
+    edge, are checked with the exact geodesic distance.
+
+    Up to max_exited vehicles found outside are remembered.
+    '''
+
+    def __init__(self, lat, lon, radius, margin=0.01, max_exited=100000):
+        self.lat = lat
+        self.lon = lon
+        self.radius = radius
+
+        # the margin makes up for the boxes being computed from only four
+        # points of the circle, on an ellipsoid
+        self.outer = bbox(lat, lon, radius * (1 + margin))
+        self.inner = bbox(lat, lon, radius / math.sqrt(2) * (1 - margin))
+        self.exited = LRUCache(max_size=max_exited)
+
+        # statistics
+        self.accepted = 0
+        self.rejected_outside = 0
+        self.rejected_exited = 0
+        self.exact_checks = 0
+
+    def boxed(self, lat, lon):
+        '''
+        Return True if the given position is inside the inner box, False if
+        outside the outer box, else (near the edge) None.
+        '''
+
+        (lat_ll, lon_ll), (lat_ur, lon_ur) = self.inner
+        if lat_ll <= lat <= lat_ur and lon_ll <= lon <= lon_ur:
+            return True
+        (lat_ll, lon_ll), (lat_ur, lon_ur) = self.outer
+        if not (lat_ll <= lat <= lat_ur and lon_ll <= lon <= lon_ur):
+            return False
+        return None
+
+    def contains(self, lat, lon):
+        'Return True if the given position is inside the boundary.'
+
+        inside = self.boxed(lat, lon)
+        if inside is not None:
+            return inside
+        self.exact_checks += 1
+        return distance(self.lat, self.lon, lat, lon) <= self.radius
+
+    def contains_many(self, lats, lons):
+        '''
+        Return a boolean array telling which positions are inside the boundary.
+
+        This does the same as contains() for arrays of positions at once.
+        '''
+
+        lats, lons = np.asarray(lats, dtype=float), np.asarray(lons, dtype=float)
+        (lat_ll, lon_ll), (lat_ur, lon_ur) = self.inner
+        inside = (lat_ll <= lats) & (lats <= lat_ur) & (lon_ll <= lons) & (lons <= lon_ur)
+        (lat_ll, lon_ll), (lat_ur, lon_ur) = self.outer
+        edge = ~inside & (lat_ll <= lats) & (lats <= lat_ur) & (lon_ll <= lons) & (lons <= lon_ur)
+        if edge.any():
+            # the fast flat approximation decides all but the points within
+            # 0.1 % of the radius, which get the exact geodesic distance
+            dist = distances(self.lat, self.lon, lats[edge], lons[edge], mode='flat')
+            close = np.abs(dist - self.radius) <= self.radius * 1e-3
+            if close.any():
+                self.exact_checks += int(close.sum())
+                dist[close] = distances(self.lat, self.lon,
+                    lats[edge][close], lons[edge][close], mode='geodesic')
+            inside[edge] = dist <= self.radius
+        return inside
+
+    def check(self, row):
+        '''
+        Check an emission row, return None if accepted, else the reason.
+
+        Vehicles found outside are remembered, so their later emissions are
+        rejected without doing the geometry again.
+        '''
+
+        return self.decide(row)
+
+    def decide(self, row, inside=None):
+        '''
+        Check a row like check(), where inside tells if its position is
+        inside the boundary, if already known.
+        '''
+
+        uid = row[0]
+        if self.exited.get(uid) is not None:
+            self.rejected_exited += 1
+            return 'vehicle has exited the city boundary'
+        if inside is None:
+            inside = self.contains(row[4], row[3])
+        if not inside:
+            self.exited.put(uid, True)
+            self.rejected_outside += 1
+            return 'outside the city boundary'
+        self.accepted += 1
+        return None
+
+    def check_many(self, rows):
+        '''
+        Check a list of emission rows like check(), return the list of reasons.
+
+        The boxes decide most positions faster one by one, but those near
+        the edge, which need the distance, are checked at once with
+        contains_many().
+        '''
+
+        if len(rows) == 1:
+            return [self.check(rows[0])]
+        inside = [self.boxed(r[4], r[3]) for r in rows]
+        # not for vehicles rejected anyway
+        edge = [i for i, known in enumerate(inside)
+            if known is None and self.exited.get(rows[i][0]) is None]
+        if edge:
+            found = self.contains_many([rows[i][4] for i in edge], [rows[i][3] for i in edge])
+            for i, ok in zip(edge, found.tolist()):
+                inside[i] = ok
+        return [self.decide(row, ok) for row, ok in zip(rows, inside)]
+
+    def stats(self):
+        'Return a dict with boundary check statistics.'
+
+        return dict(
+            boundary_accepted=self.accepted,
+            boundary_rejected_outside=self.rejected_outside,
+            boundary_rejected_exited=self.rejected_exited,
+            boundary_exact_checks=self.exact_checks,
+            exited_vehicles=len(self.exited),
+        )
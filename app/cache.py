@@ -0,0 +1,62 @@
+"""
+Small in-memory cache with LRU eviction and an optional time to live.
+"""
+
+import time
+import threading
+import collections
+
+
+class LRUCache(object):
+    '''
+    Thread-safe mapping of keys to values with a maximum size.
+
+    When the cache is full, the least recently used entry is evicted.
+    Entries older than ttl seconds (if given) are treated as missing.
+    '''
+
+    def __init__(self, max_size=128, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        'Return the value for a key, or default if missing or expired.'
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.ttl is not None \
+                    and time.time() - entry[0] > self.ttl:
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        'Add or replace a value, evicting the least recently used if needed.'
+
+        with self.lock:
+            self.entries[key] = (time.time(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        'Return a dict with cache statistics.'
+
+        return dict(size=len(self.entries), max_size=self.max_size,
+            hits=self.hits, misses=self.misses)
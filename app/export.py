@@ -0,0 +1,80 @@
+"""
+Streaming export of query results as CSV, and exports into the archive.
+
+Rows are fetched from the database cursor in chunks and converted to CSV
+text chunk by chunk, optionally gzip-compressed, so memory use does not
+depend on the size of the result.
+"""
+
+import io
+import csv
+import zlib
+import threading
+
+import vehicles
+from app import path, pragmas, storage
+
+
+def decode_rows(conn, rows):
+    'Decode rows of traffic queries, which start with the row id, see vehicles.decode().'
+
+    return vehicles.decode(conn, rows, 1)
+
+
+def iter_csv(readers, cmd, params=(), header=None, chunk_size=5000, compress=False,
+             convert=None):
+    '''
+    Run a query with a pooled connection and yield the result as CSV chunks.
+
+    The header is a list of column names, by default the names of the
+    columns returned by the query. If given, convert is called with the
+    connection and every list of rows fetched and returns the rows to
+    write. Chunks are bytes, gzip-compressed if compress is True. The
+    connection goes back into the pool when the generator is exhausted or
+    closed.
+    '''
+
+    gz = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+    with readers.connection() as conn:
+        cursor = conn.execute(cmd, params)
+        if header is None:
+            header = [d[0] for d in cursor.description]
+        rows = [header]
+        while True:
+            fetched = cursor.fetchmany(chunk_size)
+            rows.extend(convert(conn, fetched) if convert and fetched else fetched)
+            if not rows:
+                break
+            out = io.StringIO()
+            csv.writer(out, lineterminator='\n').writerows(rows)
+            data = out.getvalue().encode('utf-8')
+            rows = []
+            if gz:
+                data = gz.compress(data)
+                if not data:
+                    continue
+            yield data
+        cursor.close()
+    if gz:
+        yield gz.flush()
+
+
+archive_lock = threading.Lock()
+
+
+def export_archive():
+    '''
+    Export new rows into the columnar archive, see archive.py.
+
+    Only one export runs at a time, with its own database connection for
+    updating the watermark. Returns a dict with the results.
+    '''
+
+    import archive
+
+    with archive_lock:
+        conn = storage.connect(path, pragmas)
+        try:
+            return archive.export(conn)
+        finally:
+            conn.close()
@@ -0,0 +1,212 @@
+"""
+Optional blueprint with the query and export endpoints.
+"""
+
+import os
+import json
+
+from flask import Blueprint, Response, request, abort, send_from_directory
+
+import archive
+import rollups
+from app import readers
+from app.ingest import fields
+from app.export import iter_csv, export_archive, decode_rows
+from app.queries import traffic_query, search_area, trip_summary, rollup_summary
+
+
+blueprint = Blueprint('export', __name__)
+
+
+@blueprint.route('/vehicles/near')
+def get_vehicles_near():
+    '''
+    Return emissions within a radius (in meters) around a position as JSON.
+
+    The result contains the distinct vehicle uids found, and all matching
+    rows with their distances from the position. Like for /data.csv, the
+    time window can be given with duration, since and until, and vehicles
+    filtered by type.
+
+    Examples:
+        /vehicles/near?lat=52.516667&lon=13.383333&radius=500&duration=PT10M
+        /vehicles/near?lat=52.516667&lon=13.383333&radius=500&since=1473103778&until=1473104378
+    '''
+
+    if request.args.get('bbox', None):
+        abort(404, 'Use /vehicles/within to search a bounding box.')
+    try:
+        result = search_area(request.args)
+    except ValueError as e:
+        abort(404, str(e))
+    return Response(json.dumps(result), mimetype='application/json')
+
+
+@blueprint.route('/vehicles/within')
+def get_vehicles_within():
+    '''
+    Return emissions inside a bounding box as JSON.
+
+    The box is given as bbox=min_lon,min_lat,max_lon,max_lat, the other
+    arguments and the result are like for /vehicles/near.
+
+    Example:
+        /vehicles/within?bbox=13.3,52.5,13.4,52.55&type=bus&duration=PT10M
+    '''
+
+    if not request.args.get('bbox', None):
+        abort(404, 'bbox=min_lon,min_lat,max_lon,max_lat is needed.')
+    try:
+        result = search_area(request.args)
+    except ValueError as e:
+        abort(404, str(e))
+    return Response(json.dumps(result), mimetype='application/json')
+
+
+@blueprint.route('/trips')
+def get_trips():
+    '''
+    Return trip aggregates per vehicle type and time bucket as JSON.
+
+    For every type and bucket, the result contains the number of vehicles
+    and emissions, the distance travelled (in meters), the time covered
+    (duration), the average and maximum speed (in m/s), the time stopped
+    and number of stops, and the time spent inside the city boundary (all
+    times in seconds). The time window is given like for /data.csv, and
+    bucket is the length of the buckets in seconds, a multiple of the one
+    in the TRIPS section of config.ini.
+
+    Examples:
+        /trips?duration=PT6H
+        /trips?type=bus&since=1473103778&bucket=86400
+    '''
+
+    try:
+        result = trip_summary(request.args)
+    except ValueError as e:
+        abort(404, str(e))
+    return Response(json.dumps(result), mimetype='application/json')
+
+
+@blueprint.route('/trips/<uid>')
+def get_trips_vehicle(uid):
+    '''
+    Return trip aggregates of one vehicle per time bucket as JSON.
+
+    The arguments and results are like for /trips.
+
+    Example:
+        /trips/687a7ec8-6fa8-11e6-b897-442a60f31a14?duration=P1D
+    '''
+
+    try:
+        result = trip_summary(request.args, uid)
+    except ValueError as e:
+        abort(404, str(e))
+    return Response(json.dumps(result), mimetype='application/json')
+
+
+@blueprint.route('/stats')
+def get_stats():
+    '''
+    Return fleet statistics per time bucket as JSON, read from the rollups.
+
+    For every bucket (of a minute, or an hour with period=hour) the result
+    contains the number of emissions and distinct vehicles, and their
+    average heading and speed. With by=type they are given per vehicle
+    type, and with a bbox per grid cell intersecting it. The time window
+    is given like for /data.csv.
+
+    Examples:
+        /stats?duration=PT1H&by=type
+        /stats?period=hour&type=bus&since=1473103778
+        /stats?bbox=13.38,52.51,13.40,52.52&duration=PT10M
+    '''
+
+    try:
+        result = rollup_summary(request.args)
+    except ValueError as e:
+        abort(404, str(e))
+    return Response(json.dumps(result), mimetype='application/json')
+
+
+@blueprint.route('/stats/totals')
+def get_stats_totals():
+    '''
+    Return the number of rows in the database per vehicle type as JSON.
+    '''
+
+    with readers.connection() as conn:
+        totals = rollups.totals(conn)
+    return Response(json.dumps(totals), mimetype='application/json')
+
+
+@blueprint.route('/data.csv')
+def get_data_csv():
+    '''
+    Download traffic data from matching some criteria, as a CSV file.
+
+    Duration is supposed to be in ISO8601 format (PT1H means a time
+    period of one hour), since is a timestamp in seconds.
+
+    The first column contains the row id. To download a large result
+    in pages, pass limit and the id of the last row received as after.
+
+    The result is streamed in chunks as it is read from the database, and
+    gzip-compressed if the client accepts it.
+
+    Examples:
+        /data.csv
+        /data.csv?type=car&duration=PT1H
+        /data.csv?uid=687a7ec8-6fa8-11e6-b897-442a60f31a14
+        /data.csv?since=1473103778&limit=10000&after=42
+    '''
+
+    try:
+        cmd, params = traffic_query(request.args)
+    except ValueError as e:
+        abort(404, str(e))
+
+    compress = 'gzip' in request.headers.get('Accept-Encoding', '')
+    header = [''] + fields
+    chunks = iter_csv(readers, cmd, params, header=header, compress=compress,
+        convert=decode_rows)
+    headers = {'Vary': 'Accept-Encoding'}
+    if compress:
+        headers['Content-Encoding'] = 'gzip'
+    return Response(chunks, mimetype='text/csv', headers=headers)
+
+
+@blueprint.route('/archive', methods=['POST'])
+def post_archive():
+    '''
+    Export all rows added since the last export into the columnar archive.
+
+    Returns the number of rows exported, the files written and the new
+    watermark as JSON.
+
+    Test using curl like this:
+
+    curl -X POST "http://localhost:5000/archive"
+    '''
+
+    result = export_archive()
+    return Response(json.dumps(result), mimetype='application/json')
+
+
+@blueprint.route('/archive')
+def get_archive():
+    '''
+    Return the list of archive files as JSON.
+    '''
+
+    return Response(json.dumps(archive.list_files()), mimetype='application/json')
+
+
+@blueprint.route('/archive/<path:name>')
+def get_archive_file(name):
+    '''
+    Download an archive file, e.g. /archive/date=2016-09-05/part-000000000001.parquet
+    '''
+
+    return send_from_directory(os.path.abspath(archive.archive_dir), name)
@@ -0,0 +1,570 @@
+"""
+Buffered ingest of vehicle emissions into the database.
+
+Instead of committing every single emission, rows are collected in memory
+and written by a dedicated writer thread with one ``executemany`` call and
+one transaction per batch (group commit). A batch is flushed as soon as it
+reaches a given size or when its oldest row has waited for a given maximum
+latency, whatever comes first.
+"""
+
+import os
+import math
+import time
+import json
+import uuid
+import queue
+import atexit
+import itertools
+import sqlite3
+import threading
+import traceback
+import concurrent.futures
+
+import vehicles
+from protocol import min_timestamp, max_timestamp
+from app.cache import LRUCache
+
+
+allowed_types = ['bus', 'car', 'taxi', 'train', 'tram']
+fields = ['uid', 'type', 'timestamp', 'longitude', 'lattitude', 'heading']
+
+
+def parse_emission(data):
+    '''
+    Validate a single emission given as a dict and return it as a row tuple.
+
+    Raises ValueError with a short message if the emission is invalid.
+    '''
+
+    missing = [f for f in fields if f not in data]
+    if missing:
+        raise ValueError('missing field(s): %s' % ', '.join(missing))
+    try:
+        uid = str(uuid.UUID(str(data['uid'])))
+    except ValueError:
+        raise ValueError('invalid uid: %r' % data['uid'])
+    typ = data['type']
+    if typ not in allowed_types:
+        raise ValueError('invalid type: %r' % typ)
+    try:
+        timestamp, lon, lat, heading = [float(data[f]) for f in fields[2:]]
+    except (TypeError, ValueError):
+        raise ValueError('timestamp, longitude, lattitude and heading must be numbers')
+    # NaN and infinity would pass the range checks below or break the writer
+    if not all(map(math.isfinite, (timestamp, lon, lat, heading))):
+        raise ValueError('timestamp, longitude, lattitude and heading must be finite')
+    if not min_timestamp <= timestamp < max_timestamp:
+        raise ValueError('timestamp out of range')
+    if not (-180 <= lon <= 180 and -90 <= lat <= 90):
+        raise ValueError('longitude/lattitude out of range')
+    return (uid, typ, timestamp, lon, lat, heading % 360)
+
+
+def parse_batch(body):
+    '''
+    Parse a JSON array or newline-delimited JSON into a list of items.
+
+    Raises ValueError if the body is not valid JSON.
+    '''
+
+    body = body.strip()
+    if body.startswith('['):
+        return json.loads(body)
+    return [json.loads(line) for line in body.splitlines() if line.strip()]
+
+
+def submit_batch(pipeline, items):
+    '''
+    Validate a list of emission dicts and submit the valid ones together.
+
+    Returns a dict with the number of accepted and rejected rows and the
+    status of every row, in the given order.
+    '''
+
+    rows, results = [], []
+    for item in items:
+        try:
+            if not isinstance(item, dict):
+                raise ValueError('not a JSON object')
+            rows.append(parse_emission(item))
+            results.append({'status': 'accepted'})
+        except ValueError as e:
+            results.append({'status': 'rejected', 'error': str(e)})
+
+    reasons = iter(pipeline.submit(rows))
+    for res in results:
+        if res['status'] == 'accepted':
+            reason = next(reasons)
+            if reason is not None:
+                res.update(status='rejected', error=reason)
+
+    accepted = sum(1 for res in results if res['status'] == 'accepted')
+    return dict(accepted=accepted, rejected=len(results) - accepted, results=results)
+
+
+class Pipeline(object):
+    '''
+    Chain of checks that parsed emissions pass before being stored.
+
+    Filters are callables taking a row and returning None if the row is
+    accepted, else a short reason for rejecting it. Batch filters do the
+    same for a list of rows at once, returning a list of reasons, and are
+    applied first, to the rows in the order given. Observers are callables
+    taking the list of accepted rows. The sink stores accepted rows and must
+    provide a put_many method, like IngestBuffer, and a blocking attribute,
+    telling asynchronous servers to submit rows in a thread if True. Sinks
+    checking rows themselves, like WriterSink, return a list of reasons
+    from put_many, like the filters.
+    '''
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.filters = []
+        self.batch_filters = []
+        self.observers = []
+
+    def submit(self, rows):
+        '''
+        Run rows through all filters and store the accepted ones.
+
+        Returns a list with None for every accepted row and the rejection
+        reason for every other one, in the given order.
+        '''
+
+        reasons = [None] * len(rows)
+        for check in self.batch_filters:
+            pending = [i for i, reason in enumerate(reasons) if reason is None]
+            for i, reason in zip(pending, check([rows[i] for i in pending])):
+                reasons[i] = reason
+        for i, row in enumerate(rows):
+            for check in self.filters:
+                if reasons[i] is not None:
+                    break
+                reasons[i] = check(row)
+        accepted = [row for row, reason in zip(rows, reasons) if reason is None]
+        if accepted:
+            rejected = self.sink.put_many(accepted)
+            if rejected is not None:
+                rejected = iter(rejected)
+                reasons = [next(rejected) if r is None else r for r in reasons]
+                accepted = [row for row, r in zip(rows, reasons) if r is None]
+            for observe in self.observers:
+                observe(accepted)
+        return reasons
+
+
+def is_busy(error):
+    '''
+    Return whether a database error is only due to a lock held by another
+    connection, so writing again later may succeed.
+    '''
+
+    if not isinstance(error, sqlite3.OperationalError):
+        return False
+    # the primary result code is in the low byte of extended ones
+    code = getattr(error, 'sqlite_errorcode', None)
+    if code is not None:
+        return code & 0xff in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+    return 'locked' in str(error) or 'busy' in str(error)
+
+
+class IngestBuffer(object):
+    '''
+    Thread-safe write buffer flushing rows into the traffic table in batches.
+
+    Rows are tuples of uid, type, timestamp (in seconds), longitude,
+    lattitude and heading, like returned by parse_emission(). The writer
+    thread is started with the first row put into the buffer, and the
+    buffer is flushed when the interpreter exits. The writer thread opens
+    its own connection, using the optional connect function given.
+
+    Hooks are callables taking the connection and the list of records
+    written (with timestamps in milliseconds), called in the same
+    transaction, to maintain tables derived from the traffic table.
+    Timers are callables taking a dict with the durations (in seconds) of
+    the phases of writing a batch, see write(), and its number of rows.
+
+    Rows of a batch that failed because the database is busy (locked for
+    too long by another connection) are put back into the buffer and
+    retried, up to max_retries times in a row. A batch failing because of
+    one of its rows is retried in halves, to find the rows that cannot be
+    written. These rows, and the whole batch if it failed for any other
+    reason (like a missing table) or the retries are used up, are rejected
+    and counted, and appended to the dead_letter file if given, as lines
+    of JSON which can be posted to /data/batch again.
+
+    The ids of vehicles in the vehicles table (see vehicles.py) are kept in
+    an LRU cache of up to vehicle_cache vehicles.
+    '''
+
+    # put_many only waits for the lock of the buffer
+    blocking = False
+
+    def __init__(self, path, batch_size=500, max_latency=0.5, connect=None,
+            vehicle_cache=100000, max_retries=10, dead_letter=None):
+        self.path = path
+        self.connect = connect or (lambda path: sqlite3.connect(path, timeout=30))
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.max_retries = max_retries
+        self.dead_letter = dead_letter
+        # failed attempts since the last batch written
+        self.retries = 0
+
+        self.rows = []
+        self.oldest = None
+        self.cond = threading.Condition()
+        self.closed = False
+        self.thread = None
+        self.conn = None
+        self.hooks = []
+        self.timers = []
+        self.vehicle_ids = LRUCache(max_size=vehicle_cache)
+
+        # statistics
+        self.rows_put = 0
+        self.rows_flushed = 0
+        self.flushes = 0
+        self.flush_errors = 0
+        self.rows_rejected = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+        self.total_flush_latency = 0.0
+
+        atexit.register(self.close)
+
+    def start(self):
+        '''
+        Start the writer thread, if not running yet (called lazily with the
+        first row, or by servers when they start).
+        '''
+
+        with self.cond:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.run, name='ingest-writer')
+            self.thread.daemon = True
+            self.thread.start()
+
+    def put(self, row):
+        'Add a single row to the buffer.'
+
+        self.put_many([row])
+
+    def put_many(self, rows):
+        '''
+        Add several rows to the buffer.
+
+        All rows given in one call end up in the same transaction.
+        '''
+
+        with self.cond:
+            if self.closed:
+                raise RuntimeError('ingest buffer is closed')
+            if self.thread is None:
+                self.start()
+            # the writer waits for the first row, then for the batch to be due
+            first = not self.rows
+            if first:
+                self.oldest = time.time()
+            self.rows.extend(rows)
+            self.rows_put += len(rows)
+            if first or len(self.rows) >= self.batch_size:
+                self.cond.notify()
+
+    def take(self):
+        'Wait for the next batch to be due and return it (empty when closed).'
+
+        with self.cond:
+            while not self.closed:
+                if len(self.rows) >= self.batch_size:
+                    break
+                if self.rows:
+                    timeout = self.oldest + self.max_latency - time.time()
+                    if timeout <= 0:
+                        break
+                else:
+                    timeout = None
+                self.cond.wait(timeout)
+            rows, self.rows = self.rows, []
+            return rows
+
+    def requeue(self, rows):
+        'Put rows back in front of the buffer, to be retried with the next batch.'
+
+        with self.cond:
+            self.rows[:0] = rows
+            self.oldest = time.time()
+
+    def run(self):
+        'Main loop of the writer thread.'
+
+        self.conn = self.connect(self.path)
+        while True:
+            rows = self.take()
+            if rows:
+                try:
+                    retry = self.store(rows)
+                except Exception:
+                    # the rows were written, only the statistics may be wrong
+                    traceback.print_exc()
+                    continue
+                if retry and self.closed:
+                    print('Lost %d rows not written before shutdown' % len(retry))
+                elif retry:
+                    self.requeue(retry)
+                    time.sleep(self.max_latency)
+            elif self.closed:
+                break
+
+    @staticmethod
+    def to_record(row):
+        '''
+        Convert a row into the values to be inserted (timestamp in
+        milliseconds). Raises ValueError if a value is out of range.
+        '''
+
+        uid, typ, timestamp, lon, lat, heading = row
+        if typ not in allowed_types:
+            raise ValueError('invalid type: %r' % typ)
+        if not (min_timestamp <= timestamp < max_timestamp and -180 <= lon <= 180
+                and -90 <= lat <= 90 and math.isfinite(heading)):
+            raise ValueError('value out of range')
+        return (uid, typ, int(round(float(timestamp) * 1000)), lon, lat, heading)
+
+    def resolve(self, uids):
+        '''
+        Return the vehicle ids of uids as a dict, from the cache if possible.
+
+        Must be called in the write transaction, as unknown vehicles are
+        added to the vehicles table.
+        '''
+
+        ids, missing = {}, []
+        for uid in set(uids):
+            id = self.vehicle_ids.get(uid)
+            if id is None:
+                missing.append(uid)
+            else:
+                ids[uid] = id
+        if missing:
+            new = vehicles.intern(self.conn, missing)
+            for uid, id in new.items():
+                self.vehicle_ids.put(uid, id)
+            ids.update(new)
+        return ids
+
+    def insert(self, records):
+        'Insert records into the traffic table, in the write transaction.'
+
+        ids = self.resolve(r[0] for r in records)
+        self.conn.executemany(vehicles.insert_cmd, vehicles.encode(records, ids))
+
+    def store(self, rows):
+        '''
+        Write rows, in halves if a transaction fails, and return the rows to
+        be retried because the database is busy (usually none).
+        '''
+
+        error = self.write(rows)
+        if error is None:
+            self.retries = 0
+            return []
+        if is_busy(error) and self.retries < self.max_retries:
+            self.retries += 1
+            return rows
+        if isinstance(error, sqlite3.OperationalError) or len(rows) == 1:
+            # not caused by a row, like a missing table, or busy for too long
+            self.retries = 0
+            self.reject(rows, error)
+            return []
+        half = len(rows) // 2
+        retry = self.store(rows[:half])
+        if retry:
+            return retry + rows[half:]
+        return self.store(rows[half:])
+
+    def reject(self, rows, error):
+        'Drop rows that cannot be written, keeping them in the dead letter file.'
+
+        self.rows_rejected += len(rows)
+        if len(rows) == 1:
+            print('Rejected row %r: %s' % (rows[0], error))
+        else:
+            print('Rejected %d rows: %s' % (len(rows), error))
+        if self.dead_letter is None:
+            return
+        try:
+            with open(self.dead_letter, 'a') as f:
+                for row in rows:
+                    f.write(json.dumps(dict(zip(fields, row), error=str(error))) + '\n')
+        except (OSError, ValueError) as e:
+            print('Failed writing rejected rows to %s: %s' % (self.dead_letter, e))
+
+    def write(self, rows):
+        '''
+        Write rows in one transaction and update statistics. Returns None,
+        or the error if the transaction failed (and was rolled back).
+
+        The phases passed to the timers are waiting for the write lock,
+        executing the insert, running the hooks and committing.
+        '''
+
+        start = time.time()
+        try:
+            records = [self.to_record(row) for row in rows]
+            t0 = time.perf_counter()
+            with self.conn:
+                # take the write lock first, to know how long it took
+                self.conn.execute('BEGIN IMMEDIATE')
+                t1 = time.perf_counter()
+                self.insert(records)
+                t2 = time.perf_counter()
+                for hook in self.hooks:
+                    hook(self.conn, records)
+                t3 = time.perf_counter()
+            t4 = time.perf_counter()
+        except Exception as e:
+            # ids of vehicles added in the failed transaction are invalid
+            self.vehicle_ids.clear()
+            self.flush_errors += 1
+            print('Failed writing %d rows: %s' % (len(rows), e))
+            return e
+        for timer in self.timers:
+            timer(dict(lock=t1 - t0, execute=t2 - t1, hooks=t3 - t2, commit=t4 - t3), len(rows))
+        latency = time.time() - start
+        self.flushes += 1
+        self.rows_flushed += len(rows)
+        self.last_flush_latency = latency
+        self.max_flush_latency = max(self.max_flush_latency, latency)
+        self.total_flush_latency += latency
+
+    def close(self):
+        'Flush all pending rows and stop the writer thread.'
+
+        with self.cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.cond.notify()
+        if self.thread is not None:
+            self.thread.join()
+
+    def stats(self):
+        'Return a dict with queue depth and flush statistics.'
+
+        with self.cond:
+            depth = len(self.rows)
+        avg = self.total_flush_latency / self.flushes if self.flushes else 0.0
+        return dict(
+            queue_depth=depth,
+            batch_size=self.batch_size,
+            max_latency=self.max_latency,
+            rows_put=self.rows_put,
+            rows_flushed=self.rows_flushed,
+            flushes=self.flushes,
+            flush_errors=self.flush_errors,
+            rows_rejected=self.rows_rejected,
+            last_flush_latency=self.last_flush_latency,
+            avg_flush_latency=avg,
+            max_flush_latency=self.max_flush_latency,
+            vehicle_cache_size=len(self.vehicle_ids),
+            vehicle_cache_hits=self.vehicle_ids.hits,
+            vehicle_cache_misses=self.vehicle_ids.misses,
+        )
+
+
+class WriterSink(object):
+    '''
+    Sink of the worker processes of serve_multi.py, submitting rows to the
+    pipeline of the writer process.
+
+    The writer process checks the rows with its filters, so the state of
+    the city boundary is shared by all workers, and stores the accepted
+    ones. It sends back the reasons, which Pipeline.submit() merges with
+    its own, as well as the rows accepted from all other workers and via
+    UDP, which are passed on to the observers given (those of the worker's
+    pipeline, like the latest positions and the live feed), its statistics,
+    and the metrics of writing rows, which are passed to restore_metrics.
+    All of this is read by a thread from the queue of replies of the worker.
+
+    put_many waits for the reasons, so the sink is blocking. If the queue
+    to the writer is full, or the writer does not reply within timeout
+    seconds, RuntimeError is raised and the rows are not accepted.
+    '''
+
+    blocking = True
+
+    def __init__(self, index, requests, replies, observers, restore_metrics=None,
+            timeout=10):
+        self.index = index
+        self.requests = requests
+        self.replies = replies
+        self.observers = observers
+        self.restore_metrics = restore_metrics
+        self.timeout = timeout
+        self.ids = itertools.count()
+        self.futures = {}
+        # unknown until the writer sends its statistics
+        self.writer_stats = dict(queue_depth=None)
+        self.rows_put = 0
+
+        self.thread = threading.Thread(target=self.run, name='writer-replies')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put_many(self, rows):
+        '''
+        Submit rows to the writer, return the reasons for rejecting them.
+        '''
+
+        id = next(self.ids)
+        future = self.futures[id] = concurrent.futures.Future()
+        try:
+            try:
+                self.requests.put_nowait((self.index, id, list(rows)))
+            except queue.Full:
+                raise RuntimeError('ingest queue is full, try again later')
+            try:
+                reasons = future.result(self.timeout)
+            except concurrent.futures.TimeoutError:
+                raise RuntimeError('writer process not responding')
+        finally:
+            del self.futures[id]
+        self.rows_put += reasons.count(None)
+        return reasons
+
+    def run(self):
+        'Main loop of the thread reading the replies of the writer.'
+
+        while True:
+            kind, value = self.replies.get()
+            if kind == 'rows':
+                for observe in self.observers:
+                    observe(value)
+            elif kind == 'stats':
+                self.writer_stats = value
+            elif kind == 'metrics':
+                if self.restore_metrics is not None:
+                    self.restore_metrics(value)
+            else:
+                id, result = value
+                future = self.futures.get(id)
+                if future is None:
+                    # timed out
+                    continue
+                if kind == 'error':
+                    future.set_exception(RuntimeError(result))
+                else:
+                    future.set_result(result)
+
+    def stats(self):
+        'Return the latest statistics of the writer and those of this worker.'
+
+        try:
+            depth = self.requests.qsize()
+        except NotImplementedError:
+            depth = None
+        return dict(self.writer_stats, worker_queue_depth=depth,
+            worker_rows_put=self.rows_put, worker_pid=os.getpid())
@@ -0,0 +1,449 @@
+"""
+Append-only journal of accepted emissions, applied to the database in the
+background.
+
+With the journal, accepted rows are not kept in memory until they are
+written, but appended to a journal on local disk first, so every emission
+acknowledged survives a crash of the service. The journal consists of
+segment files with fixed-size records of 53 bytes, all numbers little
+endian and without padding:
+
+    ======  =======  ==============================================
+    offset  type     content
+    ======  =======  ==============================================
+    0       16 byte  vehicle UID (UUID bytes in network order)
+    16      uint8    vehicle type code, see protocol.type_codes
+    17      float64  timestamp in seconds since the epoch
+    25      float64  longitude in degrees
+    33      float64  lattitude in degrees
+    41      float64  heading in degrees
+    49      uint32   CRC-32 of the bytes before
+    ======  =======  ==============================================
+
+Unlike the UDP format of protocol.py, values are stored as received. The
+checksum detects records only partly written when the service or machine
+crashed, which end a segment.
+
+The writer thread of JournaledBuffer is the loader: it applies the records
+after its position (segment and record number) in large transactions,
+and stores the new position in the watermarks table in the same
+transaction. Segments are deleted once applied and a new one is started
+when the current one is full. On startup, the loader starts at the stored
+position, so segments left over are applied exactly once, even if the
+service crashed while applying them. Records that cannot be stored, like
+with an unknown type or values out of range, are skipped like rows
+rejected by IngestBuffer, so they cannot stop the loader.
+
+The journal is configured in the JOURNAL section of ``config.ini``: its
+directory, the number of records per segment and per transaction, and
+when appended records are flushed to disk with fsync: ``always`` before
+a request is answered, at most every ``fsync_interval`` seconds
+(``interval``), or ``never`` (left to the operating system, which still
+survives crashes of the service, but not of the machine). With
+``interval``, records appended at the end of a burst are synced by the
+writer thread once the interval has passed. As appending may block,
+serve_aiohttp.py does it in a thread, not on its event loop.
+
+With serve_multi.py, the journal is appended to by the writer process,
+before the worker submitting the rows answers the request.
+"""
+
+import os
+import time
+import uuid
+import zlib
+import struct
+import threading
+import traceback
+
+from protocol import type_codes, types
+from app.ingest import IngestBuffer
+
+
+body = struct.Struct('<16sBdddd')
+record_size = body.size + 4
+
+fsync_policies = ('always', 'interval', 'never')
+
+
+def encode(rows):
+    'Encode rows like returned by parse_emission() as concatenated records.'
+
+    records = []
+    for (uid, typ, ts, lon, lat, heading) in rows:
+        data = body.pack(uuid.UUID(uid).bytes, type_codes[typ], ts, lon, lat, heading)
+        records.append(data + struct.pack('<I', zlib.crc32(data)))
+    return b''.join(records)
+
+
+def decode(data):
+    '''
+    Decode concatenated records into rows like returned by parse_emission().
+
+    Stops at the first incomplete record or record with a wrong checksum.
+    The type of records with an unknown type code is None.
+    '''
+
+    rows, uids = [], {}
+    for i in range(0, len(data) - record_size + 1, record_size):
+        end = i + body.size
+        if zlib.crc32(data[i:end]) != struct.unpack_from('<I', data, end)[0]:
+            break
+        uid, code, ts, lon, lat, heading = body.unpack_from(data, i)
+        text = uids.get(uid)
+        if text is None:
+            text = uids[uid] = str(uuid.UUID(bytes=uid))
+        typ = types[code] if code < len(types) else None
+        rows.append((text, typ, ts, lon, lat, heading))
+    return rows
+
+
+def get_position(conn):
+    'Return the segment and record number up to which the journal was applied.'
+
+    values = dict(conn.execute("SELECT name, value FROM watermarks "
+        "WHERE name IN ('journal_segment', 'journal_offset')"))
+    return values.get('journal_segment', 0), values.get('journal_offset', 0)
+
+
+def set_position(conn, segment, offset):
+    conn.executemany('INSERT OR REPLACE INTO watermarks (name, value) VALUES (?, ?)',
+        [('journal_segment', segment), ('journal_offset', offset)])
+
+
+class Journal(object):
+    '''
+    Segment files in a directory, numbered from 1, records are appended to
+    the last one. Thread-safe.
+    '''
+
+    def __init__(self, directory='journal', segment_size=100000, fsync='interval',
+            fsync_interval=1.0):
+        if fsync not in fsync_policies:
+            raise ValueError('fsync must be one of %s' % ', '.join(fsync_policies))
+        self.directory = directory
+        self.segment_size = segment_size
+        self.fsync = fsync
+        self.fsync_interval = fsync_interval
+        self.lock = threading.Lock()
+        self.file = None
+        # number of the segment appended to and its number of records
+        self.current = None
+        self.count = 0
+        self.synced = 0.0
+        # records appended since the last sync
+        self.pending = 0
+
+        # statistics
+        self.records = 0
+        self.fsyncs = 0
+
+    def filename(self, segment):
+        return os.path.join(self.directory, 'segment-%012d.journal' % segment)
+
+    def segments(self):
+        'Return the numbers of all segments, sorted.'
+
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted(int(name[8:-8]) for name in names
+            if name.startswith('segment-') and name.endswith('.journal'))
+
+    def open(self, after=0):
+        'Start a new segment to append to, numbered after all others (and after).'
+
+        os.makedirs(self.directory, exist_ok=True)
+        with self.lock:
+            self.start_segment(max(self.segments() + [after]) + 1)
+
+    def start_segment(self, segment):
+        self.file = open(self.filename(segment), 'ab', buffering=0)
+        self.current, self.count = segment, 0
+        if self.fsync != 'never':
+            # make the new file itself durable
+            fd = os.open(self.directory, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def append(self, rows):
+        '''
+        Append rows to the current segment, starting a new one if it is full.
+        '''
+
+        data = memoryview(encode(rows))
+        with self.lock:
+            if self.file is None:
+                raise RuntimeError('journal is not open')
+            if self.count and self.count + len(rows) > self.segment_size:
+                self.sync()
+                self.file.close()
+                self.start_segment(self.current + 1)
+            # unbuffered, usually written with one system call
+            while data:
+                data = data[self.file.write(data):]
+            self.count += len(rows)
+            self.records += len(rows)
+            self.pending += len(rows)
+            if self.fsync == 'always' or (self.fsync == 'interval'
+                    and time.time() - self.synced >= self.fsync_interval):
+                self.sync()
+
+    def sync(self):
+        'Flush the current segment to disk, unless the policy is never.'
+
+        if self.fsync != 'never':
+            os.fsync(self.file.fileno())
+            self.synced = time.time()
+            self.fsyncs += 1
+        self.pending = 0
+
+    def flush(self):
+        '''
+        Sync the records appended since the last sync, if fsync_interval has
+        passed (with the interval policy). Returns the number of seconds
+        until it has, or None if there is nothing to sync.
+        '''
+
+        with self.lock:
+            if not self.pending or self.fsync != 'interval' or self.file is None:
+                return None
+            due = self.synced + self.fsync_interval - time.time()
+            if due > 0:
+                return due
+            self.sync()
+            return None
+
+    def read(self, segment, offset, limit):
+        '''
+        Return the rows of up to limit valid records of a segment, starting
+        with record number offset, or an empty list if it does not exist.
+        '''
+
+        try:
+            with open(self.filename(segment), 'rb') as f:
+                f.seek(offset * record_size)
+                data = f.read(limit * record_size)
+        except FileNotFoundError:
+            return []
+        return decode(data)
+
+    def size(self, segment):
+        'Return the number of complete records of a segment, 0 if it does not exist.'
+
+        try:
+            return os.path.getsize(self.filename(segment)) // record_size
+        except FileNotFoundError:
+            return 0
+
+    def next_segment(self, segment):
+        'Return the number of the first segment after a given one.'
+
+        return min([s for s in self.segments() if s > segment] + [self.current])
+
+    def delete(self, segment):
+        try:
+            os.remove(self.filename(segment))
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.sync()
+                self.file.close()
+                self.file = None
+
+
+class JournaledBuffer(IngestBuffer):
+    '''
+    Ingest buffer appending rows to a journal, whose writer thread applies
+    the journal to the database, see the module documentation.
+
+    Rows put into the buffer are appended to the journal right away. The
+    writer thread applies them when batch_size rows are waiting or the
+    oldest has waited for max_latency, together with all others waiting,
+    up to load_size rows per transaction. It is started with the first row,
+    or by servers when they start, to replay the journal.
+    '''
+
+    # appending to the journal may wait for the disk
+    blocking = True
+
+    def __init__(self, path, journal, load_size=50000, **kwargs):
+        super().__init__(path, **kwargs)
+        self.journal = journal
+        self.load_size = load_size
+        self.position = None
+        # rows appended since the writer thread last woke up
+        self.waiting = 0
+        self.damaged = 0
+
+    def start(self):
+        'Start a new journal segment and the writer thread.'
+
+        with self.cond:
+            if self.thread is not None:
+                return
+            conn = self.connect(self.path)
+            try:
+                self.position = get_position(conn)
+            finally:
+                conn.close()
+            # left over when the service stopped after applying them
+            for segment in self.journal.segments():
+                if segment < self.position[0]:
+                    self.journal.delete(segment)
+            self.journal.open(after=self.position[0])
+            super().start()
+
+    def put_many(self, rows):
+        '''
+        Append several rows to the journal.
+
+        All rows given in one call end up in the same transaction.
+        '''
+
+        with self.cond:
+            if self.closed:
+                raise RuntimeError('ingest buffer is closed')
+            if self.thread is None:
+                self.start()
+        self.journal.append(rows)
+        with self.cond:
+            first = not self.waiting
+            if first:
+                self.oldest = time.time()
+            self.waiting += len(rows)
+            self.rows_put += len(rows)
+            if first or self.waiting >= self.batch_size:
+                self.cond.notify()
+
+    def wait(self, timeout=None):
+        '''
+        Wait until the rows appended are due to be applied, or closed, or
+        for at most timeout seconds.
+        '''
+
+        end = time.time() + timeout if timeout is not None else None
+        with self.cond:
+            while not self.closed:
+                if self.waiting >= self.batch_size:
+                    break
+                if self.waiting:
+                    timeout = self.oldest + self.max_latency - time.time()
+                    if timeout <= 0:
+                        break
+                else:
+                    timeout = None
+                if end is not None:
+                    left = end - time.time()
+                    if left <= 0:
+                        break
+                    timeout = left if timeout is None else min(timeout, left)
+                self.cond.wait(timeout)
+            self.waiting = 0
+
+    def run(self):
+        'Main loop of the writer thread, which first applies left over segments.'
+
+        self.conn = self.connect(self.path)
+        while True:
+            with self.cond:
+                closed = self.closed
+            try:
+                loaded = self.load()
+            except Exception:
+                traceback.print_exc()
+                loaded = False
+            if closed:
+                break
+            if loaded:
+                # wakes up to sync the end of a burst, see Journal.flush()
+                self.wait(self.journal.flush())
+            else:
+                # retried later, the rows stay in the journal
+                time.sleep(self.max_latency)
+
+    def load(self):
+        '''
+        Apply all valid records after the position, and delete the segments
+        done. Returns False if the database is not available.
+        '''
+
+        while True:
+            segment, offset = self.position
+            # a segment is complete when a later one was started
+            complete = segment < self.journal.current
+            rows = self.journal.read(segment, offset, self.load_size)
+            if rows and self.store(rows):
+                return False
+            if len(rows) < self.load_size:
+                if not complete:
+                    return True
+                offset = self.position[1]
+                size = self.journal.size(segment)
+                if offset < size:
+                    self.damaged += size - offset
+                    print('Skipped %d damaged records of journal segment %d' % (
+                        size - offset, segment))
+                self.journal.delete(segment)
+                self.position = self.journal.next_segment(segment), 0
+
+    def insert(self, records):
+        'Insert records and store the position after them, in the same transaction.'
+
+        super().insert(records)
+        segment, offset = self.position
+        set_position(self.conn, segment, offset + len(records))
+
+    def advance(self, num_rows):
+        segment, offset = self.position
+        self.position = segment, offset + num_rows
+
+    def write(self, rows):
+        'Write rows like IngestBuffer, and move the position after them if done.'
+
+        error = super().write(rows)
+        if error is None:
+            self.advance(len(rows))
+        return error
+
+    def reject(self, rows, error):
+        'Skip records that cannot be stored (again if replayed after a crash).'
+
+        super().reject(rows, error)
+        self.advance(len(rows))
+
+    def close(self):
+        '''
+        Apply all rows appended and stop the writer thread. The segment
+        appended to last is deleted if it was applied completely.
+        '''
+
+        super().close()
+        current, count = self.journal.current, self.journal.count
+        self.journal.close()
+        if current is not None and self.position == (current, count):
+            self.journal.delete(current)
+
+    def stats(self):
+        'Return a dict with flush statistics and the state of the journal.'
+
+        result = super().stats()
+        segment, offset = self.position or (0, 0)
+        # rows appended but not applied yet
+        depth = sum(self.journal.size(s) for s in self.journal.segments() if s >= segment)
+        result.update(
+            queue_depth=max(depth - offset, 0),
+            journal_segments=len(self.journal.segments()),
+            journal_segment=segment,
+            journal_offset=offset,
+            journal_records=self.journal.records,
+            journal_fsyncs=self.journal.fsyncs,
+            journal_damaged=self.damaged,
+        )
+        return result
@@ -0,0 +1,270 @@
+"""
+Live feed of accepted emissions, pushed to subscribers as server-sent events.
+
+The broadcaster is a pipeline observer, which only appends accepted rows
+to a list, so ingest is not slowed down by subscribers. A background
+thread takes these rows every interval (a tick), keeps only the latest
+row per vehicle, serializes every row once into JSON and sends every
+subscriber one message with the rows matching its filter. Subscribers
+with the same filter share the same encoded message.
+
+Each subscriber has a bounded buffer of messages. If a client cannot keep
+up and its buffer is full, the buffered messages are dropped and replaced
+by a snapshot of the latest positions matching its filter, which the
+client receives next (the same as right after connecting).
+
+Settings are read from the LIVE section of ``config.ini``.
+"""
+
+import json
+import time
+import threading
+import collections
+
+import numpy as np
+
+from app import config, pipeline, positions
+from app.ingest import allowed_types, fields
+from app.positions import parse_bbox
+
+
+tick = config.getfloat('LIVE', 'interval', fallback=0.25)
+buffer_size = config.getint('LIVE', 'buffer', fallback=16)
+keepalive = config.getfloat('LIVE', 'keepalive', fallback=15)
+max_subscribers = config.getint('LIVE', 'max_subscribers', fallback=500)
+
+
+def event(name, data):
+    'Return a server-sent event with JSON data (already serialized).'
+
+    return ('event: %s\ndata: %s\n\n' % (name, data)).encode()
+
+
+class Filter(object):
+    '''
+    Filter of a subscriber by vehicle types, uids and bounding box.
+
+    All of them are optional. Filters with the same values are equal, so
+    subscribers can share messages.
+    '''
+
+    __slots__ = ('types', 'uids', 'bbox')
+
+    def __init__(self, types=None, uids=None, bbox=None):
+        self.types = frozenset(types) if types else None
+        self.uids = frozenset(uids) if uids else None
+        self.bbox = tuple(bbox) if bbox else None
+
+    def key(self):
+        return (self.types, self.uids, self.bbox)
+
+    def __eq__(self, other):
+        return self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def mask(self, uids, index, types, lon, lat):
+        '''
+        Return a boolean array telling which rows of a tick match.
+
+        The rows are given as a list of uids, a dict mapping uids to their
+        index, and arrays of type codes and positions.
+        '''
+
+        mask = np.ones(len(uids), dtype=bool)
+        if self.types is not None:
+            mask &= np.isin(types, [allowed_types.index(t) for t in self.types])
+        if self.bbox is not None:
+            min_lon, min_lat, max_lon, max_lat = self.bbox
+            mask &= (min_lon <= lon) & (lon <= max_lon) & (min_lat <= lat) & (lat <= max_lat)
+        if self.uids is not None:
+            selected = np.zeros(len(uids), dtype=bool)
+            selected[[index[uid] for uid in self.uids if uid in index]] = True
+            mask &= selected
+        return mask
+
+    def snapshot(self):
+        'Return the latest positions matching the filter as JSON.'
+
+        typ = next(iter(self.types)) if self.types and len(self.types) == 1 else None
+        vehicles = positions.snapshot(typ, self.bbox)
+        if self.types is not None and typ is None:
+            vehicles = [v for v in vehicles if v['type'] in self.types]
+        if self.uids is not None:
+            vehicles = [v for v in vehicles if v['uid'] in self.uids]
+        return json.dumps(vehicles)
+
+
+class Subscriber(object):
+    '''
+    Client of the live feed, with a bounded buffer of encoded messages.
+
+    The broadcaster puts messages into the buffer and calls notify, which
+    by default wakes up a thread waiting in wait(). Async servers pass a
+    notify function waking up their task instead.
+    '''
+
+    def __init__(self, filter, max_messages=None, notify=None):
+        self.filter = filter
+        self.max_messages = max_messages or buffer_size
+        self.messages = collections.deque()
+        self.lock = threading.Lock()
+        self.event = threading.Event()
+        self.notify = notify or self.event.set
+        # a snapshot is sent first
+        self.resync = True
+        self.dropped = 0
+
+    def put(self, message):
+        with self.lock:
+            if len(self.messages) >= self.max_messages:
+                # too slow, send the latest positions instead
+                self.dropped += len(self.messages)
+                self.messages.clear()
+                self.resync = True
+            else:
+                self.messages.append(message)
+        self.notify()
+
+    def take(self):
+        '''
+        Return all messages buffered, starting with a snapshot if needed.
+        '''
+
+        with self.lock:
+            messages, self.messages = list(self.messages), collections.deque()
+            resync, self.resync = self.resync, False
+            self.event.clear()
+        if resync:
+            messages.insert(0, event('snapshot', self.filter.snapshot()))
+        return messages
+
+    def wait(self, timeout=None):
+        'Wait for messages, return them (an empty list after the timeout).'
+
+        if not self.resync and not self.messages:
+            self.event.wait(timeout)
+        return self.take()
+
+
+class Broadcaster(object):
+    '''
+    Fan-out of accepted emissions to all subscribers of the live feed.
+
+    The thread sending messages is started with the first subscriber, and
+    rows are only collected while there are subscribers.
+    '''
+
+    def __init__(self, interval=None):
+        self.interval = interval or tick
+        self.subscribers = set()
+        self.rows = []
+        self.lock = threading.Lock()
+        self.thread = None
+
+        # statistics
+        self.ticks = 0
+        self.rows_sent = 0
+        self.messages_encoded = 0
+
+    def publish(self, rows):
+        'Collect accepted rows for the next tick (a pipeline observer).'
+
+        if self.subscribers:
+            with self.lock:
+                self.rows.extend(rows)
+
+    def subscribe(self, subscriber):
+        '''
+        Add a subscriber, raise RuntimeError if there are too many.
+        '''
+
+        with self.lock:
+            if len(self.subscribers) >= max_subscribers:
+                raise RuntimeError('too many subscribers')
+            self.subscribers.add(subscriber)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='live-feed')
+                self.thread.daemon = True
+                self.thread.start()
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+
+    def run(self):
+        'Main loop of the broadcasting thread.'
+
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                rows, self.rows = self.rows, []
+                subscribers = list(self.subscribers)
+            if rows and subscribers:
+                self.broadcast(rows, subscribers)
+
+    def broadcast(self, rows, subscribers):
+        'Send the rows of one tick to all subscribers matching them.'
+
+        # only the latest row of every vehicle
+        latest = {}
+        for row in rows:
+            prev = latest.get(row[0])
+            if prev is None or row[2] >= prev[2]:
+                latest[row[0]] = row
+        rows = list(latest.values())
+        uids = [r[0] for r in rows]
+        index = dict((uid, i) for i, uid in enumerate(uids))
+        types = np.array([allowed_types.index(r[1]) for r in rows], dtype=np.int8)
+        lon = np.array([r[3] for r in rows])
+        lat = np.array([r[4] for r in rows])
+        encoded = [json.dumps(dict(zip(fields, r))) for r in rows]
+
+        messages = {}
+        for subscriber in subscribers:
+            f = subscriber.filter
+            if f not in messages:
+                selected = np.flatnonzero(f.mask(uids, index, types, lon, lat)).tolist()
+                messages[f] = event('positions',
+                    '[%s]' % ','.join(encoded[i] for i in selected)) if selected else None
+                self.messages_encoded += 1
+            if messages[f] is not None:
+                subscriber.put(messages[f])
+        self.ticks += 1
+        self.rows_sent += len(rows)
+
+    def stats(self):
+        'Return a dict with live feed statistics.'
+
+        with self.lock:
+            subscribers = list(self.subscribers)
+        return dict(
+            live_subscribers=len(subscribers),
+            live_ticks=self.ticks,
+            live_rows_sent=self.rows_sent,
+            live_messages_encoded=self.messages_encoded,
+            live_messages_dropped=sum(s.dropped for s in subscribers),
+        )
+
+
+broadcaster = Broadcaster()
+pipeline.observers.append(broadcaster.publish)
+
+
+def parse_filter(args):
+    '''
+    Return the filter given in request arguments.
+
+    Supported arguments are type and uid, both comma separated lists, and
+    bbox=min_lon,min_lat,max_lon,max_lat. Raises ValueError for invalid
+    arguments.
+    '''
+
+    types = [t for t in args.get('type', '').split(',') if t]
+    for typ in types:
+        if typ not in allowed_types:
+            raise ValueError("'%s' is an invalid vehicle type." % typ)
+    uids = [u for u in args.get('uid', '').split(',') if u]
+    box = args.get('bbox', None)
+    return Filter(types, uids, parse_bbox(box) if box else None)
@@ -0,0 +1,47 @@
+"""
+Optional blueprint with the live feed of emissions, see app/live.py.
+"""
+
+from flask import Blueprint, Response, request, abort
+
+from app import live
+
+
+blueprint = Blueprint('live', __name__)
+
+
+@blueprint.route('/live')
+def get_live():
+    '''
+    Stream the positions of vehicles as server-sent events.
+
+    The first event, "snapshot", contains the latest positions of all
+    vehicles matching the filter, then every "positions" event the new
+    positions received since the last one, both as JSON arrays. Vehicles
+    can be filtered by comma separated types and uids and by a bounding
+    box.
+
+    Test using curl like this:
+
+    curl -N "http://localhost:5000/live?type=bus,tram&bbox=13.3,52.5,13.4,52.55"
+    '''
+
+    try:
+        subscriber = live.Subscriber(live.parse_filter(request.args))
+        live.broadcaster.subscribe(subscriber)
+    except ValueError as e:
+        abort(404, str(e))
+    except RuntimeError as e:
+        abort(503, str(e))
+
+    def generate():
+        try:
+            while True:
+                messages = subscriber.wait(live.keepalive)
+                # a comment keeps the connection open and detects closed ones
+                yield b''.join(messages) or b': keepalive\n\n'
+        finally:
+            live.broadcaster.unsubscribe(subscriber)
+
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(generate(), mimetype='text/event-stream', headers=headers)
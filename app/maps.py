@@ -1,68 +1,65 @@
 """
 Maps to show locations of vehicles.
+
+Maps are rendered by the render module, either in a background thread or,
+if configured with processes in the MAPS section of config.ini, in a pool
+of worker processes, so rendering never holds up request handling in the
+service process. Rendered maps are kept in an LRU cache for some time.
+The render module, and with it matplotlib, is imported only when the first
+map is rendered.
 """
 
-import os
-import time
+import multiprocessing
+import concurrent.futures
+
+import numpy as np
+
+from app import config
+from app.cache import LRUCache
+
+
+processes = config.getint('MAPS', 'processes', fallback=0)
+cache = LRUCache(
+    max_size=config.getint('MAPS', 'cache_size', fallback=32),
+    ttl=config.getfloat('MAPS', 'cache_ttl', fallback=60))
+
+executor = None
+
+
+def get_executor():
+    'Return the executor used for rendering, created when first needed.'
 
-import matplotlib
-import pandas as pd
+    global executor
+    if executor is None:
+        if processes > 0:
+            # spawned workers only import the render module, not the service
+            executor = concurrent.futures.ProcessPoolExecutor(processes,
+                mp_context=multiprocessing.get_context('spawn'))
+        else:
+            executor = concurrent.futures.ThreadPoolExecutor(1)
+    return executor
 
-from utils import bbox
 
+def submit(name, lons=(), lats=()):
+    'Render a map in the background, return a future for its PNG data.'
 
-# Force matplotlib to not use any Xwindows backend.
-matplotlib.use('Agg')
+    # matplotlib is only loaded when the first map is rendered
+    import render
+
+    return get_executor().submit(render.render_map, name, lons, lats)
+
+
+def positions(data):
+    'Split (lon, lat) pairs into arrays of longitudes and lattitudes.'
+
+    data = np.asarray(data, dtype=float).reshape(-1, 2)
+    return data[:, 0], data[:, 1]
 
 
 def make_map_traffic(data):
-    import json
-    import matplotlib.pyplot as plt
-    import matplotlib as mpl
-    from mpl_toolkits.basemap import Basemap
-
-    mpl.use('Agg')
-
-    # load points from geojson file
-    path = os.path.join(os.getcwd(), 'geo/stops_berlin.geojson')
-    js = json.load(open(path))
-    lonlats = [f['geometry']['coordinates'] for f in js['features']]
-
-    # compute bounding box (ll, ur)
-    class Point(object):
-        def __init__(self, **kwargs):
-            for k in kwargs:
-                setattr(self, k, kwargs[k])
-    p = lonlats[0]
-    ll = Point(lon=p[0], lat=p[1])
-    ur = Point(lon=p[0], lat=p[1])
-    for (lon, lat) in lonlats:
-        ll.lon = lon if lon < ll.lon else ll.lon
-        ll.lat = lat if lat < ll.lat else ll.lat
-        ur.lon = lon if lon > ur.lon else ur.lon
-        ur.lat = lat if lat > ur.lat else ur.lat
-
-    # create map
-    plt.figure(num=1, figsize=(25, 10))
-    map = Basemap(projection='mill', resolution='c', \
-        llcrnrlat=ll.lat, urcrnrlat=ur.lat, \
-        llcrnrlon=ll.lon, urcrnrlon=ur.lon \
-        # llcrnrlat=ll.lat-1, urcrnrlat=ur.lat+1, \
-        # llcrnrlon=ll.lon-1, urcrnrlon=ur.lon+1 \
-    )
-    map.drawmapboundary(fill_color='#aaddff')
-    map.fillcontinents(color='#dddddd', lake_color='#aaddff')
-    map.drawcountries()
-    map.drawcoastlines()
-    map.readshapefile('geo/berlin/roads', 'berlin')
-
-    for (lat, lon) in data:
-        map.plot(lat, lon, 'ro', markersize=10, latlon=True)
-
-    lat, lon = 13.383333, 52.516667
-    map.plot(lat, lon, 'bo', markersize=20, latlon=True)
-
-    return plt
+    'Return a Berlin map with vehicles at (lon, lat) positions as PNG data.'
+
+    return submit('traffic', *positions(data)).result()
 
 
 # additional, undocumented maps
@@ -72,55 +69,10 @@ def make_map_world():
     Show a simple world map.
     '''
 
-    from mpl_toolkits.basemap import Basemap
-    import matplotlib as mpl
-    import matplotlib.pyplot as plt
-
-    mpl.use('Agg')
-    map = Basemap()
-    map.drawcoastlines()
-    return plt
+    return submit('world').result()
 
 
 def make_map_berlin_bvg():
-    import json
-    import matplotlib.pyplot as plt
-    import matplotlib as mpl
-    from mpl_toolkits.basemap import Basemap
-
-    mpl.use('Agg')
-
-    # load points from geojson file
-    path = os.path.join(os.getcwd(), 'geo/stops_berlin.geojson')
-    js = json.load(open(path))
-    lonlats = [f['geometry']['coordinates'] for f in js['features']]
-
-    # compute bounding box (ll, ur)
-    class Point(object):
-        def __init__(self, **kwargs):
-            for k in kwargs:
-                setattr(self, k, kwargs[k])
-    p = lonlats[0]
-    ll = Point(lon=p[0], lat=p[1])
-    ur = Point(lon=p[0], lat=p[1])
-    for (lon, lat) in lonlats:
-        ll.lon = lon if lon < ll.lon else ll.lon
-        ll.lat = lat if lat < ll.lat else ll.lat
-        ur.lon = lon if lon > ur.lon else ur.lon
-        ur.lat = lat if lat > ur.lat else ur.lat
-
-    # create map
-    plt.figure(num=1, figsize=(25, 10))
-    map = Basemap(projection='mill', resolution='c', \
-        llcrnrlat=ll.lat, urcrnrlat=ur.lat, \
-        llcrnrlon=ll.lon, urcrnrlon=ur.lon \
-    )
-    map.drawmapboundary(fill_color='#aaddff')
-    map.fillcontinents(color='#dddddd', lake_color='#aaddff')
-    map.drawcountries()
-    map.drawcoastlines()
-    map.readshapefile('geo/berlin/roads', 'berlin')
-    for (lon, lat) in lonlats:
-        map.plot(lon, lat, 'ro', markersize=3, latlon=True)
-
-    return plt
+    'Return a Berlin map with all BVG stops as PNG data.'
+
+    return submit('berlin_bvg').result()
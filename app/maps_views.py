@@ -0,0 +1,66 @@
+"""
+Optional blueprint with the maps.
+"""
+
+from flask import Blueprint, Response, request
+
+from app import maps, readers
+from app.queries import build_where_clause, vehicle_id, last_row_id
+
+
+blueprint = Blueprint('maps', __name__)
+
+
+@blueprint.route('/map/traffic')
+def get_map_traffic():
+    '''
+    Show a map with all locations of all (or only one) vehicles in Snowdonia.
+
+    You can map only one vehicle by adding ?uid=<UID> as query parameter.
+    Maps are cached until new data is written or they expire.
+    '''
+
+    uid = request.args.get('uid', None) or None
+    key = ('traffic', uid, last_row_id())
+    png = maps.cache.get(key)
+    if png is None:
+        cmd = "SELECT longitude, lattitude FROM traffic "
+        where_clause, params = build_where_clause([('vehicle', '=', vehicle_id(uid))])
+        cmd += where_clause
+        with readers.connection() as conn:
+            data = conn.execute(cmd, params).fetchall()
+        png = maps.make_map_traffic(data)
+        maps.cache.put(key, png)
+    return Response(png, mimetype='image/png')
+
+
+def static_map(name, make_map):
+    'Return PNG data of a map without vehicles, from the cache if possible.'
+
+    png = maps.cache.get(name)
+    if png is None:
+        png = make_map()
+        maps.cache.put(name, png)
+    return png
+
+
+# additional, undocumented maps
+
+@blueprint.route('/map/world', methods=['GET'])
+def get_map_world():
+    '''
+    Show a world map.
+    '''
+
+    png = static_map('world', maps.make_map_world)
+    return Response(png, mimetype='image/png')
+
+
+@blueprint.route('/map/berlin/bvg')
+def get_map_berlin_bvg():
+    '''
+    Show a Berlin map with BVG stops.
+    '''
+
+    png = static_map('berlin_bvg', maps.make_map_berlin_bvg)
+    return Response(png, mimetype='image/png')
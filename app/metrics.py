@@ -0,0 +1,308 @@
+"""
+Instrumentation of the service, served on /metrics in the Prometheus text
+format (see https://prometheus.io/docs/instrumenting/exposition_formats/).
+
+Recorded are the number of requests per endpoint and status code, the
+number of errors (status 400 or more) and a latency histogram per endpoint,
+and histograms of the phases of ingesting emissions:
+
+    ========  ======================================================
+    parse     reading the form data of POST /data
+    validate  checking the values with parse_emission()
+    submit    running the pipeline filters and buffering the row
+    lock      waiting for the database write lock (per batch)
+    execute   inserting the rows of a batch
+    hooks     updating the trip aggregates and rollups of a batch
+    commit    committing the transaction of a batch
+    ========  ======================================================
+
+Recording a value only finds the counter or histogram bucket in a dict and
+increments it, the text is rendered when the metrics are scraped. Gauges
+are computed at that time by functions. To keep this cheap, increments are
+not locked: a thread switch in the middle of one can lose it, which is
+rare enough for metrics.
+"""
+
+import time
+import bisect
+import threading
+import collections
+
+
+# upper bounds of latency histogram buckets in seconds
+latency_buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025,
+    0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# seconds over which the rows written per second are averaged
+rate_window = 10.0
+
+content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_labels(labels):
+    'Return label names and values as {name="value",...}, or nothing.'
+
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', r'\\')
+        .replace('"', r'\"').replace('\n', r'\n')) for name, value in labels)
+
+
+class Counter(object):
+    'Counter of one combination of label values.'
+
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, labels):
+        yield name, labels, self.value
+
+    def state(self):
+        return self.value
+
+    def restore(self, state):
+        self.value = state
+
+
+class Histogram(object):
+    '''
+    Histogram of one combination of label values.
+
+    Values are counted in the first bucket with an upper bound not below
+    them, or in the last bucket (+Inf), and summed up.
+    '''
+
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds=latency_buckets):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def samples(self, name, labels):
+        counts, total = list(self.counts), self.sum
+        cumulative = 0
+        for bound, count in zip(self.bounds + (float('inf'),), counts):
+            cumulative += count
+            yield name + '_bucket', labels + [('le', format_value(bound))], cumulative
+        yield name + '_sum', labels, total
+        yield name + '_count', labels, cumulative
+
+    def state(self):
+        return list(self.counts), self.sum
+
+    def restore(self, state):
+        counts, self.sum = state
+        self.counts = list(counts)
+
+
+class Metric(object):
+    '''
+    Named counter or histogram with one child for every combination of
+    label values, created with the first value recorded.
+    '''
+
+    def __init__(self, name, help, kind, label_names=(), factory=Counter):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.label_names = tuple(label_names)
+        self.factory = factory
+        self.children = {}
+        self.lock = threading.Lock()
+
+    def labels(self, *values):
+        'Return the counter or histogram of the given label values.'
+
+        child = self.children.get(values)
+        if child is None:
+            with self.lock:
+                child = self.children.setdefault(values, self.factory())
+        return child
+
+    def render(self, lines):
+        lines.append('# HELP %s %s' % (self.name, self.help))
+        lines.append('# TYPE %s %s' % (self.name, self.kind))
+        with self.lock:
+            children = sorted(self.children.items(), key=lambda item: str(item[0]))
+        for values, child in children:
+            labels = list(zip(self.label_names, values))
+            for name, labels, value in child.samples(self.name, labels):
+                lines.append('%s%s %s' % (name, format_labels(labels), format_value(value)))
+
+
+class Gauge(object):
+    '''
+    Value computed when scraped by a function, which returns a number (or
+    None if unknown), or a dict of numbers by tuples of label values.
+    '''
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, func, label_names=()):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.label_names = tuple(label_names)
+
+    def render(self, lines):
+        value = self.func()
+        values = value if isinstance(value, dict) else {(): value}
+        lines.append('# HELP %s %s' % (self.name, self.help))
+        lines.append('# TYPE %s gauge' % self.name)
+        for key, value in sorted(values.items()):
+            if value is not None:
+                labels = list(zip(self.label_names, key))
+                lines.append('%s%s %s' % (self.name, format_labels(labels), format_value(value)))
+
+
+class Registry(object):
+    'Collection of all metrics, rendered together.'
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, label_names=()):
+        return self.add(Metric(name, help, 'counter', label_names, Counter))
+
+    def histogram(self, name, help, label_names=(), buckets=latency_buckets):
+        return self.add(Metric(name, help, 'histogram', label_names,
+            lambda: Histogram(buckets)))
+
+    def gauge(self, name, help, func, label_names=()):
+        return self.add(Gauge(name, help, func, label_names))
+
+    def snapshot(self, names):
+        '''
+        Return the values of the named counters and histograms as a dict,
+        to be restored in another process with restore().
+        '''
+
+        result = {}
+        for metric in self.metrics:
+            if metric.name in names:
+                with metric.lock:
+                    children = list(metric.children.items())
+                result[metric.name] = [(values, child.state()) for values, child in children]
+        return result
+
+    def restore(self, snapshot):
+        'Replace the values of the metrics in a snapshot by its values.'
+
+        for metric in self.metrics:
+            for values, state in snapshot.get(metric.name, ()):
+                metric.labels(*values).restore(state)
+
+    def render(self):
+        'Return all metrics in the Prometheus text format.'
+
+        lines = []
+        for metric in self.metrics:
+            metric.render(lines)
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+requests = registry.counter('http_requests_total',
+    'Number of HTTP requests by endpoint and status code.', ['endpoint', 'status'])
+errors = registry.counter('http_request_errors_total',
+    'Number of HTTP requests answered with a status of 400 or more by endpoint.', ['endpoint'])
+latency = registry.histogram('http_request_duration_seconds',
+    'Time until the response of HTTP requests started by endpoint.', ['endpoint'])
+phases = registry.histogram('ingest_phase_seconds',
+    'Duration of the phases of ingesting emissions.', ['phase'])
+rows_written = registry.counter('ingest_rows_written_total',
+    'Number of rows written into the database.')
+udp_errors = registry.counter('udp_errors_total',
+    'Number of batches of UDP datagrams which failed to be handled.')
+
+# metrics recorded by the writer process of serve_multi.py, which are sent
+# to the workers serving /metrics, see writer_snapshot()
+writer_metrics = ('ingest_phase_seconds', 'ingest_rows_written_total', 'udp_errors_total')
+
+# batches written in the last rate window, as tuples of time and rows
+recent = collections.deque()
+
+# rows per second of the writer process, in the workers of serve_multi.py
+writer_rate = None
+
+
+def rows_per_second():
+    if writer_rate is not None:
+        return writer_rate
+    since = time.time() - rate_window
+    return sum(num for t, num in list(recent) if t >= since) / rate_window
+
+
+registry.gauge('ingest_rows_per_second',
+    'Rows written into the database per second, averaged over %g seconds.' % rate_window,
+    rows_per_second)
+
+
+def observe_request(endpoint, status, seconds):
+    'Record a request answered with a status code after some seconds.'
+
+    requests.labels(endpoint, status).inc()
+    latency.labels(endpoint).observe(seconds)
+    if status >= 400:
+        errors.labels(endpoint).inc()
+
+
+def observe_phases(**durations):
+    'Record the durations of ingest phases in seconds, given by phase name.'
+
+    for phase, seconds in durations.items():
+        phases.labels(phase).observe(seconds)
+
+
+def observe_write(durations, num_rows):
+    '''
+    Record the phase durations of a batch written, used as ingest timer.
+    '''
+
+    observe_phases(**durations)
+    rows_written.labels().inc(num_rows)
+    now = time.time()
+    recent.append((now, num_rows))
+    while recent[0][0] < now - rate_window:
+        recent.popleft()
+
+
+def writer_snapshot():
+    '''
+    Return the metrics of writing rows recorded in this process, to be sent
+    by the writer process of serve_multi.py to its workers.
+    '''
+
+    return dict(metrics=registry.snapshot(writer_metrics), rows_per_second=rows_per_second())
+
+
+def restore_writer(snapshot):
+    '''
+    Export the metrics of the writer process sent by writer_snapshot() from
+    a worker, which writes no rows itself.
+    '''
+
+    global writer_rate
+    registry.restore(snapshot['metrics'])
+    writer_rate = snapshot['rows_per_second']
@@ -0,0 +1,134 @@
+"""
+In-memory index of the latest known position of every vehicle.
+"""
+
+import math
+import array
+import threading
+
+import numpy as np
+
+import vehicles
+from app.ingest import allowed_types
+
+
+class LatestPositions(object):
+    '''
+    Latest state of every vehicle, kept in compact arrays indexed by uid.
+
+    Each vehicle gets a slot when it is seen for the first time, and its
+    state is stored in typed arrays (one per column), which needs a few
+    dozen bytes per vehicle. It is updated with every accepted emission
+    that is newer than the one stored.
+    '''
+
+    __slots__ = ('lock', 'slots', 'uids', 'types', 'ts', 'lon', 'lat', 'heading')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.slots = {}
+        self.uids = []
+        self.types = array.array('b')
+        self.ts = array.array('d')
+        self.lon = array.array('d')
+        self.lat = array.array('d')
+        self.heading = array.array('d')
+
+    def __len__(self):
+        return len(self.uids)
+
+    def update(self, rows):
+        'Update the index with rows like returned by parse_emission().'
+
+        with self.lock:
+            for (uid, typ, ts, lon, lat, heading) in rows:
+                i = self.slots.get(uid)
+                if i is None:
+                    self.slots[uid] = len(self.uids)
+                    self.uids.append(uid)
+                    self.types.append(allowed_types.index(typ))
+                    self.ts.append(ts)
+                    self.lon.append(lon)
+                    self.lat.append(lat)
+                    self.heading.append(heading)
+                elif ts >= self.ts[i]:
+                    self.types[i] = allowed_types.index(typ)
+                    self.ts[i] = ts
+                    self.lon[i] = lon
+                    self.lat[i] = lat
+                    self.heading[i] = heading
+
+    def load(self, conn):
+        'Fill the index with the latest row of every vehicle in the database.'
+
+        # SQLite returns the other columns from the row with the maximum
+        cmd = '''SELECT vehicle, type, max(timestamp) / 1000.0,
+                        longitude, lattitude, heading
+                 FROM traffic GROUP BY vehicle'''
+        cursor = conn.execute(cmd)
+        while True:
+            rows = cursor.fetchmany(5000)
+            if not rows:
+                break
+            self.update([r for r in vehicles.decode(conn, rows) if r[1] in allowed_types])
+
+    def snapshot(self, typ=None, bbox=None):
+        '''
+        Return the latest state of all vehicles as a list of dicts.
+
+        Optionally, only vehicles of a given type and/or inside a bounding
+        box, given as (min_lon, min_lat, max_lon, max_lat), are returned.
+        '''
+
+        with self.lock:
+            uids = list(self.uids)
+            types = np.array(self.types, dtype=np.int8)
+            ts = np.array(self.ts)
+            lon = np.array(self.lon)
+            lat = np.array(self.lat)
+            heading = np.array(self.heading)
+
+        mask = np.ones(len(uids), dtype=bool)
+        if typ is not None:
+            mask &= types == allowed_types.index(typ)
+        if bbox is not None:
+            min_lon, min_lat, max_lon, max_lat = bbox
+            mask &= (min_lon <= lon) & (lon <= max_lon) & (min_lat <= lat) & (lat <= max_lat)
+
+        keys = ['uid', 'type', 'timestamp', 'longitude', 'lattitude', 'heading']
+        return [dict(zip(keys, (uids[i], allowed_types[types[i]],
+                ts[i], lon[i], lat[i], heading[i])))
+            for i in np.flatnonzero(mask).tolist()]
+
+
+def parse_bbox(value):
+    '''
+    Parse a bounding box given as min_lon,min_lat,max_lon,max_lat.
+
+    Raises ValueError for invalid values.
+    '''
+
+    box = [float(x) for x in value.split(',')]
+    if len(box) != 4:
+        raise ValueError('Bounding box needs four values: %s' % value)
+    if not all(math.isfinite(x) for x in box):
+        raise ValueError('Bounding box values must be finite: %s' % value)
+    return box
+
+
+def positions_query(args):
+    '''
+    Return the vehicle type and bounding box to filter positions by.
+
+    The bounding box is given as min_lon,min_lat,max_lon,max_lat and both
+    are None if not given in the request arguments. A ValueError is raised
+    for invalid arguments.
+    '''
+
+    typ = args.get('type', None)
+    if typ is not None and typ not in allowed_types:
+        raise ValueError('Unknown vehicle type: %s' % typ)
+    box = args.get('bbox', None)
+    if box is not None:
+        box = parse_bbox(box)
+    return typ, box
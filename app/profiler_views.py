@@ -0,0 +1,83 @@
+"""
+Optional blueprint with the sampling profiler of requests, see
+app/profiling.py.
+
+These endpoints change the behaviour of the running service and show its
+source code paths, so only enable this blueprint where they cannot be
+reached from outside.
+"""
+
+import json
+
+from flask import Blueprint, Response, request, abort, g
+
+from app.profiling import profiler, parse_settings
+
+
+blueprint = Blueprint('profiler', __name__)
+
+
+@blueprint.before_app_request
+def start_profile():
+    if profiler.enabled:
+        rule = request.url_rule
+        g.profile = profiler.start(rule.rule if rule is not None else 'other')
+
+
+@blueprint.after_app_request
+def stop_profile(response):
+    profile = g.get('profile')
+    if profile is not None:
+        # streamed responses are only done when closed
+        response.call_on_close(lambda: profiler.stop(profile))
+    return response
+
+
+@blueprint.route('/profiler', methods=['GET', 'POST'])
+def profiler_settings():
+    '''
+    Return the profiler settings and the profiles kept as JSON.
+
+    With POST, the settings enabled (true or false), every (profile every
+    Nth request, 0 for none) and threshold (profile requests taking longer,
+    in seconds, 0 for none) are changed first.
+
+    Test using curl like this:
+
+    curl -X POST "http://localhost:5000/profiler" --data "enabled=true&every=10&threshold=0.5"
+    '''
+
+    if request.method == 'POST':
+        try:
+            profiler.configure(**parse_settings(request.values))
+        except ValueError as e:
+            abort(400, str(e))
+    result = dict(profiler.settings(), profiles=[p.info() for p in profiler.profiles])
+    return Response(json.dumps(result), mimetype='application/json')
+
+
+@blueprint.route('/profiler/profiles')
+def get_profiles():
+    '''
+    Return the stacks of all profiles kept, or of one endpoint, collapsed.
+
+    Examples:
+        /profiler/profiles
+        /profiler/profiles?endpoint=/data.csv
+    '''
+
+    stacks = profiler.merged(request.args.get('endpoint', None))
+    return Response(stacks, mimetype='text/plain')
+
+
+@blueprint.route('/profiler/profiles/<int:id>')
+def get_profile(id):
+    '''
+    Return the stacks of one profile collapsed, one "stack count" per line.
+    '''
+
+    try:
+        profile = profiler.get(id)
+    except KeyError:
+        abort(404, 'No profile %d.' % id)
+    return Response(profile.collapsed(), mimetype='text/plain')
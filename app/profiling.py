@@ -0,0 +1,245 @@
+"""
+Opt-in sampling profiler for requests of the running service.
+
+When enabled, every Nth request and every request taking longer than a
+threshold is profiled: while it runs, a sampler thread takes the Python
+stack of the thread handling it every interval (5 ms by default) with
+sys._current_frames(), so the request itself runs at full speed. The last
+profiles are kept in memory and returned as collapsed stacks, one line per
+distinct stack with its number of samples, which tools like flamegraph.pl
+or speedscope turn into flame graphs.
+
+With a threshold, every request is sampled, but only the profiles of slow
+ones are kept. Requests handled by an event loop (aiohttp) share their
+thread with other requests and hand work over to other threads, so for
+them all busy threads are sampled, with the thread name as root frame.
+
+The profiler is part of the optional profiler blueprint and configured in
+the PROFILER section of ``config.ini``. It can be enabled, disabled and
+reconfigured at runtime, and only checks one attribute per request while
+disabled.
+"""
+
+import os
+import sys
+import time
+import threading
+import collections
+
+from app import config
+
+
+# threads waiting with one of these files as the innermost frame are idle
+idle_files = ('threading.py', 'selectors.py', 'queue.py', os.path.join('futures', 'thread.py'))
+
+
+def short_path(path):
+    '''
+    Return a path relative to the longest entry of sys.path (or the current
+    directory) containing it.
+    '''
+
+    for prefix in sorted(filter(None, sys.path + [os.getcwd()]), key=len, reverse=True):
+        if path.startswith(prefix + os.sep):
+            return path[len(prefix) + 1:]
+    return path
+
+
+class Profile(object):
+    '''
+    Samples of the stacks of one request, counted by collapsed stack.
+    '''
+
+    def __init__(self, id, endpoint, thread=None, nth=False):
+        self.id = id
+        self.endpoint = endpoint
+        # the thread handling the request, or None for all threads
+        self.thread = thread
+        # kept no matter how long the request takes
+        self.nth = nth
+        self.time = time.time()
+        self.start = time.perf_counter()
+        self.duration = None
+        self.samples = 0
+        self.stacks = collections.Counter()
+
+    def collapsed(self):
+        'Return the stacks in the collapsed format, one "stack count" per line.'
+
+        return ''.join('%s %d\n' % item for item in sorted(self.stacks.items()))
+
+    def info(self):
+        return dict(id=self.id, endpoint=self.endpoint, time=self.time,
+            duration=self.duration, samples=self.samples)
+
+
+class Profiler(object):
+    '''
+    Sampling profiler of requests, see the module documentation.
+
+    Frameworks call start() when a request starts, if enabled, and stop()
+    with the profile returned when it is done.
+    '''
+
+    def __init__(self, enabled=False, every=100, threshold=0, interval=0.005, keep=20):
+        self.enabled = enabled
+        self.every = every
+        self.threshold = threshold
+        self.interval = interval
+        self.profiles = collections.deque(maxlen=keep)
+        self.active = {}
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = None
+        self.requests = 0
+        self.next_id = 1
+        self.labels = {}
+
+    def configure(self, enabled=None, every=None, threshold=None):
+        'Change the settings given, requests already profiled are finished.'
+
+        with self.lock:
+            if every is not None:
+                self.every = every
+            if threshold is not None:
+                self.threshold = threshold
+            if enabled is not None:
+                self.enabled = enabled
+
+    def settings(self):
+        return dict(enabled=self.enabled, every=self.every, threshold=self.threshold,
+            interval=self.interval, keep=self.profiles.maxlen)
+
+    def start(self, endpoint, all_threads=False):
+        '''
+        Start profiling a request if it is sampled, return its profile or
+        None. With all_threads, all busy threads are sampled, else the
+        current thread.
+        '''
+
+        self.requests += 1
+        nth = bool(self.every) and self.requests % self.every == 0
+        if not nth and not self.threshold:
+            return None
+        with self.lock:
+            profile = Profile(self.next_id, endpoint,
+                None if all_threads else threading.get_ident(), nth)
+            self.next_id += 1
+            self.active[profile.id] = profile
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name='profiler')
+                self.thread.daemon = True
+                self.thread.start()
+        self.wake.set()
+        return profile
+
+    def stop(self, profile):
+        '''
+        Stop profiling a request and keep its profile if it was the Nth one
+        or slow, and has samples (shorter requests may have none).
+        '''
+
+        profile.duration = time.perf_counter() - profile.start
+        with self.lock:
+            self.active.pop(profile.id, None)
+            slow = self.threshold and profile.duration >= self.threshold
+            if profile.samples and (profile.nth or slow):
+                self.profiles.append(profile)
+
+    def run(self):
+        'Main loop of the sampler thread, idle while no request is profiled.'
+
+        me = threading.get_ident()
+        while True:
+            self.wake.wait()
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            names = dict((t.ident, t.name) for t in threading.enumerate())
+            # locked, so profiles do not change after being stopped
+            with self.lock:
+                if not self.active:
+                    self.wake.clear()
+                for profile in self.active.values():
+                    self.sample(profile, frames, names, me)
+            del frames
+
+    def sample(self, profile, frames, names, me):
+        'Add the current stack of the request thread (or all busy ones) to a profile.'
+
+        if profile.thread is not None:
+            frame = frames.get(profile.thread)
+            if frame is not None:
+                profile.stacks[self.collapse(frame)] += 1
+                profile.samples += 1
+            return
+        for ident, frame in frames.items():
+            if ident != me and not frame.f_code.co_filename.endswith(idle_files):
+                profile.stacks['%s;%s' % (names.get(ident, ident), self.collapse(frame))] += 1
+        profile.samples += 1
+
+    def label(self, code):
+        'Return the name of a frame in a collapsed stack, like func (path:line).'
+
+        label = self.labels.get(code)
+        if label is None:
+            label = self.labels[code] = '%s (%s:%d)' % (code.co_name,
+                short_path(code.co_filename), code.co_firstlineno)
+        return label
+
+    def collapse(self, frame):
+        'Return the stack of a frame from the outermost one, separated by ";".'
+
+        labels = []
+        while frame is not None:
+            labels.append(self.label(frame.f_code))
+            frame = frame.f_back
+        return ';'.join(reversed(labels))
+
+    def get(self, id):
+        'Return a kept profile by id, raise KeyError if unknown.'
+
+        for profile in list(self.profiles):
+            if profile.id == id:
+                return profile
+        raise KeyError(id)
+
+    def merged(self, endpoint=None):
+        '''
+        Return the collapsed stacks of all profiles kept (of an endpoint).
+        '''
+
+        stacks = collections.Counter()
+        for profile in list(self.profiles):
+            if endpoint is None or profile.endpoint == endpoint:
+                stacks.update(profile.stacks)
+        return ''.join('%s %d\n' % item for item in sorted(stacks.items()))
+
+
+profiler = Profiler(
+    enabled=config.getboolean('PROFILER', 'enabled', fallback=False),
+    every=config.getint('PROFILER', 'every', fallback=100),
+    threshold=config.getfloat('PROFILER', 'threshold', fallback=0),
+    interval=config.getfloat('PROFILER', 'interval', fallback=0.005),
+    keep=config.getint('PROFILER', 'keep', fallback=20))
+
+
+def parse_settings(args):
+    '''
+    Return the settings given in request arguments as dict, see configure().
+
+    Raises ValueError for invalid arguments.
+    '''
+
+    settings = {}
+    if 'enabled' in args:
+        value = args['enabled'].lower()
+        if value not in ('true', 'false', '1', '0', 'on', 'off'):
+            raise ValueError('enabled must be true or false')
+        settings['enabled'] = value in ('true', '1', 'on')
+    if 'every' in args:
+        settings['every'] = int(args['every'])
+    if 'threshold' in args:
+        settings['threshold'] = float(args['threshold'])
+    if settings.get('every', 0) < 0 or settings.get('threshold', 0) < 0:
+        raise ValueError('every and threshold must not be negative')
+    return settings
@@ -0,0 +1,292 @@
+"""
+Queries of the traffic table built from request arguments.
+
+These helpers are used by the endpoints of both the Flask and the aiohttp
+implementation of the service.
+"""
+
+import math
+import time
+
+import numpy as np
+
+import trips
+import rollups
+import vehicles
+from app import readers
+from app.ingest import allowed_types, fields
+from app.positions import parse_bbox
+
+from utils import bbox, distances, grid_cells
+
+
+def build_where_clause(criteria):
+    '''
+    Build a SQL where clause with placeholders from a list of criteria.
+
+    Criteria with a value of None are skipped. Returns the clause and the
+    list of values for its placeholders.
+
+    Example:
+        build_where_clause([('foo', '=', 'bar'), ('x', '>', 42)])
+        -> (' WHERE foo=? AND x>?', ['bar', 42])
+    '''
+
+    criteria = [(k, op, v) for (k, op, v) in criteria if v is not None]
+    result = ''
+    if criteria:
+        result += ' WHERE '
+    result += ' AND '.join(['%s%s?' % (k, op) for (k, op, v) in criteria])
+    return result, [v for (k, op, v) in criteria]
+
+
+# columns of the traffic table as returned to clients, with timestamps
+# converted from milliseconds to seconds
+traffic_columns = vehicles.text_columns
+
+
+def last_row_id():
+    'Return the id of the last row of the traffic table, to tell if rows were added.'
+
+    with readers.connection() as conn:
+        return conn.execute('SELECT max(id) FROM traffic').fetchone()[0]
+
+
+def vehicle_id(uid):
+    '''
+    Return the id of a vehicle given by uid to select its rows, -1 (no
+    rows) if unknown, or None (all rows) if no uid is given.
+    '''
+
+    if not uid:
+        return None
+    with readers.connection() as conn:
+        id = vehicles.lookup(conn, uid)
+    return -1 if id is None else id
+
+
+def time_criteria(args):
+    '''
+    Return criteria for the time window given in request arguments.
+
+    The window starts at now minus duration (ISO 8601) or at since, and
+    ends at until (both in epoch seconds). Raises ValueError for invalid
+    arguments.
+    '''
+
+    criteria = []
+    if args.get('duration', None):
+        import isodate
+
+        value = args['duration']
+        try:
+            dur = isodate.parse_duration(value)
+        except:
+            msg = "'%s' is an invalid ISO 8601 duration string. " % value
+            msg += 'See https://en.wikipedia.org/wiki/ISO_8601#Durations'
+            raise ValueError(msg)
+        timestamp = time.time() - dur.total_seconds()
+        criteria.append(('timestamp', '>=', int(timestamp * 1000)))
+
+    try:
+        since = args.get('since', None)
+        if since:
+            criteria.append(('timestamp', '>=', int(float(since) * 1000)))
+        until = args.get('until', None)
+        if until:
+            criteria.append(('timestamp', '<', int(float(until) * 1000)))
+    except (ValueError, OverflowError):
+        # int() raises OverflowError for infinite and ValueError for NaN
+        raise ValueError('since and until must be finite numbers.')
+    return criteria
+
+
+def traffic_query(args):
+    '''
+    Build a SQL query for the traffic table from request arguments.
+
+    Supported arguments are uid, type, duration (ISO 8601), since and until
+    (epoch seconds), and for keyset pagination after (a row id) and limit. Returns
+    the query and the values for its placeholders. Raises ValueError for
+    invalid arguments.
+    '''
+
+    where_args = []
+
+    where_args.append(('vehicle', '=', vehicle_id(args.get('uid', None))))
+
+    typ = args.get('type', None)
+    if typ:
+        if typ not in allowed_types:
+            raise ValueError("'%s' is an invalid vehicle type." % typ)
+        where_args.append(('type', '=', vehicles.type_codes[typ]))
+
+    where_args += time_criteria(args)
+
+    try:
+        after = args.get('after', None)
+        if after:
+            where_args.append(('id', '>', int(after)))
+        limit = args.get('limit', None)
+        limit = int(limit) if limit else None
+    except ValueError:
+        raise ValueError('after and limit must be numbers.')
+
+    cmd = "SELECT id, %s FROM traffic " % traffic_columns
+    where_clause, params = build_where_clause(where_args)
+    cmd += where_clause
+    if after or limit:
+        # a stable order is needed for paging
+        cmd += ' ORDER BY id'
+    if limit:
+        cmd += ' LIMIT ?'
+        params.append(limit)
+    return cmd, params
+
+
+# grid cells searched with the spatial index at most, larger areas are
+# searched by time and position only
+max_cells = 500
+
+
+def area_query(args):
+    '''
+    Build a SQL query for rows inside an area from request arguments.
+
+    The area is either a circle given by lat, lon and radius (in meters)
+    or a bounding box given as bbox=min_lon,min_lat,max_lon,max_lat. The
+    query selects rows inside the bounding box of the area, using the grid
+    cell index, and can be restricted to a vehicle type and a time window
+    like in traffic_query(). Returns the query, the values for its
+    placeholders, and the circle as (lat, lon, radius) or None.
+    Raises ValueError for invalid arguments.
+    '''
+
+    circle = None
+    if args.get('bbox', None):
+        lon_ll, lat_ll, lon_ur, lat_ur = parse_bbox(args['bbox'])
+    else:
+        try:
+            circle = [float(args[k]) for k in ('lat', 'lon', 'radius')]
+        except KeyError:
+            raise ValueError('Either bbox or lat, lon and radius are needed.')
+        if not all(math.isfinite(x) for x in circle):
+            raise ValueError('lat, lon and radius must be finite.')
+        (lat_ll, lon_ll), (lat_ur, lon_ur) = bbox(*circle)
+
+    cells = grid_cells(lat_ll, lon_ll, lat_ur, lon_ur, max_cells)
+    use_cells = cells is not None
+    where_args = [
+        ('lattitude', '>=', lat_ll), ('lattitude', '<=', lat_ur),
+        ('longitude', '>=', lon_ll), ('longitude', '<=', lon_ur),
+    ]
+    typ = args.get('type', None)
+    if typ:
+        if typ not in allowed_types:
+            raise ValueError("'%s' is an invalid vehicle type." % typ)
+        # the unary + keeps SQLite from using the type index instead
+        where_args.append(('+type' if use_cells else 'type', '=', vehicles.type_codes[typ]))
+    where_args += time_criteria(args)
+
+    cmd = "SELECT id, %s FROM traffic " % traffic_columns
+    where_clause, params = build_where_clause(where_args)
+    cmd += where_clause
+    if use_cells:
+        cmd += ' AND cell IN (%s)' % ', '.join(map(str, cells))
+    return cmd, params, circle
+
+
+def search_area(args):
+    '''
+    Return rows inside an area given in request arguments as a dict.
+
+    See area_query() for the arguments. For a circle, the rows inside its
+    bounding box are refined with their distances to the centre, and the
+    distance (in meters) is added to every row.
+    '''
+
+    cmd, params, circle = area_query(args)
+    with readers.connection() as conn:
+        rows = vehicles.decode(conn, conn.execute(cmd, params).fetchall(), 1)
+
+    keys = ['id'] + fields
+    if circle is not None and rows:
+        lat, lon, radius = circle
+        lats = np.array([r[5] for r in rows])
+        lons = np.array([r[4] for r in rows])
+        dist = distances(lat, lon, lats, lons, mode='flat')
+        # the exact geodesic distance only decides points near the edge
+        close = np.abs(dist - radius) <= radius * 1e-3
+        if close.any():
+            dist[close] = distances(lat, lon, lats[close], lons[close], mode='geodesic')
+        inside = dist <= radius
+        rows = [r + (d,) for (r, d) in zip(rows, dist.tolist())]
+        rows = [r for (r, i) in zip(rows, inside) if i]
+        keys = keys + ['distance']
+
+    result = [dict(zip(keys, r)) for r in rows]
+    uids = sorted(set(r[1] for r in rows))
+    return dict(count=len(result), vehicles=uids, rows=result)
+
+
+def trip_summary(args, uid=None):
+    '''
+    Return trip aggregates over time buckets from request arguments.
+
+    Without a uid the aggregates are grouped by vehicle type, which can be
+    restricted with type. The time window is given like in traffic_query()
+    and selects buckets by their start, bucket is their length in seconds.
+    See trips.summary() for the result. Raises ValueError for invalid
+    arguments.
+    '''
+
+    criteria = [('uid', '=', uid)]
+    typ = args.get('type', None)
+    if typ:
+        if typ not in allowed_types:
+            raise ValueError("'%s' is an invalid vehicle type." % typ)
+        criteria.append(('type', '=', typ))
+    criteria += [('bucket', op, v) for (k, op, v) in time_criteria(args)]
+    try:
+        bucket = args.get('bucket', None)
+        bucket = int(float(bucket) * 1000) if bucket else None
+    except (ValueError, OverflowError):
+        raise ValueError('bucket must be a finite number.')
+
+    with readers.connection() as conn:
+        return trips.summary(conn, criteria, bucket, by_type=uid is None)
+
+
+def rollup_summary(args):
+    '''
+    Return rollups over time from request arguments.
+
+    Supported arguments are period (minute or hour), type, the time window
+    like in traffic_query() selecting buckets by their start, by=type to
+    group by vehicle type too, and a bounding box (like for
+    /vehicles/within) to return the rollups of the grid cells intersecting
+    it. See rollups.summary() for the result. Raises ValueError for invalid
+    arguments.
+    '''
+
+    criteria = []
+    typ = args.get('type', None)
+    if typ:
+        if typ not in allowed_types:
+            raise ValueError("'%s' is an invalid vehicle type." % typ)
+        criteria.append(('type', '=', typ))
+    criteria += [('bucket', op, v) for (k, op, v) in time_criteria(args)]
+    by = args.get('by', None)
+    if by not in (None, '', 'type'):
+        raise ValueError('Rollups can only be grouped by type.')
+
+    cells = None
+    if args.get('bbox', None):
+        lon_ll, lat_ll, lon_ur, lat_ur = parse_bbox(args['bbox'])
+        cells = grid_cells(lat_ll, lon_ll, lat_ur, lon_ur, max_cells)
+        if cells is None:
+            raise ValueError('The bounding box covers more than %d grid cells.' % max_cells)
+
+    with readers.connection() as conn:
+        return rollups.summary(conn, args.get('period', 'minute'), criteria,
+            by_type=by == 'type', cells=cells)
@@ -0,0 +1,103 @@
+"""
+Database connections with a configurable SQLite tuning profile.
+
+The database is used in WAL mode, so readers never block the writer and
+vice versa. Writing is done by one serialized writer connection (owned by
+the writer thread of the ingest buffer), while queries use a pool of
+read-only connections.
+"""
+
+import queue
+import sqlite3
+import threading
+import contextlib
+
+
+# default pragmas, can be overwritten in the SQLITE section of config.ini
+default_pragmas = dict(
+    journal_mode='wal',
+    synchronous='normal',
+    cache_size=-16000,
+    mmap_size=256 * 1024 * 1024,
+    busy_timeout=5000,
+)
+
+
+def get_pragmas(config):
+    'Return the pragmas from the SQLITE section of a config, with defaults.'
+
+    pragmas = dict(default_pragmas)
+    if config.has_section('SQLITE'):
+        for key in pragmas:
+            pragmas[key] = config.get('SQLITE', key, fallback=pragmas[key])
+    return pragmas
+
+
+def connect(path, pragmas=None, readonly=False):
+    '''
+    Open a database connection and apply the given pragmas.
+
+    The journal mode is persistent in the database file and is only set by
+    connections that are not read-only. Connections can be used by other
+    threads than the creating one, but only by one thread at a time.
+    '''
+
+    pragmas = dict(default_pragmas if pragmas is None else pragmas)
+    if readonly:
+        uri = 'file:%s?mode=ro' % path
+        conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        pragmas.pop('journal_mode', None)
+    else:
+        conn = sqlite3.connect(path, check_same_thread=False)
+    for key, value in sorted(pragmas.items()):
+        conn.execute('PRAGMA %s = %s' % (key, value))
+    return conn
+
+
+class ReadPool(object):
+    '''
+    Pool of read-only database connections.
+
+    Connections are opened lazily, up to the given size. If all connections
+    are in use, callers wait for the next one to be returned.
+    '''
+
+    def __init__(self, path, size=4, pragmas=None):
+        self.path = path
+        self.size = size
+        self.pragmas = pragmas
+        self.idle = queue.LifoQueue()
+        self.opened = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        'Take a connection from the pool, opening a new one if allowed.'
+
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            can_open = self.opened < self.size
+            if can_open:
+                self.opened += 1
+        if can_open:
+            return connect(self.path, self.pragmas, readonly=True)
+        return self.idle.get()
+
+    def release(self, conn):
+        'Return a connection into the pool.'
+
+        if conn.in_transaction:
+            conn.rollback()
+        self.idle.put(conn)
+
+    @contextlib.contextmanager
+    def connection(self):
+        'Context manager providing a connection from the pool.'
+
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
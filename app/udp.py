@@ -0,0 +1,137 @@
+"""
+UDP listener for emissions in the binary format of the protocol module.
+
+Datagrams are received by a separate thread. All datagrams waiting in the
+socket buffer are read at once, decoded together and submitted to the same
+pipeline as the emissions posted to /data.
+"""
+
+import atexit
+import socket
+import threading
+import traceback
+
+import protocol
+from app import metrics
+
+
+# the running listener, if any
+listener = None
+
+
+class UdpListener(object):
+    '''
+    Thread receiving datagrams on a UDP port and submitting their rows.
+    '''
+
+    def __init__(self, pipeline, port, host='0.0.0.0', max_batch=1000,
+            buffer_size=4 * 1024 * 1024):
+        self.pipeline = pipeline
+        self.max_batch = max_batch
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # a large receive buffer keeps bursts from being dropped
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buffer_size)
+        self.sock.bind((host, port))
+        self.thread = None
+        self.closed = False
+
+        # statistics
+        self.datagrams = 0
+        self.invalid_datagrams = 0
+        self.records = 0
+        self.invalid_records = 0
+        self.rejected_records = 0
+        self.errors = 0
+
+        atexit.register(self.close)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='udp-listener', daemon=True)
+        self.thread.start()
+
+    def receive(self):
+        'Wait for a datagram, return it with all others already waiting.'
+
+        datagrams = [self.sock.recv(65535)]
+        try:
+            while len(datagrams) < self.max_batch:
+                datagrams.append(self.sock.recv(65535, socket.MSG_DONTWAIT))
+        except BlockingIOError:
+            pass
+        return datagrams
+
+    def run(self):
+        'Main loop of the listener thread, until closed.'
+
+        while not self.closed:
+            try:
+                datagrams = self.receive()
+                if self.closed:
+                    break
+                self.handle(datagrams)
+            except Exception:
+                if self.closed:
+                    break
+                # e.g. the pipeline failed, the next datagrams may succeed
+                self.errors += 1
+                metrics.udp_errors.labels().inc()
+                traceback.print_exc()
+
+    def handle(self, datagrams):
+        'Decode datagrams and submit their valid rows to the pipeline.'
+
+        valid = [d for d in datagrams if d and len(d) % protocol.record_size == 0]
+        self.datagrams += len(datagrams)
+        self.invalid_datagrams += len(datagrams) - len(valid)
+        rows, num_invalid = protocol.decode(b''.join(valid))
+        self.records += len(rows) + num_invalid
+        self.invalid_records += num_invalid
+        if rows:
+            reasons = self.pipeline.submit(rows)
+            self.rejected_records += sum(1 for r in reasons if r is not None)
+
+    def stats(self):
+        'Return a dict with listener statistics.'
+
+        return dict(
+            udp_datagrams=self.datagrams,
+            udp_invalid_datagrams=self.invalid_datagrams,
+            udp_records=self.records,
+            udp_invalid_records=self.invalid_records,
+            udp_rejected_records=self.rejected_records,
+            udp_errors=self.errors,
+        )
+
+    def close(self):
+        'Stop receiving datagrams and wait for the thread to finish.'
+
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            # wakes the thread waiting for a datagram, even though a UDP
+            # socket is not connected
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        if self.thread is not None:
+            self.thread.join()
+        self.sock.close()
+
+
+def start(pipeline, port):
+    'Start listening on a UDP port, if it is not 0.'
+
+    global listener
+    if port:
+        listener = UdpListener(pipeline, port)
+        listener.start()
+        print('listening for UDP emissions on port %d' % port)
+    return listener
+
+
+def stop():
+    'Stop the running listener, if any, before the pipeline is closed.'
+
+    if listener is not None:
+        listener.close()
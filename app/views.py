@@ -1,36 +1,34 @@
 """
 Microservice endpoints.
+
+Only the endpoints needed for ingesting data are defined here, the query
+and export endpoints and the maps are optional blueprints, see
+app/export_views.py and app/maps_views.py.
 """
 
-import os
-import time
 import json
+import time
 
-import isodate
-import pandas as pd
-from flask import Response, render_template, request, abort
-
-from app import app, maps, conn
-
-from utils import bbox
+from flask import Response, render_template, request, abort, g
 
+import rollups
+from app import app, readers, boundary, pipeline, positions, udp, metrics
+from app.ingest import parse_emission, parse_batch, submit_batch
+from app.positions import positions_query
 
-# helpers
 
-def build_where_clause(criteria):
-    '''
-    Build a SQL where clause from a list of criteria.
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
 
-    Example:
-        build_where_clause([('foo', '=', 'bar'), ('x', '>', 42)])
-        -> ' WHERE foo=bar AND x>42'
-    '''
 
-    result = ''
-    if any(criteria):
-        result += ' WHERE '
-    result += ' AND '.join(['%s%s%s' % (k, op, json.dumps(v)) for (k, op, v) in criteria if v is not None])
-    return result
+@app.after_request
+def observe_request(response):
+    # unknown URLs are counted together, so there is a limited number of labels
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'other'
+    metrics.observe_request(endpoint, response.status_code,
+        time.perf_counter() - g.request_start)
+    return response
 
 
 # desired API endpoint
@@ -40,28 +38,56 @@ def post_data():
     """
     Post vehicle data and store into a database.
 
+    Emissions outside the city boundary, or from vehicles that have exited
+    it before, are disregarded and answered with "ignored".
+
     Test using curl like this:
 
     curl -X POST "http://localhost:5000/data" --data "uid=76b1b23a-9763-41e8-9727-a63955cb5daf&type=car&timestamp=1472716308.602317&longitude=13.383333&lattitude=52.516667&heading=123"
     """
 
-    data = {k: request.form[k] for k in request.form.keys()}
-
-    cmd = "INSERT INTO traffic VALUES (?, ?, ?, ?, ?, ?)"
-    vals = (
-        data['uid'], 
-        data['type'], 
-        data['timestamp'], 
-        data['longitude'],
-        data['lattitude'],
-        data['heading']
-    )
-    cursor = conn.cursor()
-    cursor.execute(cmd, vals)
-    conn.commit()
+    start = time.perf_counter()
+    form = request.form
+    parsed = time.perf_counter()
+    try:
+        row = parse_emission(form)
+    except ValueError as e:
+        abort(400, str(e))
+    validated = time.perf_counter()
+
+    # stored asynchronously by the writer thread in the next batch
+    reason, = pipeline.submit([row])
+    metrics.observe_phases(parse=parsed - start, validate=validated - parsed,
+        submit=time.perf_counter() - validated)
+    if reason is not None:
+        return 'ignored'
     return 'saved'
 
 
+@app.route('/data/batch', methods=['POST'])
+def post_data_batch():
+    """
+    Post many emissions at once and store the valid ones in one transaction.
+
+    The body is either a JSON array of emission objects or newline-delimited
+    JSON (one object per line), with the same fields as for POST /data. The
+    result is a JSON object with the number of accepted and rejected rows and
+    the status of every row, in the order given.
+
+    Test using curl like this:
+
+    curl -X POST "http://localhost:5000/data/batch" -H "Content-Type: application/json" --data '[{"uid": "76b1b23a-9763-41e8-9727-a63955cb5daf", "type": "bus", "timestamp": 1472716308.602317, "longitude": 13.383333, "lattitude": 52.516667, "heading": 123}]'
+    """
+
+    try:
+        items = parse_batch(request.get_data(as_text=True))
+    except ValueError as e:
+        abort(400, 'Invalid JSON: %s' % e)
+
+    result = submit_batch(pipeline, items)
+    return Response(json.dumps(result), mimetype='application/json')
+
+
 # additional endpoints
 
 @app.route('/')
@@ -80,104 +106,56 @@ def get_simple():
 def get_num_data():
     '''
     Return number of data points
-    '''
 
-    cursor = conn.cursor()
-    cmd = "SELECT count(*) FROM traffic"
-    cursor.execute(cmd)
-    row = cursor.fetchone()
-    return str(row[0])
-
-
-@app.route('/data.csv')
-def get_data_csv():
+    The number is read from the row counts per type kept by triggers,
+    instead of counting all rows.
     '''
-    Download traffic data from matching some criteria, as a CSV file.
 
-    Duration is supposed to be in ISO8601 format (PT1H means a time
-    period of one hour).
+    with readers.connection() as conn:
+        num = sum(rollups.totals(conn).values())
+    return str(num)
 
-    Examples:
-        /data.csv
-        /data.csv?type=car&duration=PT1H
-        /data.csv?uid=687a7ec8-6fa8-11e6-b897-442a60f31a14
-    '''
 
-    args = request.args
-    where_args = []
-
-    uid = args.get('uid', None)
-    if uid:
-        where_args.append(('uid', '=', uid))
-    
-    typ = args.get('type', None)
-    allowed_types = ['bus', 'car', 'taxi', 'train']
-    if typ:
-        assert typ in allowed_types
-        where_args.append(('type', '=', typ))
-
-    timestamp = None
-    if args.get('duration', None):
-        value = args['duration']
-        try:
-            dur = isodate.parse_duration(value)
-        except:
-            msg = "'%s' is an invalid ISO 8601 duration string. " % value
-            msg += 'See https://en.wikipedia.org/wiki/ISO_8601#Durations'
-            abort(404, msg)
-        timestamp = time.time() - dur.total_seconds()
-        where_args.append(('timestamp', '>=', timestamp))
-
-    # using pandas to run the SQL query and convert rows to CSV
-    cmd = "SELECT * FROM traffic "
-    where_clause = build_where_clause(where_args)
-    cmd += where_clause
-    df = pd.read_sql_query(cmd, conn)
-    csv = df.to_csv()
-    return Response(csv, mimetype='text/csv')
-
-
-@app.route('/map/traffic')
-def get_map_traffic():
+@app.route('/ingest/stats')
+def get_ingest_stats():
     '''
-    Show a map with all locations of all (or only one) vehicles in Snowdonia.
-
-    You can map only one vehicle by adding ?uid=<UID> as query parameter.
+    Return ingest buffer, boundary filter and UDP statistics as JSON.
     '''
 
-    cursor = conn.cursor()
-    cmd = "SELECT * FROM traffic "
-    args = request.args
-    uid = args.get('uid', None)
-    if uid:
-        cmd += ' WHERE uid="%s"' % uid
-    df = pd.read_sql_query(cmd, conn)
-    data = list(zip(df.longitude, df.lattitude))
-
-    plt = maps.make_map_traffic(data)
-    plt.savefig('geo/map_traffic.png')
-    return Response(open('geo/map_traffic.png', 'rb').read(), mimetype='image/png')
+    stats = dict(pipeline.sink.stats(), **boundary.stats())
+    if udp.listener is not None:
+        stats.update(udp.listener.stats())
+    return Response(json.dumps(stats), mimetype='application/json')
 
 
-# additional, undocumented maps
-
-@app.route('/map/world', methods=['GET'])
-def get_map_world():
+@app.route('/metrics')
+def get_metrics():
     '''
-    Show a world map.
+    Return request and ingest metrics in the Prometheus text format.
     '''
 
-    plt = maps.make_map_world()
-    plt.savefig('geo/map_world.png')
-    return Response(open('geo/map_world.png', 'rb').read(), mimetype='image/png')
+    return Response(metrics.registry.render(), content_type=metrics.content_type)
 
 
-@app.route('/map/berlin/bvg')
-def get_map_berlin_bvg():
+@app.route('/vehicles/current')
+def get_vehicles_current():
     '''
-    Show a Berlin map with BVG stops.
+    Return the latest position of every vehicle as JSON.
+
+    This is served from memory without querying the database. Vehicles can
+    be filtered by type and by a bounding box given as
+    min_lon,min_lat,max_lon,max_lat.
+
+    Examples:
+        /vehicles/current
+        /vehicles/current?type=bus&bbox=13.3,52.5,13.4,52.55
     '''
 
-    plt = maps.make_map_berlin_bvg()
-    plt.savefig('geo/map_berlin.png')
-    return Response(open('geo/map_berlin.png', 'rb').read(), mimetype='image/png')
+    try:
+        typ, box = positions_query(request.args)
+    except ValueError as e:
+        abort(404, str(e))
+
+    vehicles = positions.snapshot(typ, box)
+    result = dict(count=len(vehicles), vehicles=vehicles)
+    return Response(json.dumps(result), mimetype='application/json')
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+
+"""
+Columnar archive of the traffic table.
+
+Rows are exported incrementally into compressed, columnar files, one
+directory per UTC day (like ``archive/date=2016-09-05/``), with uid and
+type stored dictionary-encoded. The id of the last row exported is kept in
+the database as a watermark, so every run exports only the rows added
+since the last one, into one new file per day. File names contain the
+first row id of the run, so repeating an interrupted run overwrites its
+files instead of duplicating rows.
+
+The format is set in the ARCHIVE section of ``config.ini``: ``parquet``
+(zstd-compressed) or ``arrow`` (Arrow IPC files, uncompressed, which can
+be memory-mapped without copying). Both are opened with memory mapping
+when read and can also be read directly by pyarrow, pandas, Spark etc.
+
+This needs pyarrow to be installed.
+
+Usage:
+
+    python3 archive.py export [--prune KEEP_DAYS]
+    python3 archive.py list
+"""
+
+import os
+import time
+import sqlite3
+import argparse
+import configparser
+
+import database
+import vehicles
+
+
+config_path = 'config.ini'
+config = configparser.ConfigParser()
+config.read(config_path)
+archive_dir = config.get('ARCHIVE', 'directory', fallback='archive')
+archive_format = config.get('ARCHIVE', 'format', fallback='parquet')
+
+extensions = dict(parquet='.parquet', arrow='.arrow')
+
+
+def get_schema():
+    import pyarrow as pa
+
+    dict_string = pa.dictionary(pa.int32(), pa.string())
+    return pa.schema([
+        ('id', pa.int64()),
+        ('uid', dict_string),
+        ('type', dict_string),
+        ('timestamp', pa.timestamp('ms', tz='UTC')),
+        ('longitude', pa.float64()),
+        ('lattitude', pa.float64()),
+        ('heading', pa.float64()),
+    ])
+
+
+def get_watermark(conn):
+    'Return the id of the last row exported, 0 if none.'
+
+    row = conn.execute("SELECT value FROM watermarks WHERE name = 'archive'").fetchone()
+    return row[0] if row else 0
+
+
+def set_watermark(conn, last_id):
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO watermarks (name, value) "
+            "VALUES ('archive', ?)", (last_id,))
+
+
+class DayWriters(object):
+    '''
+    Open file writers for all days of one export run.
+
+    Files are written under a temporary name and renamed when closed.
+    '''
+
+    def __init__(self, directory, fmt, first_id):
+        self.directory = directory
+        self.format = fmt
+        self.name = 'part-%012d%s' % (first_id, extensions[fmt])
+        self.schema = get_schema()
+        self.writers = {}
+
+    def path(self, day):
+        return os.path.join(self.directory, 'date=%s' % day, self.name)
+
+    def write(self, day, table):
+        import pyarrow.parquet as pq
+        import pyarrow.ipc as ipc
+
+        if day not in self.writers:
+            path = self.path(day)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if self.format == 'parquet':
+                writer = pq.ParquetWriter(path + '.tmp', self.schema,
+                    compression='zstd', use_dictionary=['uid', 'type'])
+            else:
+                writer = ipc.new_file(path + '.tmp', self.schema)
+            self.writers[day] = writer
+        self.writers[day].write_table(table)
+
+    def close(self):
+        'Close all files, return their paths.'
+
+        paths = []
+        for day, writer in sorted(self.writers.items()):
+            writer.close()
+            os.replace(self.path(day) + '.tmp', self.path(day))
+            paths.append(self.path(day))
+        return paths
+
+
+def to_table(rows, schema):
+    'Convert rows of the traffic table into an Arrow table.'
+
+    import pyarrow as pa
+
+    columns = list(zip(*rows))
+    arrays = [pa.array(col, type=field.type.value_type).dictionary_encode()
+            if pa.types.is_dictionary(field.type) else pa.array(col, type=field.type)
+        for col, field in zip(columns, schema)]
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def export(conn=None, directory=None, fmt=None, chunk_size=100000):
+    '''
+    Export all rows added since the last export, return a dict with results.
+
+    The connection must be able to write, to update the watermark.
+    '''
+
+    conn = conn or sqlite3.connect(database.path)
+    directory = directory or archive_dir
+    fmt = fmt or archive_format
+    if fmt not in extensions:
+        raise ValueError('Unknown archive format: %r' % fmt)
+
+    start = time.time()
+    watermark = get_watermark(conn)
+    cmd = 'SELECT id, %s FROM traffic WHERE id > ? ORDER BY id' % vehicles.record_columns
+    cursor = conn.execute(cmd, (watermark,))
+    writers = DayWriters(directory, fmt, watermark + 1)
+    num_rows, last_id = 0, watermark
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        rows = vehicles.decode(conn, rows, 1)
+        # group the rows of the chunk by UTC day
+        by_day = {}
+        for row in rows:
+            day = time.strftime('%Y-%m-%d', time.gmtime(row[3] // 1000))
+            by_day.setdefault(day, []).append(row)
+        for day, day_rows in by_day.items():
+            writers.write(day, to_table(day_rows, writers.schema))
+        num_rows += len(rows)
+        last_id = rows[-1][0]
+    cursor.close()
+    paths = writers.close()
+    if num_rows:
+        set_watermark(conn, last_id)
+    return dict(rows=num_rows, files=paths, watermark=last_id,
+        duration=time.time() - start)
+
+
+def prune(conn=None, keep_days=7):
+    '''
+    Delete archived rows older than keep_days complete UTC days.
+
+    Only rows up to the watermark are deleted, and never the last row, so
+    row ids are not reused for new rows.
+    '''
+
+    conn = conn or sqlite3.connect(database.path)
+    cutoff = (int(time.time() * 1000) // database.day_ms - int(keep_days) + 1) * database.day_ms
+    with conn:
+        cursor = conn.execute('''DELETE FROM traffic
+            WHERE id <= ? AND timestamp < ? AND id < (SELECT max(id) FROM traffic)''',
+            (get_watermark(conn), cutoff))
+    return cursor.rowcount
+
+
+def list_files(directory=None):
+    'Return the paths of all archive files, relative to the directory.'
+
+    directory = directory or archive_dir
+    result = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            if name.endswith(tuple(extensions.values())):
+                result.append(os.path.relpath(os.path.join(root, name), directory))
+    return result
+
+
+def read(directory=None, columns=None):
+    '''
+    Read the whole archive into an Arrow table, using memory mapping.
+    '''
+
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import pyarrow.ipc as ipc
+
+    directory = directory or archive_dir
+    tables = []
+    for name in list_files(directory):
+        path = os.path.join(directory, name)
+        if name.endswith('.parquet'):
+            table = pq.read_table(path, columns=columns, memory_map=True)
+        else:
+            table = ipc.open_file(pa.memory_map(path)).read_all()
+            if columns:
+                table = table.select(columns)
+        tables.append(table)
+    if not tables:
+        return get_schema().empty_table()
+    return pa.concat_tables(tables)
+
+
+if __name__ == '__main__':
+    desc = 'Export the traffic table into a columnar archive.'
+    parser = argparse.ArgumentParser(description=desc)
+    add_arg = parser.add_argument
+    add_arg('command',
+        choices=['export', 'list'],
+        help='Export new rows or list the archive files.')
+    add_arg('--prune',
+        type=int, metavar='KEEP_DAYS',
+        help='After exporting, delete exported rows older than this number '
+            'of days from the database.')
+
+    args = parser.parse_args()
+    if args.command == 'export':
+        conn = sqlite3.connect(database.path, timeout=30)
+        database.migrate(conn)
+        res = export(conn)
+        for path in res['files']:
+            print(path)
+        print('exported %d rows in %.1f seconds, watermark is now %d' % (
+            res['rows'], res['duration'], res['watermark']))
+        if args.prune is not None:
+            print('pruned %d rows' % prune(conn, args.prune))
+    elif args.command == 'list':
+        for name in list_files():
+            print(os.path.join(archive_dir, name))
@@ -0,0 +1,5 @@
+"""
+Benchmarks, to be run as modules from the repository root, e.g.:
+
+    python3 -m benchmarks.spatial
+"""
@@ -0,0 +1,128 @@
+"""
+Temporary environments for benchmarks: a directory with its own config.ini
+and synthetic database, and the service running on it.
+
+The real database and config.ini are never modified.
+"""
+
+import os
+import sys
+import time
+import socket
+import sqlite3
+import tempfile
+import subprocess
+import configparser
+import urllib.request
+
+
+root = os.getcwd()
+
+
+def free_port():
+    'Return a TCP port that is currently not in use.'
+
+    with socket.socket() as sock:
+        sock.bind(('localhost', 0))
+        return sock.getsockname()[1]
+
+
+def child_env():
+    'Return the environment for child processes, finding the repository modules.'
+
+    path = [root] + list(filter(None, [os.environ.get('PYTHONPATH')]))
+    return dict(os.environ, PYTHONPATH=os.pathsep.join(path))
+
+
+class Environment(object):
+    '''
+    Temporary directory with a config.ini based on the real one.
+
+    Settings of the SERVICE section can be changed with keyword arguments.
+    Use as a context manager, the directory is removed at the end.
+    '''
+
+    def __init__(self, **service):
+        self.tmp = tempfile.TemporaryDirectory(prefix='benchmark-')
+        self.path = self.tmp.name
+        config = configparser.ConfigParser()
+        config.read(os.path.join(root, 'config.ini'))
+        self.port = free_port()
+        settings = dict(database='benchmark.db', port=self.port, debug=False, udp_port=0)
+        settings.update(service)
+        for key, value in settings.items():
+            config.set('SERVICE', key, str(value))
+        with open(os.path.join(self.path, 'config.ini'), 'w') as f:
+            config.write(f)
+        os.symlink(os.path.join(root, 'geo'), os.path.join(self.path, 'geo'))
+        self.database = os.path.join(self.path, settings['database'])
+        self.url = 'http://localhost:%d' % self.port
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.tmp.cleanup()
+
+    def run(self, *args):
+        'Run a repository script (with arguments) in the directory, return its output.'
+
+        cmd = [sys.executable, os.path.join(root, args[0])] + [str(a) for a in args[1:]]
+        return subprocess.check_output(cmd, cwd=self.path, env=child_env()).decode()
+
+    def fill(self, num_rows, duration=3600):
+        '''
+        Create the database with about num_rows rows of a simulated fleet.
+
+        The fleet emits for the given duration (in seconds) with one row per
+        vehicle every 20 seconds, its size is chosen to give num_rows rows.
+        Returns the actual number of rows.
+        '''
+
+        if os.path.exists(self.database):
+            os.remove(self.database)
+        self.run('database.py', 'create')
+        ticks = int(duration // 20)
+        vehicles = max(1, int(round(num_rows / ticks)))
+        self.run('simulate.py', '--fleet', '--type', 'mixed', vehicles, duration)
+        with sqlite3.connect(self.database) as conn:
+            return conn.execute('SELECT count(*) FROM traffic').fetchone()[0]
+
+    def serve(self):
+        'Return the service started on the directory, see Service.'
+
+        return Service(self)
+
+
+class Service(object):
+    '''
+    The service (serve.py) running in a child process of an environment.
+
+    Use as a context manager, the service is stopped at the end.
+    '''
+
+    def __init__(self, env, timeout=60):
+        self.env = env
+        self.timeout = timeout
+        self.process = None
+
+    def __enter__(self):
+        self.process = subprocess.Popen([sys.executable, os.path.join(root, 'serve.py')],
+            cwd=self.env.path, env=child_env(),
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        end = time.time() + self.timeout
+        while True:
+            try:
+                urllib.request.urlopen(self.env.url + '/simple').read()
+                return self
+            except IOError:
+                if self.process.poll() is not None or time.time() > end:
+                    raise RuntimeError('The service did not start.')
+                time.sleep(0.2)
+
+    def __exit__(self, *exc):
+        self.process.terminate()
+        try:
+            self.process.wait(30)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
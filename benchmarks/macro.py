@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+"""
+Macro-benchmarks of the running service on synthetic databases.
+
+For every database size, a temporary database is filled with a fleet
+simulated by simulate.py and the service is started on it (see
+benchmarks/env.py), to measure:
+
+- downloading all rows with /data.csv
+- the latency of /num_data
+
+Then emissions are posted to /data by 100 to 5000 concurrent emitters
+with loadtest.py, to measure the ingest throughput and latency. Every
+emitter posts once per second, so the throughput is at most the number
+of emitters per second. The server implementation can be chosen, by
+default the one in config.ini.
+
+    python3 -m benchmarks.macro
+    python3 -m benchmarks.macro --sizes 10000,10000000 --emitters 1000 --server aiohttp
+"""
+
+import sys
+import json
+import time
+import asyncio
+import argparse
+import urllib.request
+
+import numpy as np
+
+import loadtest
+from benchmarks.env import Environment
+from benchmarks.micro import result, print_results
+
+
+def download(url, chunk_size=1 << 20):
+    'Download a URL, return the time needed and the number of bytes.'
+
+    start = time.perf_counter()
+    size = 0
+    with urllib.request.urlopen(url) as resp:
+        while True:
+            chunk = resp.read(chunk_size)
+            if not chunk:
+                break
+            size += len(chunk)
+    return time.perf_counter() - start, size
+
+
+def run_queries(env, name, num_rows, num_requests=200):
+    'Benchmark exporting all rows and counting them.'
+
+    duration, size = download(env.url + '/data.csv')
+    latencies = []
+    for i in range(num_requests):
+        latencies.append(download(env.url + '/num_data')[0])
+    p50, p99 = np.percentile(np.array(latencies) * 1000, [50, 99])
+    return {
+        'data_csv.%s.duration' % name: result(duration, 's'),
+        'data_csv.%s.throughput' % name: result(num_rows / duration, 'rows/s', 'higher'),
+        'data_csv.%s.size' % name: result(size / 1e6, 'MB'),
+        'num_data.%s.p50' % name: result(float(p50), 'ms'),
+        'num_data.%s.p99' % name: result(float(p99), 'ms'),
+    }
+
+
+def run_ingest(env, emitters, ticks=3):
+    'Benchmark posting emissions with a number of concurrent emitters.'
+
+    # one tick per second, with emissions spread over the tick
+    res = asyncio.run(loadtest.run(env.url + '/data', emitters, ticks * 20, speedup=20,
+        jitter=True, connections=emitters))
+    name = 'post_data.emitters_%d' % emitters
+    return {
+        '%s.throughput' % name: result(res['throughput'], 'requests/s', 'higher'),
+        '%s.errors' % name: result(res['errors'], 'requests'),
+        '%s.p50' % name: result(res['latency_ms']['p50'], 'ms'),
+        '%s.p99' % name: result(res['latency_ms']['p99'], 'ms'),
+    }
+
+
+def run(sizes, emitters, server=None, ticks=3):
+    'Run all macro-benchmarks, return the results as a dict by name.'
+
+    service = dict(blueprints='export')
+    if server:
+        service['server'] = server
+    results = {}
+    with Environment(**service) as env:
+        for size in sizes:
+            num_rows = env.fill(size)
+            print('database with %d rows' % num_rows, file=sys.stderr)
+            with env.serve():
+                results.update(run_queries(env, 'rows_%d' % size, num_rows))
+        with env.serve():
+            for num in emitters:
+                results.update(run_ingest(env, num, ticks))
+    return results
+
+
+def parse_numbers(value):
+    return [int(float(x)) for x in value.split(',') if x]
+
+
+if __name__ == '__main__':
+    desc = 'Run macro-benchmarks of the service.'
+    parser = argparse.ArgumentParser(description=desc)
+    add_arg = parser.add_argument
+    add_arg('--sizes',
+        default='1e4,1e5,1e6',
+        help='Comma separated numbers of rows in the databases (default: "1e4,1e5,1e6").')
+    add_arg('--emitters',
+        default='100,500,1000,5000',
+        help='Comma separated numbers of concurrent emitters (default: "100,500,1000,5000").')
+    add_arg('--ticks',
+        type=int, default=3,
+        help='Number of emissions per emitter (default: 3).')
+    add_arg('--server',
+        choices=['flask', 'aiohttp', 'multi'],
+        help='Server implementation (default: the one in config.ini).')
+    add_arg('--json',
+        metavar='PATH',
+        help='Also save the results as JSON in this file.')
+
+    args = parser.parse_args()
+    res = run(parse_numbers(args.sizes), parse_numbers(args.emitters), args.server, args.ticks)
+    print_results(res)
+    if args.json:
+        json.dump(res, open(args.json, 'w'), indent=2)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+"""
+Micro-benchmarks of functions on the hot paths of the service.
+
+- utils.distance() and utils.destination(), the geodesic helpers
+- build_where_clause(), used by every query endpoint
+- maps.make_map_traffic(), rendering a map with 10000 positions
+
+They run in a fresh process in a temporary directory with an empty
+database (see benchmarks/env.py), which also gives the time of the first
+map, including loading matplotlib and drawing the base map. If Basemap is
+not installed, the map benchmark is skipped.
+
+    python3 -m benchmarks.micro
+"""
+
+import sys
+import json
+import time
+import timeit
+import argparse
+import subprocess
+
+import numpy as np
+
+from benchmarks.env import Environment, child_env
+
+
+# code run in the child process, prints the results as JSON
+child_code = '''
+import json
+from benchmarks.micro import measure
+print(json.dumps(measure(%(maps)r)))
+'''
+
+
+def timed(func, *args, repeat=5):
+    'Return the best time of one call of func(*args) in seconds.'
+
+    timer = timeit.Timer(lambda: func(*args))
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number
+
+
+def result(value, unit, better='lower'):
+    return dict(value=value, unit=unit, better=better)
+
+
+def measure_geo():
+    'Benchmark the geodesic helpers and building where clauses.'
+
+    import utils
+    from app.queries import build_where_clause
+
+    criteria = [('vehicle', '=', 42),
+        ('type', '=', 0), ('timestamp', '>=', 1473103778000),
+        ('timestamp', '<', 1473104378000), ('id', '>', None)]
+    return {
+        'utils.distance': result(
+            timed(utils.distance, 52.516667, 13.383333, 52.52, 13.41) * 1e6, 'us'),
+        'utils.destination': result(
+            timed(utils.destination, 52.516667, 13.383333, 45, 1000) * 1e6, 'us'),
+        'build_where_clause': result(
+            timed(build_where_clause, criteria) * 1e6, 'us'),
+    }
+
+
+def measure_maps(num=10000, repeat=3):
+    '''
+    Benchmark rendering traffic maps, return an empty dict without Basemap.
+
+    The first map includes loading matplotlib and drawing the base map.
+    '''
+
+    try:
+        import mpl_toolkits.basemap
+    except ImportError:
+        return {}
+    from app import maps
+
+    rng = np.random.RandomState(42)
+    data = np.column_stack([13.1 + rng.random_sample(num) * 0.6,
+        52.35 + rng.random_sample(num) * 0.35])
+    start = time.perf_counter()
+    maps.make_map_traffic(data)
+    first = time.perf_counter() - start
+    best = timed(maps.make_map_traffic, data, repeat=repeat)
+    return {
+        'maps.make_map_traffic.first': result(first, 's'),
+        'maps.make_map_traffic': result(best * 1000, 'ms'),
+    }
+
+
+def measure(maps=True):
+    '''
+    Run all micro-benchmarks in this process, return the results as a dict.
+
+    This imports the service, so it must run in a benchmark environment.
+    '''
+
+    results = measure_geo()
+    if maps:
+        results.update(measure_maps())
+    return results
+
+
+def run(maps=True):
+    '''
+    Run all micro-benchmarks in a new process in a temporary environment,
+    return the results as a dict by name.
+    '''
+
+    with Environment(blueprints='maps' if maps else '') as env:
+        env.run('database.py', 'create')
+        code = child_code % dict(maps=maps)
+        out = subprocess.check_output([sys.executable, '-c', code],
+            cwd=env.path, env=child_env())
+    return json.loads(out.decode().strip().splitlines()[-1])
+
+
+def print_results(results):
+    for name, r in sorted(results.items()):
+        print('%-45s %12.3f %s' % (name, r['value'], r['unit']))
+
+
+if __name__ == '__main__':
+    desc = 'Run micro-benchmarks of the service.'
+    parser = argparse.ArgumentParser(description=desc)
+    add_arg = parser.add_argument
+    add_arg('--no-maps',
+        action='store_true',
+        help='Skip rendering maps.')
+    add_arg('--json',
+        metavar='PATH',
+        help='Also save the results as JSON in this file.')
+
+    args = parser.parse_args()
+    res = run(maps=not args.no_maps)
+    print_results(res)
+    if args.json:
+        json.dump(res, open(args.json, 'w'), indent=2)
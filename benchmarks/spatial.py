@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+"""
+Benchmark spatial queries around all BVG stops in Berlin.
+
+For every stop in geo/stops_berlin.geojson the vehicles within a radius
+during a time window are searched in the traffic table, using different
+strategies:
+
+- grid: the grid cell index, refined with distances (like /vehicles/near)
+- bbox: the timestamp index and the bounding box, refined with distances
+- scan: all rows of the time window, with distances to every row
+
+The time window ends at the newest timestamp in the database. Fill the
+database with a simulated fleet first, e.g.:
+
+    python3 simulate.py --fleet 2000 3600
+    python3 -m benchmarks.spatial --radius 500 --duration 600
+"""
+
+import json
+import time
+import argparse
+
+import numpy as np
+
+import database
+from app import storage
+from utils import bbox, distances, grid_cells
+
+
+def load_stops(path='geo/stops_berlin.geojson'):
+    'Return the lat/lon positions of all stops.'
+
+    features = json.load(open(path))['features']
+    return [tuple(reversed(f['geometry']['coordinates'])) for f in features]
+
+
+def refine(rows, lat, lon, radius):
+    'Return the vehicle ids of rows within radius, deciding the edge exactly.'
+
+    if not rows:
+        return set()
+    lats = np.array([r[2] for r in rows])
+    lons = np.array([r[1] for r in rows])
+    dist = distances(lat, lon, lats, lons, mode='flat')
+    close = np.abs(dist - radius) <= radius * 1e-3
+    if close.any():
+        dist[close] = distances(lat, lon, lats[close], lons[close], mode='geodesic')
+    return set(r[0] for (r, d) in zip(rows, dist) if d <= radius)
+
+
+def search(conn, strategy, lat, lon, radius, start, end):
+    'Return the ids of vehicles within radius in the time window.'
+
+    cmd = 'SELECT vehicle, longitude, lattitude FROM traffic WHERE timestamp >= ? AND timestamp <= ?'
+    params = [start, end]
+    if strategy in ('grid', 'bbox'):
+        (lat_ll, lon_ll), (lat_ur, lon_ur) = bbox(lat, lon, radius)
+        cmd += ' AND lattitude BETWEEN ? AND ? AND longitude BETWEEN ? AND ?'
+        params += [lat_ll, lat_ur, lon_ll, lon_ur]
+        if strategy == 'grid':
+            cells = grid_cells(lat_ll, lon_ll, lat_ur, lon_ur)
+            cmd += ' AND cell IN (%s)' % ', '.join(map(str, cells))
+    return refine(conn.execute(cmd, params).fetchall(), lat, lon, radius)
+
+
+def run(strategies, radius, duration, num_stops=None):
+    'Run all searches for every strategy and return the results as a dict.'
+
+    conn = storage.connect(database.path, readonly=True)
+    end = conn.execute('SELECT max(timestamp) FROM traffic').fetchone()[0]
+    if end is None:
+        raise SystemExit('The traffic table is empty.')
+    start = end - int(duration * 1000)
+    num_rows = conn.execute('SELECT count(*) FROM traffic WHERE timestamp >= ?',
+        (start,)).fetchone()[0]
+    stops = load_stops()[:num_stops]
+
+    results = dict(stops=len(stops), rows_in_window=num_rows, radius=radius,
+        duration=duration, strategies={})
+    found = {}
+    for strategy in strategies:
+        t0 = time.perf_counter()
+        found[strategy] = [search(conn, strategy, lat, lon, radius, start, end)
+            for (lat, lon) in stops]
+        total = time.perf_counter() - t0
+        results['strategies'][strategy] = dict(
+            total_s=total,
+            per_stop_ms=total / len(stops) * 1000,
+            matches=sum(len(f) for f in found[strategy]))
+    first = found[strategies[0]]
+    results['same_results'] = all(found[s] == first for s in strategies)
+    return results
+
+
+if __name__ == '__main__':
+    desc = 'Benchmark radius searches around all BVG stops in Berlin.'
+    parser = argparse.ArgumentParser(description=desc)
+    add_arg = parser.add_argument
+    add_arg('--radius',
+        type=float, default=500,
+        help='Search radius in meters (default: 500).')
+    add_arg('--duration',
+        type=float, default=600,
+        help='Time window in seconds (default: 600).')
+    add_arg('--stops',
+        type=int, default=None,
+        help='Use only this number of stops (default: all).')
+    add_arg('--strategies',
+        default='grid,bbox,scan',
+        help='Comma separated strategies to run (default: "grid,bbox,scan").')
+
+    args = parser.parse_args()
+    strategies = args.strategies.split(',')
+    res = run(strategies, args.radius, args.duration, args.stops)
+    print('%d stops, %d rows in the time window, radius %g m' % (
+        res['stops'], res['rows_in_window'], res['radius']))
+    for name, r in res['strategies'].items():
+        print('%-5s %8.2f s  %8.3f ms/stop  %d matches' % (
+            name, r['total_s'], r['per_stop_ms'], r['matches']))
+    print('same results: %s' % res['same_results'])
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+
+"""
+Benchmark startup time and memory of the service with different subsystems.
+
+For every configuration a fresh Python process imports the service (like
+serve.py does before starting the server, for the Flask or the aiohttp
+implementation, which the workers of serve_multi.py run) and reports the
+time needed, its maximum resident memory and which heavy modules were
+loaded. Each process runs in a temporary directory with a copy of
+config.ini using the given blueprints and a copy of the database, so the
+real one is never modified. Configurations rendering a map are skipped if
+Basemap is not installed.
+
+    python3 -m benchmarks.startup
+    python3 -m benchmarks.startup --server aiohttp --repeat 5 --json startup.json
+"""
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import subprocess
+import configparser
+
+
+# configurations: blueprints enabled, and whether a map is rendered
+configurations = dict(
+    ingest=('', False),
+    export=('export', False),
+    full=('export, maps, live', False),
+    full_map=('export, maps, live', True),
+)
+
+heavy_modules = ['numpy', 'pandas', 'isodate', 'matplotlib', 'flask', 'aiohttp']
+
+# code run in the child process, prints the results as JSON
+child_code = '''
+import sys, time, json, resource
+start = time.perf_counter()
+if %(server)r == 'flask':
+    from app import app
+else:
+    import serve_aiohttp
+    serve_aiohttp.make_app()
+if %(render_map)r:
+    from app import maps
+    maps.make_map_world()
+duration = time.perf_counter() - start
+print(json.dumps(dict(
+    startup_s=duration,
+    max_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    modules=[m for m in %(heavy)r if m in sys.modules],
+)))
+'''
+
+
+def has_basemap():
+    'Return whether Basemap, needed to render maps, is installed.'
+
+    try:
+        import mpl_toolkits.basemap
+    except ImportError:
+        return False
+    return True
+
+
+def measure(blueprints, render_map=False, server='flask'):
+    'Import the service in a new process and return its measurements.'
+
+    root = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        config = configparser.ConfigParser()
+        config.read('config.ini')
+        config.set('SERVICE', 'blueprints', blueprints)
+        db = config.get('SERVICE', 'database')
+        if os.path.exists(db):
+            shutil.copy(db, os.path.join(tmp, os.path.basename(db)))
+        config.set('SERVICE', 'database', os.path.basename(db))
+        with open(os.path.join(tmp, 'config.ini'), 'w') as f:
+            config.write(f)
+        os.symlink(os.path.join(root, 'geo'), os.path.join(tmp, 'geo'))
+
+        path = [root] + list(filter(None, [os.environ.get('PYTHONPATH')]))
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(path))
+        code = child_code % dict(server=server, render_map=render_map, heavy=heavy_modules)
+        out = subprocess.check_output([sys.executable, '-c', code], cwd=tmp, env=env)
+    return json.loads(out.decode().strip().splitlines()[-1])
+
+
+def run(names, repeat=3, server='flask'):
+    'Measure all named configurations, return the best of each as a dict.'
+
+    results = {}
+    for name in names:
+        blueprints, render_map = configurations[name]
+        if render_map and not has_basemap():
+            continue
+        runs = [measure(blueprints, render_map, server) for i in range(repeat)]
+        best = min(runs, key=lambda r: r['startup_s'])
+        best['max_rss_mb'] = min(r['max_rss_mb'] for r in runs)
+        results[name] = best
+    return results
+
+
+if __name__ == '__main__':
+    desc = 'Benchmark startup time and memory of the service.'
+    parser = argparse.ArgumentParser(description=desc)
+    add_arg = parser.add_argument
+    add_arg('--configs',
+        default=','.join(configurations),
+        help='Comma separated configurations to run (default: "%s").'
+            % ','.join(configurations))
+    add_arg('--server',
+        choices=['flask', 'aiohttp', 'multi'],
+        help='Server implementation (default: the one in config.ini).')
+    add_arg('--repeat',
+        type=int, default=3,
+        help='Number of runs per configuration, the best is used (default: 3).')
+    add_arg('--json',
+        metavar='PATH',
+        help='Also save the results as JSON in this file.')
+
+    args = parser.parse_args()
+    if args.server is None:
+        config = configparser.ConfigParser()
+        config.read('config.ini')
+        args.server = config.get('SERVICE', 'server', fallback='flask')
+    # the workers of serve_multi.py run the aiohttp implementation
+    server = 'aiohttp' if args.server == 'multi' else args.server
+    res = run(args.configs.split(','), args.repeat, server)
+    for name, r in res.items():
+        print('%-9s %6.3f s  %7.1f MB  %s' % (
+            name, r['startup_s'], r['max_rss_mb'], ', '.join(r['modules'])))
+    if args.json:
+        json.dump(res, open(args.json, 'w'), indent=2)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+"""
+Run all micro- and macro-benchmarks and compare them with a baseline.
+
+The results are saved as JSON, together with some information about the
+machine, and compared with the results in a baseline file, by default
+benchmarks/baseline.json. Every result worse than in the baseline by more
+than the tolerance is reported as a regression, and the exit status is 1
+if there are any. Results of different machines are not comparable, so
+save a baseline on the machine used for comparing first:
+
+    python3 -m benchmarks.suite --save-baseline
+    python3 -m benchmarks.suite --json results.json
+    python3 -m benchmarks.suite --quick
+"""
+
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import subprocess
+
+from benchmarks import micro, macro
+
+
+default_baseline = os.path.join(os.path.dirname(__file__), 'baseline.json')
+
+
+def machine_info():
+    'Return a dict describing the machine and the code benchmarked.'
+
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return dict(
+        date=time.strftime('%Y-%m-%dT%H:%M:%S'),
+        commit=commit,
+        python=platform.python_version(),
+        platform=platform.platform(),
+        cpus=os.cpu_count(),
+    )
+
+
+def compare(results, baseline, tolerance=0.2):
+    '''
+    Compare results with a baseline, return a list of dicts per result.
+
+    Only results found in both are compared. The change is relative to the
+    baseline, positive if the result is worse.
+    '''
+
+    rows = []
+    for name, r in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if base['value']:
+            change = (r['value'] - base['value']) / abs(base['value'])
+        else:
+            change = 0.0 if r['value'] == base['value'] else float('inf')
+        if r.get('better') == 'higher':
+            change = -change
+        rows.append(dict(name=name, baseline=base['value'], value=r['value'],
+            unit=r['unit'], change=change, regression=change > tolerance))
+    return rows
+
+
+def print_comparison(rows):
+    for r in rows:
+        print('%-45s %12.3f %12.3f %-10s %+7.1f %%%s' % (r['name'], r['baseline'],
+            r['value'], r['unit'], r['change'] * 100, '  REGRESSION' if r['regression'] else ''))
+
+
+if __name__ == '__main__':
+    desc = 'Run all benchmarks and compare the results with a baseline.'
+    parser = argparse.ArgumentParser(description=desc)
+    add_arg = parser.add_argument
+    add_arg('--quick',
+        action='store_true',
+        help='Only use small databases and up to 500 emitters.')
+    add_arg('--sizes',
+        default='1e4,1e5,1e6',
+        help='Comma separated numbers of rows in the databases (default: "1e4,1e5,1e6").')
+    add_arg('--emitters',
+        default='100,500,1000,5000',
+        help='Comma separated numbers of concurrent emitters (default: "100,500,1000,5000").')
+    add_arg('--server',
+        choices=['flask', 'aiohttp', 'multi'],
+        help='Server implementation (default: the one in config.ini).')
+    add_arg('--no-maps',
+        action='store_true',
+        help='Skip rendering maps.')
+    add_arg('--json',
+        metavar='PATH', default='benchmark-results.json',
+        help='Save the results in this file (default: "benchmark-results.json").')
+    add_arg('--baseline',
+        metavar='PATH', default=default_baseline,
+        help='Baseline to compare with (default: "benchmarks/baseline.json").')
+    add_arg('--save-baseline',
+        action='store_true',
+        help='Save the results as the new baseline instead of comparing.')
+    add_arg('--tolerance',
+        type=float, default=0.2,
+        help='Relative change of a result counted as a regression (default: 0.2).')
+
+    args = parser.parse_args()
+    if args.quick:
+        args.sizes, args.emitters = '1e4,1e5', '100,500'
+    results = micro.run(maps=not args.no_maps)
+    results.update(macro.run(macro.parse_numbers(args.sizes),
+        macro.parse_numbers(args.emitters), args.server))
+    output = dict(machine=machine_info(), results=results)
+
+    micro.print_results(results)
+    json.dump(output, open(args.json, 'w'), indent=2)
+    print('saved results in %s' % args.json)
+    if args.save_baseline:
+        json.dump(output, open(args.baseline, 'w'), indent=2)
+        print('saved results as baseline in %s' % args.baseline)
+    elif os.path.exists(args.baseline):
+        baseline = json.load(open(args.baseline))
+        print('\ncompared with the baseline of %s (commit %s):' % (
+            baseline['machine']['date'], baseline['machine']['commit']))
+        rows = compare(results, baseline['results'], args.tolerance)
+        print_comparison(rows)
+        regressions = [r['name'] for r in rows if r['regression']]
+        if regressions:
+            print('%d regression(s): %s' % (len(regressions), ', '.join(regressions)))
+            sys.exit(1)
+    else:
+        print('no baseline found in %s, save one with --save-baseline' % args.baseline)
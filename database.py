@@ -5,22 +5,44 @@ Some very simple functions for database handling.
 """
 
 import os
+import csv
 import sys
+import time
 import sqlite3
 import configparser
 
-import pandas as pd
+import trips
+import rollups
+import vehicles
+from utils import grid_cell_sql
 
 
 config_path = 'config.ini'
 config = configparser.ConfigParser()
 config.read(config_path)
 path = config.get('SERVICE', 'database')
+partition_dir = config.get('SERVICE', 'partitions', fallback='partitions')
+
+day_ms = 24 * 3600 * 1000
+
+# stored columns of the traffic table
+columns = 'id, vehicle, type, timestamp, longitude, lattitude, heading'
+
+
+def remove(path):
+    '''
+    Remove a database file together with the write-ahead log and shared
+    memory files left over in WAL mode, which would be applied to a new
+    database with the same name.
+    '''
+
+    for name in (path, path + '-wal', path + '-shm'):
+        if os.path.exists(name):
+            os.remove(name)
 
 
 def create():
-    if os.path.exists(path):
-        os.remove(path)
+    remove(path)
 
     conn = sqlite3.connect(path)
     cursor = conn.cursor()
@@ -34,10 +56,286 @@ def create():
             )'''
     cursor.execute(cmd)
     conn.commit()
+    migrate(conn)
 
     os.chmod(path, 0o666)
 
 
+# schema migrations, applied in order, the schema version is saved in
+# the database as user_version
+
+def migrate_1(cursor):
+    '''
+    Add a primary key, store timestamps as integer milliseconds and add
+    indexes on (uid, timestamp), (type, timestamp) and timestamp.
+
+    Row ids are never reused (AUTOINCREMENT), else new rows would get the
+    ids of the last rows deleted by partition() or ``archive.py --prune``,
+    which may be at or below the watermark of the archive, so they would
+    never be exported.
+    '''
+
+    cursor.execute('ALTER TABLE traffic RENAME TO traffic_old')
+    cmd = '''CREATE TABLE traffic (
+                id integer primary key autoincrement,
+                uid text,
+                type text,
+                timestamp integer,
+                longitude real,
+                lattitude real,
+                heading real
+            )'''
+    cursor.execute(cmd)
+    cmd = '''INSERT INTO traffic (uid, type, timestamp, longitude, lattitude, heading)
+             SELECT uid, type, CAST(round(timestamp * 1000) AS integer),
+                    longitude, lattitude, heading
+             FROM traffic_old ORDER BY timestamp'''
+    cursor.execute(cmd)
+    cursor.execute('DROP TABLE traffic_old')
+    cursor.execute('CREATE INDEX traffic_uid_timestamp ON traffic (uid, timestamp)')
+    cursor.execute('CREATE INDEX traffic_type_timestamp ON traffic (type, timestamp)')
+    cursor.execute('CREATE INDEX traffic_timestamp ON traffic (timestamp)')
+
+
+def create_indexes(cursor, schema='main'):
+    '''
+    Create indexes on the traffic table for queries by vehicle or type and
+    time.
+    '''
+
+    cursor.execute('CREATE INDEX IF NOT EXISTS %s.traffic_vehicle_timestamp '
+        'ON traffic (vehicle, timestamp)' % schema)
+    cursor.execute('CREATE INDEX IF NOT EXISTS %s.traffic_type_timestamp '
+        'ON traffic (type, timestamp)' % schema)
+    cursor.execute('CREATE INDEX IF NOT EXISTS %s.traffic_timestamp '
+        'ON traffic (timestamp)' % schema)
+
+
+def migrate_2(cursor):
+    '''
+    Add a grid cell column computed from the position, indexed together
+    with the timestamp for spatial queries.
+    '''
+
+    cursor.execute('ALTER TABLE traffic ADD COLUMN cell integer '
+        'GENERATED ALWAYS AS (%s) VIRTUAL' % grid_cell_sql)
+    create_cell_index(cursor)
+
+
+def create_cell_index(cursor, schema='main'):
+    'Create the index on grid cell and time for spatial queries.'
+
+    cursor.execute('CREATE INDEX IF NOT EXISTS %s.traffic_cell_timestamp '
+        'ON traffic (cell, timestamp)' % schema)
+
+
+def migrate_3(cursor):
+    '''
+    Add a table for watermarks of incremental exports, see archive.py.
+    '''
+
+    cursor.execute('''CREATE TABLE watermarks (
+                          name text primary key,
+                          value integer
+                      )''')
+
+
+def iter_legacy_records(cursor, order, chunk_size=100000):
+    '''
+    Yield all rows of the traffic table before version 6 as lists of
+    records in chunks, like vehicles.iter_records().
+    '''
+
+    rows = cursor.connection.execute('''SELECT uid, type, timestamp, longitude, lattitude, heading
+        FROM traffic ORDER BY %s''' % order)
+    while True:
+        records = rows.fetchmany(chunk_size)
+        if not records:
+            break
+        yield records
+
+
+def migrate_4(cursor):
+    '''
+    Add tables with per-vehicle trip aggregates, see trips.py, and fill
+    them from the existing rows.
+    '''
+
+    trips.create_tables(cursor)
+    trips.rebuild(cursor, iter_legacy_records(cursor, 'uid, timestamp'))
+
+
+def migrate_5(cursor):
+    '''
+    Add rollup tables with statistics per time bucket, type and grid cell
+    and row counts per type, see rollups.py, and fill them from the
+    existing rows.
+    '''
+
+    rollups.create_tables(cursor)
+    rollups.rebuild(cursor, iter_legacy_records(cursor, 'timestamp'))
+
+
+def migrate_6(cursor):
+    '''
+    Store every vehicle once in a vehicles table, with the UID as 16 bytes,
+    and only numbers in the traffic table: the vehicle id and a type code
+    instead of the textual UID and type, see vehicles.py.
+    '''
+
+    vehicles.create_table(cursor)
+    ids = vehicles.intern(cursor, [r[0] for r in cursor.execute('SELECT DISTINCT uid FROM traffic')])
+    cursor.execute('CREATE TEMP TABLE vehicle_ids (uid text primary key, id integer)')
+    cursor.executemany('INSERT INTO temp.vehicle_ids (uid, id) VALUES (?, ?)', ids.items())
+
+    # the sequence of row ids goes with the renamed table
+    seq = cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'traffic'").fetchone()
+    cursor.execute('ALTER TABLE traffic RENAME TO traffic_old')
+    cmd = '''CREATE TABLE traffic (
+                id integer primary key autoincrement,
+                vehicle integer,
+                type integer,
+                timestamp integer,
+                longitude real,
+                lattitude real,
+                heading real,
+                cell integer GENERATED ALWAYS AS (%s) VIRTUAL
+            )''' % grid_cell_sql
+    cursor.execute(cmd)
+    cmd = '''INSERT INTO traffic (id, vehicle, type, timestamp, longitude, lattitude, heading)
+             SELECT t.id, v.id, CASE t.type %s END, t.timestamp, t.longitude, t.lattitude, t.heading
+             FROM traffic_old t JOIN temp.vehicle_ids v ON v.uid = t.uid
+             ORDER BY t.id''' % ' '.join("WHEN '%s' THEN %d" % (t, vehicles.type_codes[t])
+        for t in vehicles.types)
+    cursor.execute(cmd)
+    if seq is not None:
+        cursor.execute("UPDATE sqlite_sequence SET seq = max(seq, ?) WHERE name = 'traffic'", seq)
+    # also drops the old indexes and triggers
+    cursor.execute('DROP TABLE traffic_old')
+    cursor.execute('DROP TABLE temp.vehicle_ids')
+    create_indexes(cursor)
+    create_cell_index(cursor)
+
+    # row counts by type code
+    cursor.execute('DROP TABLE traffic_counts')
+    cursor.execute('''CREATE TABLE traffic_counts (
+                          type integer primary key,
+                          count integer
+                      )''')
+    cursor.execute('''INSERT INTO traffic_counts (type, count)
+                      SELECT type, count(*) FROM traffic GROUP BY type''')
+    rollups.create_triggers(cursor)
+
+
+migrations = [migrate_1, migrate_2, migrate_3, migrate_4, migrate_5, migrate_6]
+
+
+def get_version(conn):
+    'Return the schema version of a database.'
+
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn=None):
+    '''
+    Apply all pending migrations, each one in its own transaction.
+    '''
+
+    conn = conn or sqlite3.connect(path)
+    version = get_version(conn)
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        for i, migration in enumerate(migrations[version:], version + 1):
+            cursor = conn.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                migration(cursor)
+                cursor.execute('PRAGMA user_version = %d' % i)
+            except:
+                cursor.execute('ROLLBACK')
+                raise
+            cursor.execute('COMMIT')
+            print('migrated database to version %d' % i)
+    finally:
+        conn.isolation_level = isolation_level
+
+
+# partitions: rows of complete days can be moved out of the traffic table
+# into one database file per day, which can be archived or simply deleted
+
+def partition_path(day):
+    'Return the path of the partition file for a day given as YYYY-MM-DD.'
+
+    return os.path.join(partition_dir, 'traffic-%s.db' % day)
+
+
+def partition(keep_days=1):
+    '''
+    Move rows older than keep_days complete days into daily partition files.
+
+    Days are UTC days. Rows are appended to existing partition files.
+    '''
+
+    keep_days = int(keep_days)
+    conn = sqlite3.connect(path)
+    conn.isolation_level = None
+    cursor = conn.cursor()
+    if not os.path.exists(partition_dir):
+        os.makedirs(partition_dir)
+    schema = cursor.execute(
+        "SELECT sql FROM sqlite_master WHERE type='table' AND name='traffic'").fetchone()[0]
+    cutoff = (int(time.time() * 1000) // day_ms - keep_days + 1) * day_ms
+    while True:
+        first = cursor.execute('SELECT min(timestamp) FROM traffic').fetchone()[0]
+        if first is None or first >= cutoff:
+            break
+        start = first // day_ms * day_ms
+        day = time.strftime('%Y-%m-%d', time.gmtime(start / 1000))
+        cursor.execute('ATTACH DATABASE ? AS part', (partition_path(day),))
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            cursor.execute(schema.replace(
+                'CREATE TABLE traffic', 'CREATE TABLE IF NOT EXISTS part.traffic', 1))
+            create_indexes(cursor, 'part')
+            create_cell_index(cursor, 'part')
+            vehicles.create_table(cursor, 'part')
+            vals = (start, start + day_ms)
+            # the generated cell column is not copied but computed again
+            cmd = 'INSERT INTO part.traffic (%s) SELECT %s FROM main.traffic ' \
+                'WHERE timestamp >= ? AND timestamp < ?' % (columns, columns)
+            cursor.execute(cmd, vals)
+            num = cursor.rowcount
+            # with the vehicles of these rows, to make the partition complete
+            cursor.execute('''INSERT OR IGNORE INTO part.vehicles (id, uid)
+                SELECT id, uid FROM main.vehicles WHERE id IN (
+                    SELECT DISTINCT vehicle FROM main.traffic
+                    WHERE timestamp >= ? AND timestamp < ?)''', vals)
+            cursor.execute('DELETE FROM main.traffic '
+                'WHERE timestamp >= ? AND timestamp < ?', vals)
+            cursor.execute('COMMIT')
+        except:
+            cursor.execute('ROLLBACK')
+            raise
+        finally:
+            cursor.execute('DETACH DATABASE part')
+        print('moved %d rows into partition "%s"' % (num, partition_path(day)))
+
+
+def list_partitions():
+    if not os.path.exists(partition_dir):
+        return
+    for name in sorted(os.listdir(partition_dir)):
+        if name.startswith('traffic-') and name.endswith('.db'):
+            print(os.path.join(partition_dir, name))
+
+
+def drop_partition(day):
+    p = partition_path(day)
+    remove(p)
+    print('removed partition "%s"' % p)
+
+
 def dump_sql():
     conn = sqlite3.connect(path)
     for line in conn.iterdump():
@@ -46,18 +344,39 @@ def dump_sql():
 
 def dump_csv():
     conn = sqlite3.connect(path)
-    cmd = 'SELECT * FROM traffic'
-    df = pd.read_sql_query(cmd, conn)
-    print(df.to_csv())
+    cmd = 'SELECT id, %s FROM traffic' % vehicles.text_columns
+    cursor = conn.execute(cmd)
+    writer = csv.writer(sys.stdout, lineterminator='\n')
+    writer.writerow(['', 'uid', 'type', 'timestamp', 'longitude', 'lattitude', 'heading'])
+    while True:
+        rows = cursor.fetchmany(5000)
+        if not rows:
+            break
+        writer.writerows(vehicles.decode(conn, rows, 1))
 
 
 def delete():
-    os.remove(path)
+    remove(path)
+
+
+def rebuild_aggregates():
+    '''
+    Compute the trip aggregates and rollups of all rows from scratch, e.g.
+    after rows were added directly, like by simulate.py with --store database.
+    '''
+
+    conn = sqlite3.connect(path, timeout=30)
+    migrate(conn)
+    with conn:
+        rollups.rebuild(conn.cursor())
+    print('aggregated trips of %d vehicles' % conn.execute(
+        'SELECT count(*) FROM trip_state').fetchone()[0])
 
 
 def show_usage():
     prog = os.path.basename(sys.argv[0])
-    print('Usage: %s create | dump_sql | dump_csv | delete' % prog)
+    print('Usage: %s create | migrate | dump_sql | dump_csv | delete | rebuild_aggregates' % prog)
+    print('       %s partition [KEEP_DAYS] | list_partitions | drop_partition YYYY-MM-DD' % prog)
     sys.exit(0)
 
 
@@ -68,11 +387,21 @@ if __name__ == '__main__':
         show_usage()
     if arg == 'create':
         create()
+    elif arg == 'migrate':
+        migrate()
     elif arg == 'dump_sql':
         dump_sql()
     elif arg == 'dump_csv':
         dump_csv()
     elif arg == 'delete':
         delete()
+    elif arg == 'rebuild_aggregates':
+        rebuild_aggregates()
+    elif arg == 'partition':
+        partition(*sys.argv[2:3])
+    elif arg == 'list_partitions':
+        list_partitions()
+    elif arg == 'drop_partition' and len(sys.argv) == 3:
+        drop_partition(sys.argv[2])
     else:
         show_usage()
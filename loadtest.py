@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+"""
+Load test for the POST /data endpoint with many concurrent emitters.
+
+All emitters run on one event loop and share one pooled aiohttp client
+session, so requests are really sent concurrently. Their positions come
+from a simulated fleet (see simulate.py). Each emitter sends one emission
+per tick, either all at the same moment at the start of a tick or spread
+randomly over the tick (--jitter). Emitters can be started gradually over
+a ramp-up period, and time can be compressed to run many ticks quickly.
+
+At the end, throughput, error counts and latency percentiles are reported,
+optionally also saved as JSON for comparing runs.
+
+Examples:
+
+    python3 loadtest.py 1000 20
+    python3 loadtest.py 1000 600 --speedup 10 --jitter --ramp 20
+"""
+
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import collections
+
+import numpy as np
+import aiohttp
+
+from simulate import Fleet, url
+
+
+class Stats(object):
+    '''
+    Latencies and errors of all requests sent.
+    '''
+
+    def __init__(self):
+        self.latencies = []
+        self.errors = collections.Counter()
+        self.start = None
+        self.end = None
+
+    def report(self):
+        'Return a dict with the results.'
+
+        lat = np.array(self.latencies) * 1000
+        num_errors = sum(self.errors.values())
+        num = len(lat) + num_errors
+        duration = self.end - self.start
+        pct = np.percentile(lat, [50, 95, 99]) if len(lat) else [0, 0, 0]
+        return dict(
+            requests=num,
+            successful=len(lat),
+            errors=num_errors,
+            error_kinds=dict(self.errors),
+            duration=duration,
+            throughput=len(lat) / duration if duration else 0,
+            latency_ms=dict(
+                p50=float(pct[0]),
+                p95=float(pct[1]),
+                p99=float(pct[2]),
+                max=float(lat.max()) if len(lat) else 0,
+            ),
+        )
+
+
+async def emit(session, url, stats, row, delay, timeout):
+    'Post one emission after some delay and record the result.'
+
+    if delay > 0:
+        await asyncio.sleep(delay)
+    keys = ['uid', 'type', 'timestamp', 'longitude', 'lattitude', 'heading']
+    data = dict(zip(keys, row))
+    start = time.perf_counter()
+    try:
+        async with session.post(url, data=data, timeout=timeout) as resp:
+            await resp.read()
+            if resp.status != 200:
+                stats.errors['HTTP %d' % resp.status] += 1
+                return
+    except asyncio.TimeoutError:
+        stats.errors['timeout'] += 1
+        return
+    except aiohttp.ClientError as e:
+        stats.errors[type(e).__name__] += 1
+        return
+    stats.latencies.append(time.perf_counter() - start)
+
+
+async def run(url, num, dur, typ=None, speedup=1, jitter=False, ramp=0,
+        connections=1000, timeout=30):
+    'Run all emitters posting to url for the given simulated duration.'
+
+    fleet = Fleet(num, typ=typ)
+    interval = fleet.update_interval / speedup
+    num_ticks = max(1, int(dur // fleet.update_interval))
+    # real time after which every emitter starts sending
+    starts = np.linspace(0, ramp, num, endpoint=False)
+
+    stats = Stats()
+    connector = aiohttp.TCPConnector(limit=connections)
+    timeout = aiohttp.ClientTimeout(total=timeout)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        loop = asyncio.get_event_loop()
+        stats.start = loop.time()
+        tasks = []
+        for tick in range(num_ticks):
+            tick_start = stats.start + tick * interval
+            await asyncio.sleep(max(0, tick_start - loop.time()))
+            active = np.flatnonzero(fleet.inside)
+            rows = fleet.step()
+            now = loop.time() - stats.start
+            tasks = [t for t in tasks if not t.done()]
+            num_sent = 0
+            for i, row in zip(active, rows):
+                if starts[i] > now:
+                    continue
+                delay = random.random() * interval if jitter else 0
+                tasks.append(asyncio.ensure_future(
+                    emit(session, url, stats, row, delay, timeout)))
+                num_sent += 1
+            print('tick %d: %d emissions' % (tick, num_sent), file=sys.stderr)
+        if tasks:
+            await asyncio.wait(tasks)
+        stats.end = loop.time()
+    return stats.report()
+
+
+def print_report(res):
+    'Print results in a human readable way.'
+
+    print('requests:   %d (%d successful, %d errors)' % (
+        res['requests'], res['successful'], res['errors']))
+    for kind, count in sorted(res['error_kinds'].items()):
+        print('  %s: %d' % (kind, count))
+    print('duration:   %.2f s' % res['duration'])
+    print('throughput: %.1f requests/s' % res['throughput'])
+    lat = res['latency_ms']
+    print('latency:    p50 %.1f ms, p95 %.1f ms, p99 %.1f ms, max %.1f ms' % (
+        lat['p50'], lat['p95'], lat['p99'], lat['max']))
+
+
+if __name__ == '__main__':
+    desc = 'Load test the API endpoint with many concurrent emitting vehicles.'
+    parser = argparse.ArgumentParser(description=desc)
+    add_arg = parser.add_argument
+    add_arg('num',
+        type=int,
+        help='Number of emitting vehicles.')
+    add_arg('dur',
+        type=float,
+        help='Simulated duration in seconds (one tick every 20 seconds).')
+    add_arg('--url',
+        default=url,
+        help='URL of the endpoint (default: "%s").' % url)
+    add_arg('--type',
+        default=None, metavar='TYPE',
+        choices=Fleet.allowed_types,
+        help='Vehicle type to use for all vehicles (default: random types).')
+    add_arg('--speedup',
+        type=float, default=1,
+        help='Time compression factor, e.g. 10 runs a tick every 2 seconds.')
+    add_arg('--jitter',
+        action='store_true',
+        help='Spread emissions randomly over each tick instead of sending '
+            'them all at the start of a tick.')
+    add_arg('--ramp',
+        type=float, default=0, metavar='SECONDS',
+        help='Start emitters gradually over this number of real seconds.')
+    add_arg('--connections',
+        type=int, default=1000,
+        help='Maximum number of pooled connections (default: 1000).')
+    add_arg('--timeout',
+        type=float, default=30,
+        help='Timeout per request in seconds (default: 30).')
+    add_arg('--json',
+        metavar='PATH',
+        help='Also save the results as JSON in this file.')
+
+    args = parser.parse_args()
+    res = asyncio.run(run(args.url, args.num, args.dur, args.type, args.speedup,
+        args.jitter, args.ramp, args.connections, args.timeout))
+    print_report(res)
+    if args.json:
+        json.dump(res, open(args.json, 'w'), indent=2)
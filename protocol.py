@@ -0,0 +1,84 @@
+"""
+Compact binary format of emissions, as sent in UDP datagrams.
+
+Every emission is a fixed-size record of 35 bytes, all numbers little
+endian and without padding:
+
+    ======  =======  ==============================================
+    offset  type     content
+    ======  =======  ==============================================
+    0       16 byte  vehicle UID (UUID bytes in network order)
+    16      uint8    vehicle type code, see type_codes
+    17      float64  timestamp in seconds since the epoch
+    25      float32  lattitude in degrees
+    29      float32  longitude in degrees
+    33      uint16   heading in hundredths of a degree
+    ======  =======  ==============================================
+
+A datagram contains one or more records (up to records_per_datagram to
+stay below a common MTU). float32 positions have a resolution of less
+than a meter, which is enough for GPS data.
+"""
+
+import uuid
+import struct
+
+import numpy as np
+
+
+# the codes are part of the format and must never change
+type_codes = dict(bus=0, car=1, taxi=2, train=3, tram=4)
+types = sorted(type_codes, key=type_codes.get)
+
+# timestamps accepted, from the epoch to the start of 2100 (in seconds)
+min_timestamp, max_timestamp = 0.0, 4102444800.0
+
+record = struct.Struct('<16sBdffH')
+record_size = record.size
+records_per_datagram = 40
+
+dtype = np.dtype([
+    ('uid', 'V16'),
+    ('type', 'u1'),
+    ('timestamp', '<f8'),
+    ('lattitude', '<f4'),
+    ('longitude', '<f4'),
+    ('heading', '<u2'),
+])
+assert dtype.itemsize == record_size
+
+
+def encode(rows):
+    '''
+    Encode rows like returned by parse_emission() as concatenated records.
+    '''
+
+    return b''.join(record.pack(uuid.UUID(uid).bytes, type_codes[typ],
+            ts, lat, lon, int(round(heading * 100)) % 36000)
+        for (uid, typ, ts, lon, lat, heading) in rows)
+
+
+def decode(data):
+    '''
+    Decode concatenated records into rows like returned by parse_emission().
+
+    All records are decoded at once with NumPy. Records with an unknown
+    type, a position out of range or an invalid timestamp are skipped.
+    Returns the list of rows and the number of invalid records.
+    '''
+
+    arr = np.frombuffer(data, dtype=dtype)
+    lat = arr['lattitude'].astype(float)
+    lon = arr['longitude'].astype(float)
+    ts = arr['timestamp']
+    valid = (arr['type'] < len(types)) & (ts >= min_timestamp) & (ts < max_timestamp) \
+        & (np.abs(lat) <= 90) & (np.abs(lon) <= 180)
+    if not valid.all():
+        arr, lat, lon, ts = arr[valid], lat[valid], lon[valid], ts[valid]
+
+    uids = arr['uid'].tobytes()
+    uids = [str(uuid.UUID(bytes=uids[i:i + 16])) for i in range(0, len(uids), 16)]
+    typs = [types[code] for code in arr['type'].tolist()]
+    heading = arr['heading'] / 100.0 % 360
+    rows = list(zip(uids, typs, ts.tolist(), lon.tolist(), lat.tolist(), heading.tolist()))
+    return rows, len(valid) - len(rows)
@@ -0,0 +1,137 @@
+"""
+Rendering of maps with static base layers drawn only once.
+
+The base layers of every map (coastlines, countries, Berlin roads, BVG
+stops) are drawn once per process into an off-screen figure and kept as a
+raster background. Rendering a map then only restores that background and
+draws the vehicle positions on top with one scatter call, and returns the
+result as PNG data.
+
+This module does not depend on the web application, so maps can also be
+rendered in separate worker processes.
+"""
+
+import io
+import os
+import json
+import threading
+
+import numpy as np
+import matplotlib
+
+# Force matplotlib to not use any Xwindows backend.
+matplotlib.use('Agg')
+
+import matplotlib.image
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+
+stops_path = 'geo/stops_berlin.geojson'
+roads_path = 'geo/berlin/roads'
+
+# city center shown on the traffic map
+center_lon, center_lat = 13.383333, 52.516667
+
+
+def load_stops():
+    'Return the longitudes and lattitudes of all BVG stops as arrays.'
+
+    path = os.path.join(os.getcwd(), stops_path)
+    js = json.load(open(path))
+    lonlats = np.array([f['geometry']['coordinates'] for f in js['features']])
+    return lonlats[:, 0], lonlats[:, 1]
+
+
+class MapRenderer(object):
+    '''
+    Map with a cached base, to draw points on.
+
+    The draw_base function gets a Basemap instance and draws all static
+    layers with it. Rendering is serialized with a lock, since a figure
+    must not be drawn by several threads at once.
+    '''
+
+    def __init__(self, draw_base, figsize=(25, 10), **basemap_args):
+        from mpl_toolkits.basemap import Basemap
+
+        self.lock = threading.Lock()
+        self.fig = Figure(figsize=figsize)
+        self.canvas = FigureCanvasAgg(self.fig)
+        self.ax = self.fig.add_subplot(1, 1, 1)
+        self.map = Basemap(ax=self.ax, **basemap_args)
+        draw_base(self.map)
+        # points drawn later must not change the extent of the map
+        self.ax.set_autoscale_on(False)
+        self.canvas.draw()
+        self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+
+    def render(self, lons=(), lats=(), **style):
+        '''
+        Return the map with points at the given positions as PNG data.
+
+        Style arguments are passed to scatter(), e.g. color and s (size).
+        '''
+
+        with self.lock:
+            self.canvas.restore_region(self.background)
+            if len(lons):
+                x, y = self.map(np.asarray(lons), np.asarray(lats))
+                points = self.ax.scatter(x, y, **style)
+                self.ax.draw_artist(points)
+                points.remove()
+            rgba = np.array(self.canvas.buffer_rgba())
+        out = io.BytesIO()
+        matplotlib.image.imsave(out, rgba, format='png')
+        return out.getvalue()
+
+
+def berlin_map(draw_stops=False):
+    'Create a renderer for a Berlin map covering all BVG stops.'
+
+    stop_lons, stop_lats = load_stops()
+
+    def draw_base(map):
+        map.drawmapboundary(fill_color='#aaddff')
+        map.fillcontinents(color='#dddddd', lake_color='#aaddff')
+        map.drawcountries()
+        map.drawcoastlines()
+        map.readshapefile(roads_path, 'berlin')
+        if draw_stops:
+            map.scatter(stop_lons, stop_lats, latlon=True, s=9, c='r', marker='o')
+        else:
+            map.scatter([center_lon], [center_lat], latlon=True, s=400, c='b', marker='o')
+
+    return MapRenderer(draw_base, projection='mill', resolution='c',
+        llcrnrlat=stop_lats.min(), urcrnrlat=stop_lats.max(),
+        llcrnrlon=stop_lons.min(), urcrnrlon=stop_lons.max())
+
+
+def world_map():
+    'Create a renderer for a simple world map.'
+
+    return MapRenderer(lambda map: map.drawcoastlines(), figsize=(8, 6))
+
+
+# renderers of this process, created when first used
+map_factories = dict(
+    traffic=berlin_map,
+    berlin_bvg=lambda: berlin_map(draw_stops=True),
+    world=world_map,
+)
+renderers = {}
+renderers_lock = threading.Lock()
+
+
+def render_map(name, lons=(), lats=()):
+    '''
+    Render one of the maps named in map_factories and return PNG data.
+
+    Vehicle positions are drawn as red points.
+    '''
+
+    with renderers_lock:
+        if name not in renderers:
+            renderers[name] = map_factories[name]()
+        renderer = renderers[name]
+    return renderer.render(lons, lats, s=100, c='r', marker='o', zorder=10)
@@ -0,0 +1,224 @@
+"""
+Pre-aggregated fleet statistics per time bucket, vehicle type and grid cell.
+
+Every batch of rows written into the traffic table is also added to the
+rollups table, in the same transaction, for buckets of one minute and of
+one hour (the period, in seconds). For every bucket, type and grid cell
+(see utils.grid_cell) it contains:
+
+    ==========  ===================================================
+    count       number of emissions
+    vehicles    number of distinct vehicles
+    heading_x   sum of the cosines of all headings
+    heading_y   sum of the sines of all headings
+    speed_sum   sum of the speeds (in m/s) computed by trips.py
+    speeds      number of emissions with a speed
+    ==========  ===================================================
+
+Rows with a cell of -1 aggregate all cells of a bucket and type, so their
+number of vehicles is exact, where summing those of several cells counts
+vehicles seen in more than one cell several times.
+
+To count distinct vehicles, the vehicles and their types seen in the current
+and previous bucket of every period are kept in the rollup_vehicles table. Emissions
+arriving later than that count their vehicles again.
+
+The traffic_counts table holds the number of rows per type code in the
+traffic table, maintained by triggers, so it is also correct after partitioning
+or pruning the traffic table, while the rollups keep all data ever stored.
+"""
+
+import math
+
+import trips
+import vehicles
+from utils import grid_cell
+
+
+# length of the buckets in seconds
+periods = dict(minute=60, hour=3600)
+
+# rows of rollups with the sums of all cells
+all_cells = -1
+
+
+def create_tables(cursor):
+    'Create tables and triggers for rollups (called by a database migration).'
+
+    cursor.execute('''CREATE TABLE rollups (
+                          period integer,
+                          bucket integer,
+                          type text,
+                          cell integer,
+                          count integer,
+                          vehicles integer,
+                          heading_x real,
+                          heading_y real,
+                          speed_sum real,
+                          speeds integer,
+                          primary key (period, bucket, type, cell)
+                      ) WITHOUT ROWID''')
+    cursor.execute('''CREATE TABLE rollup_vehicles (
+                          period integer,
+                          bucket integer,
+                          cell integer,
+                          uid text,
+                          type text,
+                          primary key (period, bucket, cell, uid, type)
+                      ) WITHOUT ROWID''')
+    cursor.execute('''CREATE TABLE traffic_counts (
+                          type text primary key,
+                          count integer
+                      )''')
+    cursor.execute('''INSERT INTO traffic_counts (type, count)
+                      SELECT type, count(*) FROM traffic GROUP BY type''')
+    create_triggers(cursor)
+
+
+def create_triggers(cursor):
+    'Create the triggers counting the rows of the traffic table by type.'
+
+    cursor.execute('''CREATE TRIGGER traffic_count_insert AFTER INSERT ON traffic
+                      BEGIN
+                          INSERT INTO traffic_counts (type, count) VALUES (NEW.type, 1)
+                          ON CONFLICT (type) DO UPDATE SET count = count + 1;
+                      END''')
+    cursor.execute('''CREATE TRIGGER traffic_count_delete AFTER DELETE ON traffic
+                      BEGIN
+                          UPDATE traffic_counts SET count = count - 1 WHERE type = OLD.type;
+                      END''')
+
+
+def rebuild(cursor, chunks=None):
+    '''
+    Compute the trip aggregates and rollups of all rows from scratch.
+
+    The rows are read as chunks of records ordered by time, by default
+    with vehicles.iter_records().
+    '''
+
+    for table in ['trip_state', 'trip_stats', 'rollups', 'rollup_vehicles']:
+        cursor.execute('DELETE FROM %s' % table)
+    if chunks is None:
+        chunks = vehicles.iter_records(cursor.connection, 'timestamp')
+    for records in chunks:
+        aggregate(cursor, records)
+
+
+def aggregate(cursor, records):
+    '''
+    Add records to the trip aggregates and the rollups, used as ingest hook.
+    '''
+
+    # rows without a valid position would make distances and speeds NaN
+    located = [r for r in records if math.isfinite(r[3]) and math.isfinite(r[4])]
+    update(cursor, records, trips.update(cursor, located))
+
+
+def update(cursor, records, speeds=None):
+    '''
+    Add records of the traffic table to the rollups.
+
+    Records are tuples of uid, type, timestamp (in milliseconds), longitude,
+    lattitude and heading. Speeds are given as a dict by uid and timestamp,
+    like returned by trips.update(). This must be called in the same
+    transaction as inserting the records.
+    '''
+
+    speeds = speeds or {}
+    sums, seen = {}, set()
+    for uid, typ, ts, lon, lat, heading in records:
+        # a row without a valid position only counts for all cells, one
+        # without a valid heading not for the average heading, as a single
+        # NaN would spoil the sums of the bucket for good
+        if math.isfinite(lat) and math.isfinite(lon):
+            cells = (grid_cell(lat, lon), all_cells)
+        else:
+            cells = (all_cells,)
+        rad = math.radians(heading) if math.isfinite(heading) else None
+        speed = speeds.get((uid, ts))
+        for period in periods.values():
+            bucket = ts - ts % (period * 1000)
+            for c in cells:
+                key = (period, bucket, typ, c)
+                s = sums.get(key)
+                if s is None:
+                    s = sums[key] = [0, 0, 0.0, 0.0, 0.0, 0]
+                s[0] += 1
+                if rad is not None:
+                    s[2] += math.cos(rad)
+                    s[3] += math.sin(rad)
+                if speed is not None:
+                    s[4] += speed
+                    s[5] += 1
+                seen.add((period, bucket, c, uid, typ))
+
+    # count the vehicles not seen before in a bucket, cell and type, which
+    # are the ones returned as inserted
+    keys = list(seen)
+    for i in range(0, len(keys), 1000):
+        chunk = keys[i:i + 1000]
+        cmd = '''INSERT OR IGNORE INTO rollup_vehicles (period, bucket, cell, uid, type)
+                 VALUES %s RETURNING period, bucket, cell, type''' % ', '.join(
+            ['(?, ?, ?, ?, ?)'] * len(chunk))
+        for period, bucket, c, typ in cursor.execute(cmd, [x for key in chunk for x in key]).fetchall():
+            sums[period, bucket, typ, c][1] += 1
+
+    cursor.executemany('''INSERT INTO rollups
+        (period, bucket, type, cell, count, vehicles, heading_x, heading_y, speed_sum, speeds)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (period, bucket, type, cell) DO UPDATE SET %s''' % ', '.join(
+            '%s = %s + excluded.%s' % (c, c, c) for c in
+            ['count', 'vehicles', 'heading_x', 'heading_y', 'speed_sum', 'speeds']),
+        [key + tuple(s) for key, s in sums.items()])
+
+    # forget the vehicles of buckets before the previous one
+    newest = max(r[2] for r in records)
+    for period in periods.values():
+        cutoff = newest - newest % (period * 1000) - period * 1000
+        cursor.execute('DELETE FROM rollup_vehicles WHERE period = ? AND bucket < ?',
+            (period, cutoff))
+
+
+def totals(conn):
+    'Return the number of rows in the traffic table per type as a dict.'
+
+    return dict((vehicles.types[code], count) for code, count in
+        conn.execute('SELECT type, count FROM traffic_counts WHERE count > 0'))
+
+
+def summary(conn, period, criteria, by_type=False, cells=None):
+    '''
+    Return rollups over time as a list of dicts.
+
+    The period is the name of a period in periods. Criteria are like for
+    build_where_clause(), on the columns type and bucket (in milliseconds).
+    With by_type, the rollups are grouped by type too. If cells are given,
+    the rollups of these grid cells are returned, grouped by cell too, else
+    those of all cells. Timestamps in the result are in seconds, headings
+    in degrees and speeds in m/s.
+    '''
+
+    if period not in periods:
+        raise ValueError('period must be one of: %s' % ', '.join(periods))
+    criteria = [('period', '=', periods[period])] + [
+        (k, op, v) for (k, op, v) in criteria if v is not None]
+    where = ' AND '.join('%s%s?' % (k, op) for (k, op, v) in criteria)
+    if cells is None:
+        where += ' AND cell = %d' % all_cells
+    else:
+        where += ' AND cell IN (%s)' % ', '.join(map(str, cells))
+    group = ['bucket'] + (['type'] if by_type else []) + (['cell'] if cells is not None else [])
+    cmd = '''SELECT %s, sum(count), sum(vehicles), sum(heading_x), sum(heading_y),
+                    sum(speed_sum), sum(speeds)
+             FROM rollups WHERE %s GROUP BY %s ORDER BY %s''' % (
+        ', '.join(group), where, ', '.join(group), ', '.join(group))
+    result = []
+    for row in conn.execute(cmd, [v for (k, op, v) in criteria]):
+        res = dict(zip(group, row))
+        count, vehicles, hx, hy, speed_sum, num_speeds = row[len(group):]
+        res.update(bucket=res['bucket'] / 1000.0, count=count, vehicles=vehicles,
+            avg_heading=math.degrees(math.atan2(hy, hx)) % 360,
+            avg_speed=speed_sum / num_speeds if num_speeds else None)
+        result.append(res)
+    return result
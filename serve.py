@@ -1,12 +1,38 @@
+import os
+import sys
+import signal
 import configparser
 
-from app import app
-
 
 config_path = 'config.ini'
 config = configparser.ConfigParser()
 config.read(config_path)
 debug = config.getboolean('SERVICE', 'debug')
 port = config.getint('SERVICE', 'port')
+server = config.get('SERVICE', 'server', fallback='flask')
+udp_port = config.getint('SERVICE', 'udp_port', fallback=0)
+
+# guarded, since worker processes rendering maps import this module again
+if __name__ == '__main__':
+    if server == 'aiohttp':
+        import serve_aiohttp
+        serve_aiohttp.main(port)
+    elif server == 'multi':
+        import serve_multi
+        serve_multi.main(port)
+    elif server == 'flask':
+        from app import app, buffer, pipeline, udp
+
+        # with the reloader, the server runs in a child process
+        if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+            # replays the journal left over, if enabled
+            buffer.start()
+            udp.start(pipeline, udp_port)
+
+        # turn SIGTERM into a normal exit, so pending rows are flushed (atexit)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
 
-app.run(debug=debug, host='0.0.0.0', port=port)
+        app.run(debug=debug, host='0.0.0.0', port=port)
+    else:
+        print('Unknown server "%s" in file "%s", use "flask", "aiohttp" or "multi".' % (server, config_path))
+        sys.exit(1)
@@ -1,18 +1,471 @@
 #!/usr/bin/env python
 
 """
-Minimal example for running an async web server using aiohttp.
+Asynchronous implementation of the microservice using aiohttp.
 
-Code taken from here:
-http://aiohttp.readthedocs.io/en/stable/web.html
+All requests are handled by coroutines on one event loop. Posted data is
+handed over to the ingest buffer, whose writer thread owns the database
+connection used for writing, and queries are run in a thread pool with
+pooled read-only connections, so the event loop never blocks on SQLite.
+
+This serves the same database (created with ``database.py create``) as the
+Flask implementation and can be started directly or via ``serve.py`` when
+``server = aiohttp`` is set in the SERVICE section of ``config.ini``:
+
+    python3 serve_aiohttp.py
 """
 
+import os
+import time
+import asyncio
+import concurrent.futures
+
 from aiohttp import web
 
-async def hello(request):
-    return web.Response(body=b"Hello, world")
+from app import config, readers, buffer, boundary, pipeline, positions, blueprints, udp, \
+    metrics
+from app.ingest import parse_emission, parse_batch, submit_batch, fields
+from app.positions import positions_query
+# the trip aggregates and rollups are updated on ingest, so always loaded
+import rollups
+
+
+executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=config.getint('SQLITE', 'readers', fallback=4))
+# for sinks that may block, separate from the queries to not wait for them
+submitter = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+
+
+def run_query(func, *args):
+    'Run a blocking database function in the executor.'
+
+    loop = asyncio.get_event_loop()
+    return loop.run_in_executor(executor, func, *args)
+
+
+async def submit(func, *args):
+    '''
+    Run a function submitting rows to the pipeline, in a thread if the sink
+    may block (like appending to the journal), else right away.
+    '''
+
+    if pipeline.sink.blocking:
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(submitter, func, *args)
+    return func(*args)
+
+
+def get_totals():
+    with readers.connection() as conn:
+        return rollups.totals(conn)
+
+
+@web.middleware
+async def observe_request(request, handler):
+    'Record the count, status and latency of every request in the metrics.'
+
+    start = time.perf_counter()
+    status = 500
+    try:
+        resp = await handler(request)
+        status = resp.status
+        return resp
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        route = request.match_info.route.resource
+        endpoint = route.canonical if route is not None else 'other'
+        metrics.observe_request(endpoint, status, time.perf_counter() - start)
+
+
+@web.middleware
+async def profile_request(request, handler):
+    'Profile requests if enabled, added with the profiler blueprint.'
+
+    from app.profiling import profiler
+
+    if not profiler.enabled:
+        return await handler(request)
+    route = request.match_info.route.resource
+    # the event loop thread is shared, so all threads are sampled
+    profile = profiler.start(route.canonical if route is not None else 'other', all_threads=True)
+    try:
+        return await handler(request)
+    finally:
+        if profile is not None:
+            profiler.stop(profile)
+
+
+# desired API endpoint
+
+async def post_data(request):
+    'Post vehicle data and store into a database.'
+
+    start = time.perf_counter()
+    data = await request.post()
+    parsed = time.perf_counter()
+    try:
+        row = parse_emission(data)
+    except ValueError as e:
+        raise web.HTTPBadRequest(text=str(e))
+    validated = time.perf_counter()
+    try:
+        reason, = await submit(pipeline.submit, [row])
+    except RuntimeError as e:
+        # the writer process is busy, see WriterSink
+        raise web.HTTPServiceUnavailable(text=str(e))
+    metrics.observe_phases(parse=parsed - start, validate=validated - parsed,
+        submit=time.perf_counter() - validated)
+    if reason is not None:
+        return web.Response(text='ignored')
+    return web.Response(text='saved')
+
+
+async def post_data_batch(request):
+    'Post many emissions at once, see the Flask implementation for details.'
+
+    try:
+        items = parse_batch(await request.text())
+    except ValueError as e:
+        raise web.HTTPBadRequest(text='Invalid JSON: %s' % e)
+    try:
+        return web.json_response(await submit(submit_batch, pipeline, items))
+    except RuntimeError as e:
+        raise web.HTTPServiceUnavailable(text=str(e))
+
+
+# additional endpoints
+
+async def get_simple(request):
+    # This is only for benchmarking the simplest GET endpoint.
+
+    return web.Response(text='done')
+
+
+async def get_num_data(request):
+    'Return number of data points.'
+
+    totals = await run_query(get_totals)
+    return web.Response(text=str(sum(totals.values())))
+
+
+async def get_ingest_stats(request):
+    'Return ingest buffer and boundary filter statistics as JSON.'
+
+    # with serve_multi.py the sink has the statistics of the writer process,
+    # including its boundary
+    stats = dict(boundary.stats(), **pipeline.sink.stats())
+    if udp.listener is not None:
+        stats.update(udp.listener.stats())
+    return web.json_response(stats)
+
+
+async def get_metrics(request):
+    'Return request and ingest metrics in the Prometheus text format.'
+
+    return web.Response(body=metrics.registry.render().encode(),
+        headers={'Content-Type': metrics.content_type})
+
+
+async def get_vehicles_current(request):
+    'Return the latest position of every vehicle as JSON.'
+
+    try:
+        typ, box = positions_query(request.query)
+    except ValueError as e:
+        raise web.HTTPNotFound(text=str(e))
+    vehicles = positions.snapshot(typ, box)
+    return web.json_response(dict(count=len(vehicles), vehicles=vehicles))
+
+
+async def search(request):
+    'Run an area search in the executor and return the result as JSON.'
+
+    from app.queries import search_area
+
+    try:
+        result = await run_query(search_area, request.query)
+    except ValueError as e:
+        raise web.HTTPNotFound(text=str(e))
+    return web.json_response(result)
+
+
+async def get_vehicles_near(request):
+    'Return emissions within a radius around a position as JSON.'
+
+    if request.query.get('bbox', None):
+        raise web.HTTPNotFound(text='Use /vehicles/within to search a bounding box.')
+    return await search(request)
+
+
+async def get_vehicles_within(request):
+    'Return emissions inside a bounding box as JSON.'
+
+    if not request.query.get('bbox', None):
+        raise web.HTTPNotFound(text='bbox=min_lon,min_lat,max_lon,max_lat is needed.')
+    return await search(request)
+
+
+async def get_trips(request):
+    'Return trip aggregates per type, or of one vehicle, by time bucket as JSON.'
+
+    from app.queries import trip_summary
+
+    uid = request.match_info.get('uid', None)
+    try:
+        result = await run_query(trip_summary, request.query, uid)
+    except ValueError as e:
+        raise web.HTTPNotFound(text=str(e))
+    return web.json_response(result)
+
+
+async def get_stats(request):
+    'Return fleet statistics per time bucket as JSON, read from the rollups.'
+
+    from app.queries import rollup_summary
+
+    try:
+        result = await run_query(rollup_summary, request.query)
+    except ValueError as e:
+        raise web.HTTPNotFound(text=str(e))
+    return web.json_response(result)
+
+
+async def get_stats_totals(request):
+    'Return the number of rows in the database per vehicle type as JSON.'
+
+    return web.json_response(await run_query(get_totals))
+
+
+async def get_live(request):
+    'Stream the positions of vehicles as server-sent events.'
+
+    from app import live
+
+    loop = asyncio.get_event_loop()
+    ready = asyncio.Event()
+    try:
+        subscriber = live.Subscriber(live.parse_filter(request.query),
+            notify=lambda: loop.call_soon_threadsafe(ready.set))
+        live.broadcaster.subscribe(subscriber)
+    except ValueError as e:
+        raise web.HTTPNotFound(text=str(e))
+    except RuntimeError as e:
+        raise web.HTTPServiceUnavailable(text=str(e))
+
+    resp = web.StreamResponse(headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    resp.content_type = 'text/event-stream'
+    try:
+        await resp.prepare(request)
+        while True:
+            ready.clear()
+            messages = subscriber.take()
+            if not messages:
+                try:
+                    await asyncio.wait_for(ready.wait(), live.keepalive)
+                    continue
+                except asyncio.TimeoutError:
+                    messages = [b': keepalive\n\n']
+            await resp.write(b''.join(messages))
+    finally:
+        live.broadcaster.unsubscribe(subscriber)
+    return resp
+
+
+async def get_data_csv(request):
+    'Download traffic data matching some criteria, streamed as a CSV file.'
+
+    from app.export import iter_csv, decode_rows
+    from app.queries import traffic_query
+
+    try:
+        cmd, params = traffic_query(request.query)
+    except ValueError as e:
+        raise web.HTTPNotFound(text=str(e))
+
+    compress = 'gzip' in request.headers.get('Accept-Encoding', '')
+    chunks = iter_csv(readers, cmd, params, header=[''] + fields, compress=compress,
+        convert=decode_rows)
+    resp = web.StreamResponse(headers={'Vary': 'Accept-Encoding'})
+    resp.content_type = 'text/csv'
+    if compress:
+        resp.headers['Content-Encoding'] = 'gzip'
+    await resp.prepare(request)
+    try:
+        # chunks are read from the database in the executor, one by one
+        while True:
+            chunk = await run_query(next, chunks, None)
+            if chunk is None:
+                break
+            await resp.write(chunk)
+    finally:
+        await run_query(chunks.close)
+    await resp.write_eof()
+    return resp
+
+
+async def profiler_settings(request):
+    'Return the profiler settings and profiles as JSON, changed first with POST.'
+
+    from app.profiling import profiler, parse_settings
+
+    if request.method == 'POST':
+        args = dict(request.query)
+        args.update(await request.post())
+        try:
+            profiler.configure(**parse_settings(args))
+        except ValueError as e:
+            raise web.HTTPBadRequest(text=str(e))
+    return web.json_response(dict(profiler.settings(),
+        profiles=[p.info() for p in profiler.profiles]))
+
+
+async def get_profiles(request):
+    'Return the stacks of all profiles kept, or of one endpoint, collapsed.'
+
+    from app.profiling import profiler
+
+    return web.Response(text=profiler.merged(request.query.get('endpoint', None)))
+
+
+async def get_profile(request):
+    'Return the stacks of one profile collapsed.'
+
+    from app.profiling import profiler
+
+    try:
+        return web.Response(text=profiler.get(int(request.match_info['id'])).collapsed())
+    except KeyError:
+        raise web.HTTPNotFound(text='No profile %s.' % request.match_info['id'])
+
+
+async def post_archive(request):
+    'Export all rows added since the last export into the columnar archive.'
+
+    from app.export import export_archive
+
+    return web.json_response(await run_query(export_archive))
+
+
+async def get_archive(request):
+    'Return the list of archive files as JSON.'
+
+    import archive
+
+    return web.json_response(archive.list_files())
+
+
+async def get_archive_file(request):
+    'Download an archive file.'
+
+    import archive
+
+    root = os.path.abspath(archive.archive_dir)
+    path = os.path.abspath(os.path.join(root, request.match_info['name']))
+    if not path.startswith(root + os.sep) or not os.path.isfile(path):
+        raise web.HTTPNotFound()
+    return web.FileResponse(path)
+
+
+def traffic_positions(uid):
+    from app.queries import build_where_clause, vehicle_id
+
+    cmd = "SELECT longitude, lattitude FROM traffic "
+    where_clause, params = build_where_clause([('vehicle', '=', vehicle_id(uid))])
+    with readers.connection() as conn:
+        return conn.execute(cmd + where_clause, params).fetchall()
+
+
+async def get_map(key, name, fetch=None):
+    'Return PNG data of a map from the cache or rendered in the background.'
+
+    from app import maps
+
+    png = maps.cache.get(key)
+    if png is None:
+        data = await run_query(fetch) if fetch else []
+        png = await asyncio.wrap_future(maps.submit(name, *maps.positions(data)))
+        maps.cache.put(key, png)
+    return web.Response(body=png, content_type='image/png')
+
+
+async def get_map_traffic(request):
+    'Show a map with all locations of all (or only one) vehicles.'
+
+    from app.queries import last_row_id
+
+    uid = request.query.get('uid', None) or None
+    # maps are cached until new rows are written, by any process
+    key = ('traffic', uid, await run_query(last_row_id))
+    return await get_map(key, 'traffic', lambda: traffic_positions(uid))
+
+
+async def get_map_world(request):
+    return await get_map('world', 'world')
+
+
+async def get_map_berlin_bvg(request):
+    return await get_map('berlin_bvg', 'berlin_bvg')
+
+
+def make_app():
+    'Create the aiohttp application with all routes.'
+
+    middlewares = [observe_request]
+    if 'profiler' in blueprints:
+        middlewares.append(profile_request)
+    app = web.Application(middlewares=middlewares)
+    app.router.add_route('POST', '/data', post_data)
+    app.router.add_route('POST', '/data/batch', post_data_batch)
+    app.router.add_route('GET', '/simple', get_simple)
+    app.router.add_route('GET', '/num_data', get_num_data)
+    app.router.add_route('GET', '/ingest/stats', get_ingest_stats)
+    app.router.add_route('GET', '/metrics', get_metrics)
+    app.router.add_route('GET', '/vehicles/current', get_vehicles_current)
+    # optional subsystems like in the Flask implementation
+    if 'export' in blueprints:
+        app.router.add_route('GET', '/vehicles/near', get_vehicles_near)
+        app.router.add_route('GET', '/vehicles/within', get_vehicles_within)
+        app.router.add_route('GET', '/trips', get_trips)
+        app.router.add_route('GET', '/trips/{uid}', get_trips)
+        app.router.add_route('GET', '/stats', get_stats)
+        app.router.add_route('GET', '/stats/totals', get_stats_totals)
+        app.router.add_route('GET', '/data.csv', get_data_csv)
+        app.router.add_route('POST', '/archive', post_archive)
+        app.router.add_route('GET', '/archive', get_archive)
+        app.router.add_route('GET', '/archive/{name:.+}', get_archive_file)
+    if 'live' in blueprints:
+        app.router.add_route('GET', '/live', get_live)
+    if 'profiler' in blueprints:
+        app.router.add_route('GET', '/profiler', profiler_settings)
+        app.router.add_route('POST', '/profiler', profiler_settings)
+        app.router.add_route('GET', '/profiler/profiles', get_profiles)
+        app.router.add_route('GET', r'/profiler/profiles/{id:\d+}', get_profile)
+    if 'maps' in blueprints:
+        app.router.add_route('GET', '/map/traffic', get_map_traffic)
+        app.router.add_route('GET', '/map/world', get_map_world)
+        app.router.add_route('GET', '/map/berlin/bvg', get_map_berlin_bvg)
+    return app
+
+
+def main(port=None, sock=None):
+    '''
+    Run the service on a port or on an already listening socket.
+    '''
+
+    port = port or config.getint('SERVICE', 'port')
+    if sock is not None:
+        # a worker of serve_multi.py, where the writer process listens for UDP
+        web.run_app(make_app(), sock=sock, print=None)
+    else:
+        # replays the journal left over, if enabled
+        buffer.start()
+        udp.start(pipeline, config.getint('SERVICE', 'udp_port', fallback=0))
+        web.run_app(make_app(), host='0.0.0.0', port=port, backlog=2048)
+        udp.stop()
+    buffer.close()
 
-app = web.Application()
-app.router.add_route('GET', '/', hello)
 
-web.run_app(app)
+if __name__ == '__main__':
+    main()
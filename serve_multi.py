@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+
+"""
+Multi-process implementation of the microservice.
+
+A number of worker processes accept connections on one shared listening
+socket and run the aiohttp implementation of the service (see
+serve_aiohttp.py), parsing and validating requests in parallel on all
+cores. Instead of checking and storing emissions themselves, they submit
+the valid rows over a bounded multiprocessing queue to a single writer
+process, which runs them through the pipeline (see app.ingest.WriterSink),
+owns the only writing database connection and stores them in batches with
+its ingest buffer (or journal), before the worker answers the request.
+
+The state of the pipeline is kept in the writer process or passed on to
+all workers: the city boundary, and so the vehicles that have exited it,
+is checked there, and the rows it accepts from any worker or via UDP are
+sent to all other workers every publish_interval seconds, which keep the
+latest positions and serve the live feed from them. So all workers serve
+the same positions, only up to publish_interval later than the worker
+that received them, which sees them right away.
+
+The number of workers and the size of the queue (in requests) are set with
+``workers`` and ``queue_size`` in the SERVICE section of ``config.ini``.
+This is used by ``serve.py`` when ``server = multi`` is set, and can also
+be started directly:
+
+    python3 serve_multi.py
+"""
+
+import os
+import sys
+import time
+import signal
+import socket
+import threading
+import traceback
+import configparser
+import multiprocessing
+
+
+config_path = 'config.ini'
+config = configparser.ConfigParser()
+config.read(config_path)
+
+
+class Publisher(object):
+    '''
+    Passes the rows accepted by the writer process on to the workers, and
+    its statistics and metrics, every interval seconds.
+
+    Rows are put with the index of the worker they came from, which has
+    already seen them, or None for rows received via UDP.
+    '''
+
+    def __init__(self, replies, stats, metrics, interval=0.05, stats_interval=1.0):
+        self.replies = replies
+        self.stats = stats
+        self.metrics = metrics
+        self.interval = interval
+        self.stats_interval = stats_interval
+        self.rows = []
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, name='publisher')
+        self.thread.daemon = True
+
+    def put(self, rows, worker=None):
+        with self.lock:
+            self.rows.extend((worker, row) for row in rows)
+
+    def run(self):
+        'Main loop of the publishing thread.'
+
+        published = 0.0
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                rows, self.rows = self.rows, []
+            if rows:
+                for i, replies in enumerate(self.replies):
+                    selected = [row for (worker, row) in rows if worker != i]
+                    if selected:
+                        replies.put(('rows', selected))
+            if time.time() - published >= self.stats_interval:
+                stats, metrics = self.stats(), self.metrics()
+                for replies in self.replies:
+                    replies.put(('stats', stats))
+                    replies.put(('metrics', metrics))
+                published = time.time()
+
+
+def run_writer(requests, replies, ready):
+    '''
+    Run the rows submitted by the workers through the pipeline and reply
+    with the reasons, until None is received.
+    '''
+
+    # shutdown is done by the main process, after all workers are stopped
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    # importing the app migrates the database, before any worker does it
+    from app import buffer, boundary, pipeline, udp, metrics
+    from app.ingest import Pipeline
+    ready.set()
+
+    # replies to workers already stopped are not waited for on exit
+    for queue in replies:
+        queue.cancel_join_thread()
+
+    def stats():
+        result = dict(buffer.stats(), **boundary.stats())
+        if udp.listener is not None:
+            result.update(udp.listener.stats())
+        return result
+
+    # the metrics of writing rows are only recorded here, but served by the
+    # workers
+    publisher = Publisher(replies, stats, metrics.writer_snapshot,
+        interval=config.getfloat('SERVICE', 'publish_interval', fallback=0.05))
+    publisher.thread.start()
+    # the observers of this process are those of the workers
+    pipeline.observers[:] = []
+
+    # replays the journal left over, if enabled
+    buffer.start()
+    # emissions received via UDP are handled here, with the same filters
+    udp_pipeline = Pipeline(buffer)
+    udp_pipeline.filters = pipeline.filters
+    udp_pipeline.batch_filters = pipeline.batch_filters
+    udp_pipeline.observers.append(publisher.put)
+    udp.start(udp_pipeline, config.getint('SERVICE', 'udp_port', fallback=0))
+
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        worker, id, rows = request
+        try:
+            reasons = pipeline.submit(rows)
+        except Exception as e:
+            if not isinstance(e, RuntimeError):
+                traceback.print_exc()
+            replies[worker].put(('error', (id, str(e))))
+            continue
+        replies[worker].put(('result', (id, reasons)))
+        publisher.put([row for row, reason in zip(rows, reasons) if reason is None], worker)
+    udp.stop()
+    buffer.close()
+
+
+def run_worker(index, sock, requests, replies):
+    'Serve requests on the socket, submitting rows to the writer process.'
+
+    from app import pipeline, metrics
+    from app.ingest import WriterSink
+    import serve_aiohttp
+
+    # checked by the writer process, see WriterSink
+    pipeline.filters[:] = []
+    pipeline.batch_filters[:] = []
+    pipeline.sink = WriterSink(index, requests, replies, pipeline.observers,
+        metrics.restore_writer)
+    serve_aiohttp.main(sock=sock)
+
+
+def main(port=None, workers=None, queue_size=None):
+    '''
+    Start the writer and the worker processes and wait for them.
+    '''
+
+    port = port or config.getint('SERVICE', 'port')
+    workers = workers or config.getint('SERVICE', 'workers', fallback=os.cpu_count())
+    queue_size = queue_size or config.getint('SERVICE', 'queue_size', fallback=10000)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(('0.0.0.0', port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+
+    requests = multiprocessing.Queue(queue_size)
+    replies = [multiprocessing.Queue() for i in range(workers)]
+    ready = multiprocessing.Event()
+    writer = multiprocessing.Process(target=run_writer, args=(requests, replies, ready),
+        name='writer')
+    writer.start()
+    while not ready.wait(1):
+        if not writer.is_alive():
+            print('The writer process failed to start.')
+            sys.exit(1)
+    procs = [multiprocessing.Process(target=run_worker, args=(i, sock, requests, replies[i]),
+        name='worker-%d' % i) for i in range(workers)]
+    for p in procs:
+        p.start()
+    print('======== Running on http://0.0.0.0:%d with %d workers ========' % (port, workers))
+
+    def stop(signum, frame):
+        for p in procs:
+            if p.is_alive():
+                p.terminate()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    try:
+        for p in procs:
+            p.join()
+    finally:
+        # all rows of the workers are in the queue now
+        requests.put(None)
+        writer.join()
+        sock.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -6,6 +6,7 @@ Tool for creating a pool of moving vehicles emitting GPS data.
 
 import sys
 import uuid
+import socket
 import time
 import random
 import asyncio
@@ -13,9 +14,13 @@ import sqlite3
 import configparser
 import argparse
 
+import numpy as np
 import requests
 
-from utils import distance, destination
+import database
+import protocol
+import vehicles
+from utils import distance, destination, distances, destinations
 
 
 config_path = 'config.ini'
@@ -25,11 +30,32 @@ port = config.get('SERVICE', 'port')
 endpoint = config.get('SERVICE', 'endpoint')
 url = 'http://localhost:%s%s' % (port, endpoint)
 path = config.get('SERVICE', 'database')
-conn = sqlite3.connect(path)
+udp_address = ('localhost', config.getint('SERVICE', 'udp_port', fallback=0))
+# opened when first used, so importing this module (like loadtest.py does)
+# neither opens the database nor a socket
+conn = None
+udp_sock = None
 
 km_h_to_m_s = 1000 / 3600
 
 
+def get_connection():
+    '''
+    Return the database connection, opened with the pragmas of the server
+    (see app/storage.py), e.g. in WAL mode with synchronous=NORMAL unless
+    configured otherwise in section SQLITE.
+    '''
+
+    global conn
+    if conn is None:
+        conn = sqlite3.connect(path)
+        pragmas = [('journal_mode', 'wal'), ('synchronous', 'normal'), ('cache_size', -16000),
+            ('mmap_size', 256 * 1024 * 1024), ('busy_timeout', 5000)]
+        for key, default in pragmas:
+            conn.execute('PRAGMA %s = %s' % (key, config.get('SQLITE', key, fallback=default)))
+    return conn
+
+
 class Vehicle(object):
     '''
     A vehicle, able to move and store its state into a database or via an API endpoint.
@@ -91,6 +117,8 @@ class Vehicle(object):
                 self.save_api()
             elif self.storage == 'database':
                 self.save_database()
+            elif self.storage == 'udp':
+                self.save_udp()
         return self
 
     def save_api(self):
@@ -114,11 +142,172 @@ class Vehicle(object):
     def save_database(self):
         'Save current vehicle state into a database.'
 
-        cursor = conn.cursor()
-        cmd = "INSERT INTO traffic VALUES (?, ?, ?, ?, ?, ?)"
-        vals = (self.uid, self.type, self.ts, self.longitude, self.lattitude, self.heading)
-        cursor.execute(cmd, vals)
+        vals = (self.uid, self.type, int(round(self.ts * 1000)),
+            self.longitude, self.lattitude, self.heading)
+        conn = get_connection()
+        with conn:
+            vehicles.insert(conn, [vals])
+
+
+    def save_udp(self):
+        'Send current vehicle state in one UDP datagram.'
+
+        save_rows_udp([(self.uid, self.type, self.ts,
+            self.longitude, self.lattitude, self.heading)])
+
+
+class Fleet(object):
+    '''
+    A fleet of vehicles, stored in arrays and moved all at once per tick.
+
+    This behaves like a pool of Vehicle objects, but computes one tick for
+    all vehicles with a few vectorized operations. Vehicles that have left
+    the city boundary once stop emitting.
+
+    Given a database cursor, all vehicles are added to the vehicles table
+    once, so records() can return rows to be inserted as they are.
+    '''
+
+    allowed_types = Vehicle.allowed_types
+    update_interval = Vehicle.update_interval
+    city_center = Vehicle.city_center
+
+    def __init__(self, num, typ=None, start=None, cursor=None):
+        start = time.time() if start is None else start
+        self.num = num
+        self.uid = np.array([str(uuid.uuid4()) for i in range(num)], dtype=object)
+        if typ is None:
+            self.type = np.random.choice(np.array(self.allowed_types, dtype=object), num)
+        else:
+            assert typ in self.allowed_types
+            self.type = np.full(num, typ, dtype=object)
+        # spread the emissions of all vehicles over one update interval
+        self.ts = start + np.random.random(num) * self.update_interval
+        # speed is in meters / sec
+        self.speed = np.random.randint(10, 50, num) * km_h_to_m_s
+        self.heading = np.random.random(num) * 360
+        self.lattitude = np.full(num, self.city_center['lat'])
+        self.longitude = np.full(num, self.city_center['lon'])
+        self.inside = np.ones(num, dtype=bool)
+        if cursor is not None:
+            uids = self.uid.tolist()
+            ids = vehicles.intern(cursor, uids)
+            self.vehicle = np.array([ids[uid] for uid in uids])
+            self.type_code = np.array([vehicles.type_codes[t] for t in self.type.tolist()])
+
+    def step(self):
+        'Move all vehicles one step and return the rows to be emitted.'
+
+        self.move()
+        return self.rows()
+
+    def move(self):
+        'Move all vehicles one step and return the number of vehicles inside.'
+
+        self.ts += self.update_interval
+        dist = self.speed * self.update_interval
+        self.lattitude, self.longitude = destinations(
+            self.lattitude, self.longitude, self.heading, dist)
+
+        # new heading, adding a small random amount with slight clock-wise bias
+        self.heading += np.random.randint(-50, 100, self.num) / 10
+        self.heading %= 360
+
+        cc = self.city_center
+        self.inside &= distances(cc['lat'], cc['lon'], self.lattitude, self.longitude) < 50000
+        return int(self.inside.sum())
+
+    def rows(self):
+        'Return the current state of all vehicles inside as traffic table rows.'
+
+        m = self.inside
+        return list(zip(
+            self.uid[m].tolist(),
+            self.type[m].tolist(),
+            self.ts[m].tolist(),
+            self.longitude[m].tolist(),
+            self.lattitude[m].tolist(),
+            self.heading[m].tolist()))
+
+    def records(self):
+        '''
+        Return the current state of all vehicles inside as values to be
+        inserted into the traffic table (needs a cursor when built).
+        '''
+
+        m = self.inside
+        return list(zip(
+            self.vehicle[m].tolist(),
+            self.type_code[m].tolist(),
+            np.round(self.ts[m] * 1000).astype(np.int64).tolist(),
+            self.longitude[m].tolist(),
+            self.lattitude[m].tolist(),
+            self.heading[m].tolist()))
+
+
+def save_rows_api(rows):
+    'Save many rows via the batch API endpoint in one request.'
+
+    keys = ['uid', 'type', 'timestamp', 'longitude', 'lattitude', 'heading']
+    data = [dict(zip(keys, row)) for row in rows]
+    batch_url = url + '/batch'
+    try:
+        requests.post(batch_url, json=data, timeout=60)
+    except requests.RequestException:
+        msg = 'Failed calling POST "%s". Is the server running?' % batch_url
+        print(msg)
+        sys.exit(0)
+
+
+def save_rows_udp(rows, per_datagram=1):
+    '''
+    Send rows in the binary format of protocol.py via UDP.
+
+    Each datagram contains per_datagram rows, by default one like sent by
+    every single vehicle.
+    '''
+
+    global udp_sock
+    if udp_sock is None:
+        udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    for i in range(0, len(rows), per_datagram):
+        udp_sock.sendto(protocol.encode(rows[i:i + per_datagram]), udp_address)
+
+
+def fleet_main(num, dur, typ, storage, per_datagram=1, ticks_per_commit=10):
+    '''
+    Simulate a whole fleet tick by tick, storing each tick with one insert,
+    or one request or datagrams. Database inserts of ticks_per_commit ticks
+    are committed at once.
+    '''
+
+    start = time.time()
+    if storage == 'database':
+        conn = get_connection()
+        with conn:
+            fleet = Fleet(num, typ=typ, start=start, cursor=conn)
+    else:
+        fleet = Fleet(num, typ=typ, start=start)
+    num_ticks = int(dur // fleet.update_interval)
+    num_rows = 0
+    for i in range(num_ticks):
+        num_inside = fleet.move()
+        if not num_inside:
+            break
+        if storage == 'api':
+            save_rows_api(fleet.rows())
+        elif storage == 'database':
+            conn.executemany(vehicles.insert_cmd, fleet.records())
+            if (i + 1) % ticks_per_commit == 0:
+                conn.commit()
+        elif storage == 'udp':
+            save_rows_udp(fleet.rows(), per_datagram)
+        num_rows += num_inside
+    if storage == 'database':
         conn.commit()
+    elapsed = time.time() - start
+    msg = 'simulated %d vehicles for %d ticks, saved %d rows in %.1f seconds'
+    print(msg % (num, num_ticks, num_rows, elapsed))
 
 
 async def create_traffic(vehicle, dur, loop):
@@ -184,16 +373,43 @@ if __name__ == '__main__':
         help='Run in real-time mode (waiting for time to pass)')
     add_arg('--store',
         default='database', metavar='MODE',
-        help='Data storage mode, either "database" (default) or "api".')
+        help='Data storage mode, either "database" (default), "api" or '
+            '"udp" (binary datagrams, see protocol.py).')
+    add_arg('--fleet',
+        action='store_true',
+        help='Move all vehicles at once per tick (fast, not in real-time).')
+    add_arg('--ticks-per-commit',
+        type=int, default=10, metavar='NUM',
+        help='Number of ticks inserted per transaction (default: 10, with '
+            '--fleet and --store database only).')
+    add_arg('--per-datagram',
+        type=int, default=1, metavar='NUM',
+        help='Number of rows sent per UDP datagram (default: 1, with --fleet '
+            'only, at most %d).' % protocol.records_per_datagram)
     type_help = 'Vehicle type to use for all vehicles, must be one of: ' \
-        '%s (default: "bus").' % ", ".join(Vehicle.allowed_types)
+        '%s (default: "bus"), or "mixed" for random types ' \
+        '(with --fleet only).' % ", ".join(Vehicle.allowed_types)
     add_arg('--type',
         default='bus', metavar='TYPE', 
-        choices=Vehicle.allowed_types, 
+        choices=Vehicle.allowed_types + ['mixed'], 
         help=type_help)
 
     args = parser.parse_args()
-    if args.live:
+    if args.type == 'mixed' and not args.fleet:
+        parser.error('--type mixed can only be used with --fleet')
+    if not 1 <= args.per_datagram <= protocol.records_per_datagram:
+        parser.error('--per-datagram must be between 1 and %d' % protocol.records_per_datagram)
+    if args.store == 'udp' and not udp_address[1]:
+        parser.error('--store udp needs udp_port in file "%s"' % config_path)
+    if args.ticks_per_commit < 1:
+        parser.error('--ticks-per-commit must be at least 1')
+    if args.store == 'database':
+        database.migrate(get_connection())
+    if args.fleet:
+        typ = None if args.type == 'mixed' else args.type
+        fleet_main(args.num, args.dur, typ, args.store, args.per_datagram,
+            args.ticks_per_commit)
+    elif args.live:
         async_main(args.num, args.dur, args.type, args.store, args.live)
     else:
         main(args.num, args.dur, args.type, args.store, args.live)
@@ -0,0 +1,39 @@
+"""
+Common setup of the tests.
+
+The modules read config.ini from the current directory when imported, and
+importing the app package opens and migrates the configured database. So
+the tests run in a temporary directory with a copy of the configuration
+and a new database, never touching the database of the repository.
+"""
+
+import os
+import sys
+import atexit
+import shutil
+import tempfile
+
+import pytest
+
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, root)
+
+directory = tempfile.mkdtemp(prefix='snowdonia-tests-')
+atexit.register(shutil.rmtree, directory, True)
+shutil.copy(os.path.join(root, 'config.ini'), directory)
+os.chdir(directory)
+
+import database
+
+database.create()
+
+
+@pytest.fixture
+def db_path(tmp_path, monkeypatch):
+    'Path of a new database migrated to the latest version.'
+
+    path = str(tmp_path / 'test.db')
+    monkeypatch.setattr(database, 'path', path)
+    database.create()
+    return path
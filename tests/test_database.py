@@ -0,0 +1,85 @@
+import sqlite3
+
+import pytest
+
+import rollups
+import database
+import vehicles
+
+
+uids = ['76b1b23a-9763-41e8-9727-a63955cb5daf', 'e7698142-3a16-4a58-a7f4-44d9aeab663d']
+
+
+def counts(conn):
+    'Return the counts of the traffic_counts table and of COUNT(*) by type.'
+
+    stored = dict(conn.execute('SELECT type, count FROM traffic_counts WHERE count > 0'))
+    actual = dict(conn.execute('SELECT type, count(*) FROM traffic GROUP BY type'))
+    return stored, actual
+
+
+def test_migrate_from_version_0(tmp_path):
+    # the schema and rows of the original database, before any migration
+    conn = sqlite3.connect(str(tmp_path / 'legacy.db'))
+    conn.execute('''CREATE TABLE traffic (
+                        uid text,
+                        type text,
+                        timestamp real,
+                        longitude real,
+                        lattitude real,
+                        heading real
+                    )''')
+    legacy = [(uid, typ, 1473009221.873 + 20 * i, 13.38 - 0.001 * i, 52.51, 90.0)
+        for uid, typ in zip(uids, ['bus', 'tram']) for i in range(5)]
+    conn.executemany('INSERT INTO traffic VALUES (?, ?, ?, ?, ?, ?)', legacy)
+    conn.commit()
+    assert database.get_version(conn) == 0
+
+    database.migrate(conn)
+    assert database.get_version(conn) == len(database.migrations)
+    records = [r for chunk in vehicles.iter_records(conn) for r in chunk]
+    assert sorted(records) == sorted((uid, typ, int(round(ts * 1000)), lon, lat, heading)
+        for uid, typ, ts, lon, lat, heading in legacy)
+    assert conn.execute('SELECT count(*) FROM vehicles').fetchone()[0] == 2
+    assert conn.execute('SELECT count(*) FROM trip_state').fetchone()[0] == 2
+    assert rollups.totals(conn) == dict(bus=5, tram=5)
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(rollup_vehicles)')]
+    assert 'type' in columns
+
+    # nothing left to do
+    database.migrate(conn)
+    assert database.get_version(conn) == len(database.migrations)
+
+
+def test_row_ids_not_reused(db_path):
+    conn = sqlite3.connect(db_path)
+    records = [(uids[0], 'bus', 1473009221873 + i, 13.38, 52.51, 0.0) for i in range(3)]
+    with conn:
+        vehicles.insert(conn, records)
+        conn.execute('DELETE FROM traffic WHERE id = 3')
+        vehicles.insert(conn, records[:1])
+    assert [r[0] for r in conn.execute('SELECT id FROM traffic ORDER BY id')] == [1, 2, 4]
+
+
+def test_traffic_counts(db_path):
+    conn = sqlite3.connect(db_path)
+    records = [(uid, typ, 1473009221873 + i, 13.38, 52.51, 0.0)
+        for i, (uid, typ) in enumerate(zip(uids * 10, ['bus', 'tram', 'taxi'] * 7))]
+    with conn:
+        vehicles.insert(conn, records)
+    stored, actual = counts(conn)
+    codes = vehicles.type_codes
+    assert stored == actual == {codes['bus']: 7, codes['tram']: 7, codes['taxi']: 6}
+
+    with conn:
+        conn.execute('DELETE FROM traffic WHERE type = ? AND id % 2 = 0', (codes['tram'],))
+        conn.execute('DELETE FROM traffic WHERE type = ?', (codes['taxi'],))
+    stored, actual = counts(conn)
+    assert stored == actual
+
+    # a failed transaction leaves both unchanged
+    with pytest.raises(sqlite3.IntegrityError):
+        with conn:
+            vehicles.insert(conn, records)
+            conn.execute('INSERT INTO traffic (id) VALUES (1)')
+    assert counts(conn) == (stored, actual)
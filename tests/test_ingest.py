@@ -0,0 +1,65 @@
+import json
+
+import pytest
+
+from app.ingest import parse_emission, parse_batch
+
+
+emission = dict(
+    uid='76b1b23a-9763-41e8-9727-a63955cb5daf',
+    type='bus',
+    timestamp=1472716308.5,
+    longitude=13.38,
+    lattitude=52.51,
+    heading=370.0,
+)
+
+
+def test_parse_emission():
+    row = parse_emission(dict(emission, uid=emission['uid'].upper(), longitude='13.38'))
+    assert row == (emission['uid'], 'bus', 1472716308.5, 13.38, 52.51, 10.0)
+
+
+@pytest.mark.parametrize('changes, message', [
+    (dict(uid='not-a-uuid'), 'invalid uid'),
+    (dict(type='boat'), 'invalid type'),
+    (dict(timestamp='now'), 'must be numbers'),
+    (dict(heading=None), 'must be numbers'),
+    (dict(longitude=[13.38]), 'must be numbers'),
+    (dict(lattitude='nan'), 'must be finite'),
+    (dict(timestamp=float('inf')), 'must be finite'),
+    (dict(heading=float('-inf')), 'must be finite'),
+    (dict(timestamp=-1), 'timestamp out of range'),
+    (dict(timestamp=1e300), 'timestamp out of range'),
+    (dict(longitude=180.5), 'out of range'),
+    (dict(lattitude=-91), 'out of range'),
+])
+def test_parse_emission_invalid(changes, message):
+    with pytest.raises(ValueError, match=message):
+        parse_emission(dict(emission, **changes))
+
+
+def test_parse_emission_missing_fields():
+    data = dict(emission)
+    del data['uid'], data['heading']
+    with pytest.raises(ValueError, match='missing field\\(s\\): uid, heading'):
+        parse_emission(data)
+
+
+def test_parse_batch():
+    items = [emission, dict(emission, type='tram')]
+    assert parse_batch(json.dumps(items)) == items
+    ndjson = '\n'.join(json.dumps(item) for item in items)
+    assert parse_batch('\n%s\n\n' % ndjson) == items
+    assert parse_batch('') == []
+
+
+@pytest.mark.parametrize('body', [
+    '[{"uid": 1}',
+    '{"uid": 1}\n{"uid": ',
+    '{"uid": 1} {"uid": 2}',
+    'NaN-',
+])
+def test_parse_batch_invalid(body):
+    with pytest.raises(ValueError):
+        parse_batch(body)
@@ -0,0 +1,71 @@
+import os
+import sqlite3
+
+from app.journal import Journal, JournaledBuffer, record_size, get_position
+
+
+uid = '76b1b23a-9763-41e8-9727-a63955cb5daf'
+
+
+def make_rows(num, start=1472716308.0):
+    return [(uid, 'bus', start + i, 13.38, 52.51, 1.0) for i in range(num)]
+
+
+def replay(db_path, journal, rows=None):
+    'Start a buffer on the journal, apply it (and rows) and close it.'
+
+    buffer = JournaledBuffer(db_path, journal, batch_size=100, max_latency=0.05)
+    buffer.start()
+    if rows:
+        buffer.put_many(rows)
+    buffer.close()
+    return buffer
+
+
+def count(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute('SELECT count(*) FROM traffic').fetchone()[0]
+    finally:
+        conn.close()
+
+
+def test_replay_truncated_segment(db_path, tmp_path):
+    # a crash while appending leaves the last record of a segment incomplete
+    journal = Journal(str(tmp_path / 'journal'), segment_size=1000)
+    journal.open()
+    journal.append(make_rows(250))
+    journal.close()
+    name = journal.filename(1)
+    os.truncate(name, os.path.getsize(name) - record_size // 2)
+
+    buffer = replay(db_path, Journal(journal.directory, segment_size=1000))
+    assert count(db_path) == 249
+    assert buffer.damaged == 0
+    assert buffer.stats()['rows_rejected'] == 0
+    assert Journal(journal.directory).segments() == []
+
+    # applied exactly once, rows appended after the restart are applied too
+    replay(db_path, Journal(journal.directory, segment_size=1000),
+        make_rows(100, start=1472717000.0))
+    assert count(db_path) == 349
+    conn = sqlite3.connect(db_path)
+    segment, offset = get_position(conn)
+    conn.close()
+    assert (segment, offset) == (2, 100)
+
+
+def test_replay_damaged_records(db_path, tmp_path):
+    # records after one with a wrong checksum are skipped, not applied later
+    journal = Journal(str(tmp_path / 'journal'))
+    journal.open()
+    journal.append(make_rows(10))
+    journal.close()
+    with open(journal.filename(1), 'r+b') as f:
+        f.seek(4 * record_size + 20)
+        f.write(b'\xff')
+
+    buffer = replay(db_path, Journal(journal.directory))
+    assert count(db_path) == 4
+    assert buffer.damaged == 6
+    assert Journal(journal.directory).segments() == []
@@ -0,0 +1,57 @@
+import time
+
+import pytest
+
+from app.queries import time_criteria
+from app.positions import parse_bbox, positions_query
+
+
+def test_time_criteria():
+    assert time_criteria({}) == []
+    assert time_criteria(dict(since='', until='')) == []
+    assert time_criteria(dict(since='1473009221.5', until='1473009300')) == [
+        ('timestamp', '>=', 1473009221500), ('timestamp', '<', 1473009300000)]
+
+
+def test_time_criteria_duration():
+    [(column, op, value)] = time_criteria(dict(duration='PT1H'))
+    assert (column, op) == ('timestamp', '>=')
+    assert abs(value - (time.time() - 3600) * 1000) < 60000
+
+
+@pytest.mark.parametrize('args, message', [
+    (dict(since='yesterday'), 'must be finite numbers'),
+    (dict(since='inf'), 'must be finite numbers'),
+    (dict(until='-inf'), 'must be finite numbers'),
+    (dict(until='nan'), 'must be finite numbers'),
+    (dict(since='1e400'), 'must be finite numbers'),
+    (dict(duration='1 hour'), 'invalid ISO 8601 duration'),
+])
+def test_time_criteria_invalid(args, message):
+    with pytest.raises(ValueError, match=message):
+        time_criteria(args)
+
+
+def test_parse_bbox():
+    assert parse_bbox('13.0,52.3,13.8,52.7') == [13.0, 52.3, 13.8, 52.7]
+    assert positions_query(dict(type='bus', bbox='-180,-90,180,90')) == (
+        'bus', [-180.0, -90.0, 180.0, 90.0])
+    assert positions_query({}) == (None, None)
+
+
+@pytest.mark.parametrize('value, message', [
+    ('13.0,52.3,13.8', 'needs four values'),
+    ('13.0,52.3,13.8,52.7,1', 'needs four values'),
+    ('13.0,52.3,inf,52.7', 'must be finite'),
+    ('nan,52.3,13.8,52.7', 'must be finite'),
+    ('13.0,52.3,east,52.7', 'could not convert'),
+    ('', 'could not convert'),
+])
+def test_parse_bbox_invalid(value, message):
+    with pytest.raises(ValueError, match=message):
+        parse_bbox(value)
+
+
+def test_positions_query_invalid_type():
+    with pytest.raises(ValueError, match='Unknown vehicle type'):
+        positions_query(dict(type='boat'))
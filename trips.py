@@ -0,0 +1,226 @@
+"""
+Incremental aggregation of vehicle trajectories.
+
+Every batch of rows written into the traffic table is also fed into
+update(), in the same transaction. For every vehicle it continues the
+trajectory from the last point seen before (kept in the trip_state table)
+and adds up, per vehicle and time bucket (one hour by default), in the
+trip_stats table:
+
+    ===========  ==================================================
+    points       number of emissions
+    distance     distance travelled in meters
+    duration     time in milliseconds covered by the trajectory,
+                 without gaps longer than max_gap
+    max_speed    highest speed between two emissions in m/s
+    stop_time    time in milliseconds spent at less than stop_speed
+    stops        number of stops lasting at least min_stop
+    inside_time  time in milliseconds inside the city boundary, from
+                 the first to the last emission, including gaps
+    ===========  ==================================================
+
+The average speed is distance / duration. Segments are assigned to the
+bucket of their end point. Emissions older than the last one seen for a
+vehicle are stored, but not aggregated. As emissions outside the city
+boundary are never stored, the whole time between two emissions of a
+vehicle is spent inside of it.
+
+Distances are computed with the flat approximation of utils.distances()
+for a whole batch at once, which is within 0.5 m of utils.distance() for
+distances up to 50 km, but much faster.
+
+The settings are read from the TRIPS section of ``config.ini``.
+"""
+
+import configparser
+
+import vehicles
+from utils import distances
+
+
+config_path = 'config.ini'
+config = configparser.ConfigParser()
+config.read(config_path)
+bucket_ms = int(config.getfloat('TRIPS', 'bucket', fallback=3600) * 1000)
+stop_speed = config.getfloat('TRIPS', 'stop_speed', fallback=0.5)
+min_stop_ms = int(config.getfloat('TRIPS', 'min_stop', fallback=60) * 1000)
+max_gap_ms = int(config.getfloat('TRIPS', 'max_gap', fallback=300) * 1000)
+
+# summed up columns of the trip_stats table
+stat_columns = ['points', 'distance', 'duration', 'stop_time', 'stops', 'inside_time']
+
+
+def create_tables(cursor):
+    'Create the tables for trip aggregates (called by a database migration).'
+
+    cursor.execute('''CREATE TABLE trip_state (
+                          uid text primary key,
+                          timestamp integer,
+                          longitude real,
+                          lattitude real,
+                          stop_since integer
+                      )''')
+    cursor.execute('''CREATE TABLE trip_stats (
+                          uid text,
+                          bucket integer,
+                          type text,
+                          points integer,
+                          distance real,
+                          duration integer,
+                          max_speed real,
+                          stop_time integer,
+                          stops integer,
+                          inside_time integer,
+                          primary key (uid, bucket)
+                      ) WITHOUT ROWID''')
+    cursor.execute('CREATE INDEX trip_stats_bucket ON trip_stats (bucket)')
+
+
+def rebuild(cursor, chunks=None):
+    '''
+    Aggregate all rows of the traffic table from scratch.
+
+    The rows are read as chunks of records ordered by vehicle and time,
+    by default with vehicles.iter_records().
+    '''
+
+    cursor.execute('DELETE FROM trip_state')
+    cursor.execute('DELETE FROM trip_stats')
+    if chunks is None:
+        chunks = vehicles.iter_records(cursor.connection, 'vehicle, timestamp')
+    for records in chunks:
+        update(cursor, records)
+
+
+def load_state(cursor, uids):
+    'Return the last point of the given vehicles as a dict by uid.'
+
+    state = {}
+    uids = list(uids)
+    # stay below the maximum number of placeholders
+    for i in range(0, len(uids), 500):
+        chunk = uids[i:i + 500]
+        cmd = '''SELECT uid, timestamp, longitude, lattitude, stop_since
+                 FROM trip_state WHERE uid IN (%s)''' % ','.join('?' * len(chunk))
+        for uid, ts, lon, lat, stop_since in cursor.execute(cmd, chunk):
+            state[uid] = [ts, lon, lat, stop_since]
+    return state
+
+
+def update(cursor, records):
+    '''
+    Add records of the traffic table to the trip aggregates.
+
+    Records are tuples of uid, type, timestamp (in milliseconds), longitude,
+    lattitude and heading, in any order. This must be called in the same
+    transaction as inserting the records. Returns the speed (in m/s) at
+    every record aggregated after another one, as a dict by uid and
+    timestamp.
+    '''
+
+    records = sorted(records, key=lambda r: (r[0], r[2]))
+    state = load_state(cursor, set(r[0] for r in records))
+
+    # segments from the previous point of each vehicle to every new point
+    points, segments = [], []
+    for uid, typ, ts, lon, lat, heading in records:
+        last = state.get(uid)
+        if last is not None and ts <= last[0]:
+            continue
+        points.append((uid, typ, ts, lon, lat))
+        segments.append(last[:3] if last else None)
+        state[uid] = [ts, lon, lat, last[3] if last else None]
+    if not points:
+        return {}
+
+    known = [i for i, seg in enumerate(segments) if seg is not None]
+    dists = distances([segments[i][2] for i in known], [segments[i][1] for i in known],
+        [points[i][4] for i in known], [points[i][3] for i in known]).tolist()
+    dists = dict(zip(known, dists))
+
+    stats, speeds = {}, {}
+    stop_since = dict((uid, s[3]) for uid, s in state.items())
+    for i, (uid, typ, ts, lon, lat) in enumerate(points):
+        key = (uid, ts - ts % bucket_ms)
+        s = stats.get(key)
+        if s is None:
+            s = stats[key] = dict(type=typ, points=0, distance=0.0, duration=0,
+                max_speed=0.0, stop_time=0, stops=0, inside_time=0)
+        s['points'] += 1
+        if i not in dists:
+            continue
+        prev_ts = segments[i][0]
+        dt = ts - prev_ts
+        s['inside_time'] += dt
+        if dt > max_gap_ms:
+            # the vehicle was not seen for a while, start a new trajectory
+            stop_since[uid] = None
+            continue
+        speed = speeds[uid, ts] = dists[i] * 1000.0 / dt
+        s['distance'] += dists[i]
+        s['duration'] += dt
+        s['max_speed'] = max(s['max_speed'], speed)
+        if speed < stop_speed:
+            since = stop_since.get(uid)
+            if since is None:
+                since = stop_since[uid] = prev_ts
+            s['stop_time'] += dt
+            if prev_ts - since < min_stop_ms <= ts - since:
+                s['stops'] += 1
+        else:
+            stop_since[uid] = None
+
+    cursor.executemany('''INSERT OR REPLACE INTO trip_state
+        (uid, timestamp, longitude, lattitude, stop_since) VALUES (?, ?, ?, ?, ?)''',
+        [(uid, s[0], s[1], s[2], stop_since.get(uid)) for uid, s in state.items()])
+    cursor.executemany('''INSERT INTO trip_stats
+        (uid, bucket, type, points, distance, duration, max_speed, stop_time, stops, inside_time)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (uid, bucket) DO UPDATE SET
+            type = excluded.type,
+            max_speed = max(max_speed, excluded.max_speed), %s''' % ', '.join(
+            '%s = %s + excluded.%s' % (c, c, c) for c in stat_columns),
+        [(uid, bucket, s['type'], s['points'], s['distance'], s['duration'],
+          s['max_speed'], s['stop_time'], s['stops'], s['inside_time'])
+         for (uid, bucket), s in stats.items()])
+    return speeds
+
+
+def summary(conn, criteria, bucket=None, by_type=False):
+    '''
+    Return aggregates over time buckets as a list of dicts.
+
+    Criteria are like for build_where_clause(), on the columns uid, type
+    and bucket (in milliseconds). Buckets are bucket_ms long or, if given,
+    a multiple of that (in milliseconds). With by_type, the aggregates are
+    grouped by vehicle type too and contain the number of vehicles.
+    Timestamps and durations in the result are in seconds, distances in
+    meters and speeds in m/s.
+    '''
+
+    bucket = bucket or bucket_ms
+    if bucket <= 0 or bucket % bucket_ms:
+        raise ValueError('bucket must be a multiple of %g seconds.' % (bucket_ms / 1000.0))
+
+    criteria = [(k, op, v) for (k, op, v) in criteria if v is not None]
+    where = ' AND '.join('%s%s?' % (k, op) for (k, op, v) in criteria)
+    group = 'type, b' if by_type else 'b'
+    cmd = '''SELECT %s, count(DISTINCT uid), %s, max(max_speed)
+             FROM (SELECT *, bucket - bucket %% ? AS b FROM trip_stats %s)
+             GROUP BY %s ORDER BY b, %s''' % (
+        group, ', '.join('sum(%s)' % c for c in stat_columns),
+        'WHERE ' + where if where else '', group, group)
+    result = []
+    for row in conn.execute(cmd, [bucket] + [v for (k, op, v) in criteria]):
+        row = list(row)
+        res = dict(type=row.pop(0)) if by_type else {}
+        b, vehicles, points, dist, duration, stop_time, stops, inside_time, max_speed = row
+        res.update(bucket=b / 1000.0, points=points, distance=dist,
+            duration=duration / 1000.0,
+            avg_speed=dist * 1000.0 / duration if duration else 0.0,
+            max_speed=max_speed, stop_time=stop_time / 1000.0, stops=stops,
+            inside_time=inside_time / 1000.0)
+        if by_type:
+            res['vehicles'] = vehicles
+        result.append(res)
+    return result
@@ -0,0 +1,135 @@
+"""
+Compact storage of vehicles in the traffic table.
+
+Every vehicle is stored once in the vehicles table, which maps its UID,
+stored as 16 bytes, to a small integer id. Rows of the traffic table refer
+to the vehicle by this id and store the type as integer code (the same as
+in protocol.py), so they only contain fixed-width numbers:
+
+    ==========  ================================================
+    id          row id
+    vehicle     id of the vehicle in the vehicles table
+    type        vehicle type code, see protocol.type_codes
+    timestamp   milliseconds since the epoch
+    longitude   degrees
+    lattitude   degrees
+    heading     degrees
+    ==========  ================================================
+
+Queries select the vehicle id and type code, and decode() turns them back
+into the textual UID and type, e.g. for the CSV export. This is much
+faster than formatting UIDs in SQL.
+"""
+
+import uuid
+
+from protocol import type_codes, types
+
+
+insert_cmd = '''INSERT INTO traffic (vehicle, type, timestamp, longitude, lattitude, heading)
+                VALUES (?, ?, ?, ?, ?, ?)'''
+
+
+def create_table(cursor, schema='main'):
+    'Create the vehicles table (called by a database migration).'
+
+    cursor.execute('''CREATE TABLE IF NOT EXISTS %s.vehicles (
+                          id integer primary key,
+                          uid blob unique not null
+                      )''' % schema)
+
+
+# columns of the traffic table as records, like passed to ingest hooks,
+# but with vehicle ids and type codes, see decode()
+record_columns = 'vehicle, type, timestamp, longitude, lattitude, heading'
+
+# columns of the traffic table as returned to clients, with timestamps
+# converted from milliseconds to seconds, to be decoded too
+text_columns = '''vehicle AS uid, type, timestamp / 1000.0 AS timestamp,
+                  longitude, lattitude, heading'''
+
+# textual UIDs of all vehicles decoded so far by id, which never change
+uid_texts = {}
+
+
+def intern(cursor, uids, chunk_size=500):
+    '''
+    Return the ids of vehicles given by textual UIDs as a dict by UID.
+
+    Vehicles not in the vehicles table yet are added. Raises ValueError
+    for invalid UIDs.
+    '''
+
+    ids = {}
+    uids = list(uids)
+    for i in range(0, len(uids), chunk_size):
+        chunk = dict((uuid.UUID(uid).bytes, uid) for uid in uids[i:i + chunk_size])
+        cursor.executemany('INSERT OR IGNORE INTO vehicles (uid) VALUES (?)',
+            [(blob,) for blob in chunk])
+        cmd = 'SELECT id, uid FROM vehicles WHERE uid IN (%s)' % ', '.join('?' * len(chunk))
+        for id, blob in cursor.execute(cmd, list(chunk)).fetchall():
+            ids[chunk[blob]] = id
+    return ids
+
+
+def lookup(conn, uid):
+    'Return the id of a vehicle given by textual UID, or None if unknown.'
+
+    try:
+        blob = uuid.UUID(uid).bytes
+    except ValueError:
+        return None
+    row = conn.execute('SELECT id FROM vehicles WHERE uid = ?', (blob,)).fetchone()
+    return row[0] if row else None
+
+
+def decode(conn, rows, column=0):
+    '''
+    Replace the vehicle id in a column of rows, and the type code in the
+    next one, by the textual UID and type.
+
+    Unknown vehicles are read from the vehicles table with the connection.
+    Returns a list of tuples.
+    '''
+
+    missing = list(set(r[column] for r in rows).difference(uid_texts))
+    for i in range(0, len(missing), 500):
+        chunk = missing[i:i + 500]
+        cmd = 'SELECT id, uid FROM vehicles WHERE id IN (%s)' % ', '.join('?' * len(chunk))
+        for id, blob in conn.execute(cmd, chunk).fetchall():
+            uid_texts[id] = str(uuid.UUID(bytes=blob))
+    after = column + 2
+    return [r[:column] + (uid_texts[r[column]], types[r[column + 1]]) + r[after:] for r in rows]
+
+
+def iter_records(conn, order='id', chunk_size=100000):
+    '''
+    Yield all rows of the traffic table as lists of records in chunks,
+    ordered by the given columns.
+    '''
+
+    cursor = conn.execute('SELECT %s FROM traffic ORDER BY %s' % (record_columns, order))
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        yield decode(conn, rows)
+
+
+def encode(records, ids):
+    '''
+    Convert records into the values to be inserted into the traffic table.
+
+    Records are tuples of UID, type, timestamp (in milliseconds), longitude,
+    lattitude and heading, ids is a dict of vehicle ids by UID.
+    '''
+
+    return [(ids[uid], type_codes[typ], ts, lon, lat, heading)
+        for (uid, typ, ts, lon, lat, heading) in records]
+
+
+def insert(cursor, records):
+    'Insert records into the traffic table, adding new vehicles.'
+
+    ids = intern(cursor, set(r[0] for r in records))
+    cursor.executemany(insert_cmd, encode(records, ids))